@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Import-time regression benchmark for the startup path of the shell plugins.
+# Runs `python -X importtime -c "import <module>"` a few times for codex_query and
+# codex_client, then pipes the entries of the command paths through codex_client.py
+# in one-shot mode (no completion server) from a temporary install (see latency.py):
+# "# show config" and a query answered from the completion cache.
+# Fails if a heavy module is loaded on one of these paths or a process exceeds the budget.
+#
+# Usage: python benchmarks/import_time.py [--runs N] [--budget-ms MS] [--python <interpreter with openai>]
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+from mock_openai import MockConfig, start_server
+from latency import Install
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+
+# modules that must only be loaded once Codex is actually queried
+HEAVY_MODULES = ['openai', 'psutil', 'requests', 'sqlite3', 'configparser', 'pathlib', 'argparse']
+
+# entry points called by the shell plugins
+MODULES = ['codex_query', 'codex_client']
+
+# modules that must stay off the paths answered without an API call,
+# the settings and the completion cache need configparser and sqlite3
+COMMAND_HEAVY_MODULES = ['openai', 'psutil', 'requests', 'aiohttp']
+
+# entries answered without an API call, the query is answered once beforehand to fill the cache
+COMMANDS = [('show config', '# show config\n'), ('cache hit', '# list files\n')]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='codex_query import-time benchmark')
+    parser.add_argument('--runs', type=int, default=10, help='number of interpreter runs')
+    parser.add_argument('--budget-ms', type=float, default=50, help='maximum process startup time in milliseconds')
+    parser.add_argument('--python', default=sys.executable, help='interpreter with the requirements of src/ installed')
+    return parser.parse_args()
+
+def parse_importtime(stderr, module=None):
+    """
+    Returns: the cumulative import time of module in ms and the imported top-level modules
+    """
+    import_time = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        name = name.strip()
+        modules.add(name.split('.')[0])
+        if name == module:
+            import_time = int(cumulative) / 1000
+    return import_time, modules
+
+def run_once(module):
+    """
+    Returns: process wall time in ms, cumulative module import time in ms and the imported modules
+    """
+    env = dict(os.environ)
+    # the bytecode compiled by the first run is reused, like it is for a user
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=SRC_PATH, env=env, capture_output=True, text=True, check=True)
+    wall_time = (time.perf_counter() - start) * 1000
+    return (wall_time,) + parse_importtime(result.stderr, module)
+
+def run_command(install, entry, importtime=False):
+    """
+    Pipe entry through codex_client.py like the shell plugins do, without the completion server
+
+    Returns: process wall time in ms, the imported modules (with importtime) and the output
+    """
+    env = dict(install.env, CODEX_CLI_DAEMON='off')
+    # the first run compiles the bytecode of the install, like it happens once for a user
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    options = ['-X', 'importtime'] if importtime else []
+    start = time.perf_counter()
+    result = subprocess.run(
+        [install.python] + options + [os.path.join(install.path, 'src', 'codex_client.py'), '--shell', 'bash'],
+        input=entry, env=env, capture_output=True, text=True, check=True)
+    wall_time = (time.perf_counter() - start) * 1000
+    return wall_time, parse_importtime(result.stderr)[1], result.stdout
+
+def report(name, wall_times, heavy, budget_ms, import_times=None):
+    """
+    Print the measurements of one path
+
+    Returns: True if the path regressed
+    """
+    print('{}:'.format(name))
+    print('  process startup: min {:.1f} ms, median {:.1f} ms'.format(min(wall_times), sorted(wall_times)[len(wall_times) // 2]))
+    if import_times is not None:
+        print('  import: min {:.1f} ms, median {:.1f} ms'.format(min(import_times), sorted(import_times)[len(import_times) // 2]))
+    print('  heavy modules loaded: {}'.format(', '.join(heavy) if heavy else 'none'))
+
+    if heavy or min(wall_times) > budget_ms:
+        print('  FAILED: startup regression (budget {} ms)'.format(budget_ms))
+        return True
+    return False
+
+if __name__ == '__main__':
+    args = parse_args()
+    failed = False
+
+    for module in MODULES:
+        # the first run compiles the bytecode, it is not measured
+        run_once(module)
+
+        wall_times = []
+        import_times = []
+        for _ in range(args.runs):
+            wall_time, import_time, modules = run_once(module)
+            wall_times.append(wall_time)
+            import_times.append(import_time)
+
+        heavy = sorted(name for name in HEAVY_MODULES if name in modules)
+        failed = report(module, wall_times, heavy, args.budget_ms, import_times) or failed
+
+    server = start_server(MockConfig(latency_ms=0, jitter_ms=0, chunk_ms=0))
+    install = Install(args.python, 'http://127.0.0.1:{}/v1'.format(server.server_port))
+    try:
+        for name, entry in COMMANDS:
+            # the first run compiles the bytecode and fills the completion cache, it is not measured
+            run_command(install, entry)
+
+            wall_times = [run_command(install, entry)[0] for _ in range(args.runs)]
+            _, modules, output = run_command(install, entry, importtime=True)
+            if output.strip() == '':
+                print('{}: no output'.format(name))
+                failed = True
+                continue
+
+            heavy = sorted(name for name in COMMAND_HEAVY_MODULES if name in modules)
+            failed = report(name, wall_times, heavy, args.budget_ms) or failed
+    finally:
+        install.remove()
+        server.shutdown()
+
+    sys.exit(1 if failed else 0)
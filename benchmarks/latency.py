@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# End-to-end latency benchmark against a local mock of the OpenAI API (mock_openai.py).
+# Installs a copy of src/ and contexts/ in a temporary directory and drives
+# codex_client.py exactly like the bash and zsh plugins do: the buffer is piped
+# through stdin and the completion is streamed back on stdout.
+#
+# Scenarios:
+# - startup: "# show config", no API call, one-shot process vs completion server
+# - latency: keypress to first output byte and to the full completion, plus cached repeats
+# - context: multi-turn queries with 10 to 10000 interactions in the context
+# - rate_limit: queries while the mock answers part of the requests with 429
+#
+# The distributions are written as JSON (--output) so two versions can be compared.
+#
+# Usage: python benchmarks/latency.py [--runs N] [--python <interpreter with openai>] [--output results.json]
+#        [--scenarios startup,latency,context,rate_limit] [--latency-ms 300] [--jitter-ms 100]
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib.request
+
+from mock_openai import MockConfig, start_server
+
+ROOT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+
+SCENARIOS = ['startup', 'latency', 'context', 'rate_limit']
+CONTEXT_SIZES = [10, 100, 1000, 10000]
+
+QUERIES = ['list all files', 'show disk usage', 'find python files', 'count lines in a file', 'show running processes',
+           'print the current directory', 'compress a folder', 'show the git log', 'kill a process', 'show free memory']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='codex_query end-to-end latency benchmark')
+    parser.add_argument('--runs', type=int, default=20, help='queries per measurement')
+    parser.add_argument('--python', default=sys.executable, help='interpreter with the requirements of src/ installed')
+    parser.add_argument('--output', default='benchmark_results.json', help='machine-readable results')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated subset of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--context-sizes', default=','.join(str(size) for size in CONTEXT_SIZES))
+    parser.add_argument('--latency-ms', type=float, default=300, help='mock completion latency')
+    parser.add_argument('--jitter-ms', type=float, default=100, help='mock completion latency jitter')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.3, help='share of 429 responses in the rate_limit scenario')
+    return parser.parse_args()
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of sorted values
+    """
+    return values[max(0, -(-p * len(values) // 100) - 1)]
+
+def distribution(values):
+    """
+    Returns: the summary of a list of seconds, in milliseconds
+    """
+    values = sorted(value * 1000 for value in values)
+    if len(values) == 0:
+        return {'count': 0}
+    summary = {'count': len(values), 'min': values[0], 'mean': sum(values) / len(values), 'max': values[-1]}
+    for p in (50, 95, 99):
+        summary['p{}'.format(p)] = percentile(values, p)
+    return {key: round(value, 2) for key, value in summary.items()}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Install:
+    """
+    A throwaway copy of Codex CLI configured against the mock server
+    """
+
+    def __init__(self, python, api_base):
+        self.path = tempfile.mkdtemp(prefix='codex-cli-bench-')
+        self.python = python
+        shutil.copytree(os.path.join(ROOT_PATH, 'src'), os.path.join(self.path, 'src'), ignore=shutil.ignore_patterns('__pycache__', 'openaiapirc'))
+        shutil.copytree(os.path.join(ROOT_PATH, 'contexts'), os.path.join(self.path, 'contexts'))
+        shutil.copy(os.path.join(ROOT_PATH, 'content_filter_rules.txt'), self.path)
+        self.home = os.path.join(self.path, 'home')
+        os.mkdir(self.home)
+        self.write_config()
+
+        self.env = dict(os.environ,
+                        OPENAI_API_BASE=api_base,
+                        HOME=self.home,
+                        XDG_RUNTIME_DIR=self.home,
+                        TMPDIR=self.home)
+        self.env.pop('CODEX_CLI_PROFILE', None)
+        self.env.pop('CODEX_CLI_SESSION', None)
+
+    def write_config(self, client=None):
+        """
+        openaiapirc, by default with a limiter that never throttles the benchmark itself
+        """
+        client = client or {'requests_per_minute': 100000, 'burst': 1000}
+        with open(os.path.join(self.path, 'src', 'openaiapirc'), 'w') as f:
+            f.write('[openai]\norganization_id=org-benchmark\nsecret_key=sk-benchmark\nengine=code-davinci-002\n')
+            f.write('[client]\n' + ''.join('{}={}\n'.format(key, value) for key, value in client.items()))
+        self.reset_state()
+
+    def reset_state(self):
+        """
+        Forget the completion cache, the limiter state and the metrics between scenarios
+        """
+        for name in ['completion_cache.db', 'client_state.json', 'metrics.jsonl']:
+            if os.path.isfile(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+
+    def query(self, buffer, daemon=True):
+        """
+        Send the buffer like the shell plugins do
+
+        Returns: seconds to the first output byte, seconds to the end of the output, the output
+        """
+        env = dict(self.env, CODEX_CLI_DAEMON='on' if daemon else 'off')
+        start = time.perf_counter()
+        process = subprocess.Popen([self.python, os.path.join(self.path, 'src', 'codex_client.py'), '--shell', 'bash', '--stream'],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+        process.stdin.write(buffer.encode('utf-8'))
+        process.stdin.close()
+
+        first_byte = None
+        output = b''
+        while True:
+            data = process.stdout.read1(4096)
+            if not data:
+                break
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            output += data
+        process.wait()
+        total = time.perf_counter() - start
+        return first_byte if first_byte is not None else total, total, output.decode('utf-8', 'replace')
+
+    def start_server(self):
+        """
+        Start the completion server and wait until it answers
+        """
+        self.query('# show config\n')
+        for _ in range(100):
+            _, total, _ = self.query('# show config\n')
+            if total < 0.5:
+                return
+            time.sleep(0.05)
+
+    def stop_server(self):
+        subprocess.run([self.python, os.path.join(self.path, 'src', 'codex_client.py'), '--stop'], env=self.env, stdin=subprocess.DEVNULL, capture_output=True)
+
+    def reset_context(self, size):
+        """
+        Replace the multi-turn context with size interactions
+        """
+        # the store imports its helpers (e.g. context_dedup) lazily, src stays on the path until it is done
+        sys.path.insert(0, os.path.join(self.path, 'src'))
+        try:
+            from context_store import ContextStore
+            interactions = [('# {} {}\n'.format(QUERIES[i % len(QUERIES)], i), 'echo {}\n\n'.format(i), 12) for i in range(size)]
+            ContextStore(os.path.join(self.path, 'current_context.log'), os.path.join(self.path, 'current_context.idx')).reset(interactions)
+        finally:
+            sys.path.pop(0)
+
+    def remove(self):
+        self.stop_server()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def unique_query(i):
+    return '# {} ({})\n'.format(QUERIES[i % len(QUERIES)], random.randrange(1 << 30))
+
+def run_queries(install, runs, daemon=True, buffers=None):
+    """
+    Returns: the first byte and total distributions of the queries and their failures
+    """
+    first_bytes = []
+    totals = []
+    failures = 0
+    for i in range(runs):
+        first_byte, total, output = install.query(buffers[i] if buffers else unique_query(i), daemon)
+        if 'ls -la' not in output:
+            failures += 1
+            continue
+        first_bytes.append(first_byte)
+        totals.append(total)
+    return {'first_byte': distribution(first_bytes), 'total': distribution(totals), 'failures': failures}
+
+def mock_stats(server):
+    with urllib.request.urlopen('http://127.0.0.1:{}/_stats'.format(server.server_port)) as response:
+        return json.loads(response.read())
+
+def bench_startup(install, args):
+    results = {}
+    for mode, daemon in (('one_shot', False), ('server', True)):
+        if daemon:
+            install.start_server()
+        times = [install.query('# show config\n', daemon)[1] for _ in range(args.runs)]
+        results[mode] = distribution(times)
+    return results
+
+def bench_latency(install, args):
+    results = {}
+    for mode, daemon in (('one_shot', False), ('server', True)):
+        install.reset_state()
+        if daemon:
+            install.start_server()
+        results[mode] = run_queries(install, args.runs, daemon)
+
+    # the same buffers again, answered from the completion cache
+    buffers = [unique_query(i) for i in range(args.runs)]
+    run_queries(install, args.runs, True, buffers)
+    results['server_cached'] = run_queries(install, args.runs, True, buffers)
+    return results
+
+def bench_context(install, args):
+    results = {}
+    install.start_server()
+    install.query('# start multi-turn\n')
+    for size in [int(size) for size in args.context_sizes.split(',')]:
+        first_bytes = []
+        totals = []
+        failures = 0
+        for i in range(args.runs):
+            # every query appends to the context, start each one from the same size
+            install.reset_context(size)
+            first_byte, total, output = install.query(unique_query(i))
+            if 'ls -la' not in output:
+                failures += 1
+                continue
+            first_bytes.append(first_byte)
+            totals.append(total)
+        results[str(size)] = {'first_byte': distribution(first_bytes), 'total': distribution(totals), 'failures': failures}
+    install.query('# stop multi-turn\n')
+    return results
+
+def bench_rate_limit(install, args, server):
+    # the default limiter, so its adaptation to the 429 responses is part of the measurement
+    install.write_config({})
+    install.stop_server()
+    install.start_server()
+    server.config.rate_limit_rate = args.rate_limit_rate
+    server.stats.reset()
+    try:
+        results = run_queries(install, args.runs)
+    finally:
+        server.config.rate_limit_rate = 0.0
+    results['rate_limit_rate'] = args.rate_limit_rate
+    results['mock'] = mock_stats(server)
+    install.write_config()
+    install.stop_server()
+    return results
+
+if __name__ == '__main__':
+    args = parse_args()
+    scenarios = args.scenarios.split(',')
+
+    server = start_server(MockConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms))
+    install = Install(args.python, 'http://127.0.0.1:{}/v1'.format(server.server_port))
+
+    results = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'python': subprocess.run([args.python, '--version'], capture_output=True, text=True).stdout.strip(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'scenarios': {},
+    }
+    try:
+        for scenario in scenarios:
+            print('{}...'.format(scenario), flush=True)
+            install.reset_state()
+            server.stats.reset()
+            if scenario == 'startup':
+                results['scenarios'][scenario] = bench_startup(install, args)
+            elif scenario == 'latency':
+                results['scenarios'][scenario] = bench_latency(install, args)
+            elif scenario == 'context':
+                results['scenarios'][scenario] = bench_context(install, args)
+            elif scenario == 'rate_limit':
+                results['scenarios'][scenario] = bench_rate_limit(install, args, server)
+            else:
+                print('  unknown scenario, expected one of ' + ', '.join(SCENARIOS))
+                continue
+            print(json.dumps(results['scenarios'][scenario], indent=2))
+    finally:
+        install.remove()
+        server.shutdown()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to {}'.format(args.output))
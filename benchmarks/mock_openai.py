@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the OpenAI Completions API used by the benchmarks.
+#
+# Serves /v1/engines/<engine>/completions and /v1/completions, including the
+# content-filter-alpha engine, with configurable latency, jitter, streaming and
+# injected rate limit (429) and server (500) errors. Point the openai package at
+# it with OPENAI_API_BASE=http://127.0.0.1:<port>/v1.
+#
+# Usage: python benchmarks/mock_openai.py [--port 8000] [--latency-ms 300] [--jitter-ms 100]
+#        [--rate-limit-rate 0.1] [--error-rate 0.05]
+
+import json
+import time
+import random
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILTER_ENGINE = 'content-filter-alpha'
+
+class MockConfig:
+    """
+    Behavior of the mock server, can be changed while it runs
+    """
+
+    def __init__(self, latency_ms=300, jitter_ms=100, chunk_ms=20, rate_limit_rate=0.0, retry_after=0.5,
+                 error_rate=0.0, filter_latency_ms=50, completion='\nls -la', sensitive_words=('bomb',)):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        # delay between streamed chunks
+        self.chunk_ms = chunk_ms
+        self.rate_limit_rate = rate_limit_rate
+        # seconds sent in the Retry-After header of rate limited responses
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.filter_latency_ms = filter_latency_ms
+        self.completion = completion
+        self.sensitive_words = sensitive_words
+
+class MockStats:
+    """
+    Request counters, reset between benchmark scenarios
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {'connections': 0, 'completions': 0, 'filter': 0, 'rate_limited': 0, 'errors': 0, 'streamed': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+def split_tokens(text):
+    """
+    Rough tokens for streaming and usage: words with their leading whitespace
+    """
+    tokens = []
+    for i, character in enumerate(text):
+        if i == 0 or (character.isspace() and not text[i - 1].isspace()):
+            tokens.append(character)
+        else:
+            tokens[-1] += character
+    return tokens
+
+def complete_text(prompt, body, config):
+    """
+    The completion of a prompt, cut by the stop sequences and max_tokens of the request.
+    A prompt ending with at least two characters of the beginning of the completion, a continued request,
+    gets the rest of it
+
+    Returns: the text and its finish reason
+    """
+    text = config.completion
+    for i in range(len(text), 1, -1):
+        if prompt.endswith(text[:i]):
+            text = text[i:]
+            break
+
+    stop = body.get('stop') or []
+    for sequence in [stop] if isinstance(stop, str) else stop:
+        if sequence in text:
+            text = text[:text.index(sequence)]
+    tokens = split_tokens(text)
+    max_tokens = int(body.get('max_tokens') or 16)
+    if len(tokens) > max_tokens:
+        return ''.join(tokens[:max_tokens]), 'length'
+    return text, 'stop'
+
+def make_choices(body, config, is_filter):
+    prompts = body.get('prompt', '')
+    prompts = prompts if isinstance(prompts, list) else [prompts]
+    n = int(body.get('n') or 1)
+
+    choices = []
+    for prompt_index, prompt in enumerate(prompts):
+        for j in range(n):
+            if is_filter:
+                label = '2' if any(word in prompt for word in config.sensitive_words) else '0'
+                logprobs = {'tokens': [label], 'token_logprobs': [-0.01], 'top_logprobs': [{label: -0.01}]}
+                choices.append({'text': label, 'index': prompt_index * n + j, 'logprobs': logprobs, 'finish_reason': 'length'})
+                continue
+            text, finish_reason = complete_text(prompt, body, config)
+            logprobs = None
+            if body.get('logprobs') is not None:
+                tokens = split_tokens(text)
+                logprobs = {'tokens': tokens, 'token_logprobs': [-0.1 * (j + 1)] * len(tokens), 'top_logprobs': None}
+            choices.append({'text': text, 'index': prompt_index * n + j, 'logprobs': logprobs, 'finish_reason': finish_reason})
+    return prompts, choices
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # once per connection, keep-alive requests reuse it
+        self.server.stats.count('connections')
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, e.g. a cancelled stream
+            pass
+
+    def send_json(self, status, payload, headers=()):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/_stats':
+            self.send_json(200, self.server.stats.snapshot())
+        else:
+            self.send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        parts = self.path.split('?')[0].strip('/').split('/')
+
+        if parts[-1] != 'completions':
+            self.send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+            return
+
+        engine = parts[-2] if len(parts) >= 3 and parts[-3] == 'engines' else body.get('model', '')
+        config = self.server.config
+        stats = self.server.stats
+        is_filter = engine == FILTER_ENGINE
+
+        if not is_filter and random.random() < config.rate_limit_rate:
+            stats.count('rate_limited')
+            self.send_json(429, {'error': {'message': 'Rate limit reached for requests', 'type': 'requests'}},
+                           [('Retry-After', str(config.retry_after))])
+            return
+        if not is_filter and random.random() < config.error_rate:
+            stats.count('errors')
+            self.send_json(500, {'error': {'message': 'The server had an error', 'type': 'server_error'}})
+            return
+
+        stats.count('filter' if is_filter else 'completions')
+        latency = config.filter_latency_ms if is_filter else config.latency_ms + random.uniform(-1, 1) * config.jitter_ms
+        time.sleep(max(latency, 0) / 1000)
+
+        prompts, choices = make_choices(body, config, is_filter)
+        response = {
+            'id': 'cmpl-mock',
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': engine,
+        }
+
+        if body.get('stream'):
+            stats.count('streamed')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for choice in choices:
+                tokens = split_tokens(choice['text']) or ['']
+                for i, token in enumerate(tokens):
+                    if i > 0:
+                        time.sleep(config.chunk_ms / 1000)
+                    # the last event of a choice carries its finish reason
+                    finish_reason = choice['finish_reason'] if i == len(tokens) - 1 else None
+                    event = dict(response, choices=[{'text': token, 'index': choice['index'], 'logprobs': None, 'finish_reason': finish_reason}])
+                    self.send_chunk('data: {}\n\n'.format(json.dumps(event)).encode('utf-8'))
+            self.send_chunk(b'data: [DONE]\n\n')
+            self.send_chunk(b'')
+            return
+
+        prompt_tokens = sum(len(split_tokens(prompt)) for prompt in prompts)
+        completion_tokens = sum(len(split_tokens(choice['text'])) for choice in choices)
+        response['choices'] = choices
+        response['usage'] = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+        self.send_json(200, response)
+
+def start_server(config=None, port=0):
+    """
+    Start the mock server in a daemon thread, port 0 picks a free port
+
+    Returns: the server, its URL is 'http://127.0.0.1:{}/v1'.format(server.server_port)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    server.config = config or MockConfig()
+    server.stats = MockStats()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI Completions API')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--jitter-ms', type=float, default=100)
+    parser.add_argument('--chunk-ms', type=float, default=20)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of completion requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of completion requests answered with 500')
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency_ms, args.jitter_ms, args.chunk_ms, args.rate_limit_rate, args.retry_after, args.error_rate)
+    server = start_server(config, args.port)
+    print('Mock OpenAI API on http://127.0.0.1:{}/v1, set OPENAI_API_BASE to use it'.format(server.server_port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -8,6 +8,8 @@ uninstall()
     local OPENAI_RC_FILE="$CODEX_CLI_PATH/src/openaiapirc"
     # Path to Bash settings loaded when a Bash session starts
     local BASH_RC_FILE="$HOME/.codexclirc"
+    # Stop the completion server if it is running
+    python3 "$CODEX_CLI_PATH/src/codex_client.py" --stop &> /dev/null
     # Remove the plugin loaded by .bashrc
     rm -f $BASH_RC_FILE
     # Remove credentials and other personal settings
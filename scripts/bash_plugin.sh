@@ -19,9 +19,90 @@ create_completion()
     fi
     # Get the text typed until now
     text=${READLINE_LINE}
-    completion=$(echo -n "$text" | $CODEX_CLI_PATH/src/codex_query.py)
+    local completion="" chunk fd pid key line status frame=0 frames='|/-\' started=$SECONDS
+    # Stream the completion, previewing its last line below the prompt with a spinner as it arrives
+    # Note: readline only redraws READLINE_LINE once this function returns, so unlike zsh the line
+    # cannot be edited while the query runs. Any key press cancels it: Escape just cancels, a typed
+    # character is added to the line
+    # The client prints its pid first, so that a cancelled query can be stopped
+    # Each terminal keeps its own context, unless CODEX_CLI_SESSION names a shared one
+    exec {fd}< <(echo $BASHPID; CODEX_CLI_SESSION=${CODEX_CLI_SESSION-$$} exec $CODEX_CLI_PATH/src/codex_client.py --shell bash --stream < <(printf '%s' "$text"))
+    read -r -u $fd pid
+    printf '\n' > /dev/tty
+    while true; do
+        if IFS= read -r -N 1 -t 0.05 -u $fd chunk; then
+            # The query script sends \x18 to retract the text streamed so far
+            if [ "$chunk" == $'\x18' ]; then
+                completion=""
+            else
+                completion+=$chunk
+            fi
+        else
+            status=$?
+            # read -t fails with more than 128 on timeout, anything else is the end of the stream
+            (( status > 128 )) || break
+            if IFS= read -r -s -N 1 -t 0.05 key < /dev/tty; then
+                kill $pid 2>/dev/null
+                exec {fd}<&-
+                printf '\r\e[K\e[A' > /dev/tty
+                if [[ $key == [[:print:]] ]]; then
+                    READLINE_LINE="${READLINE_LINE:0:$READLINE_POINT}${key}${READLINE_LINE:$READLINE_POINT}"
+                    READLINE_POINT=$((READLINE_POINT + 1))
+                else
+                    # Drop the rest of an escape sequence, e.g. an arrow key
+                    while IFS= read -r -s -N 1 -t 0.01 key < /dev/tty; do :; done
+                fi
+                return
+            fi
+        fi
+        frame=$(( (frame + 1) % 4 ))
+        line=${completion##*$'\n'}
+        line="${frames:$frame:1} Codex $((SECONDS - started))s ${line}"
+        printf '\r\e[K%s' "${line:0:$((${COLUMNS:-80} - 1))}" > /dev/tty
+    done
+    exec {fd}<&-
+    # Clear the preview line and go back to the prompt
+    printf '\r\e[K\e[A' > /dev/tty
+    # Drop trailing newlines, like $(...) does
+    while [[ $completion == *$'\n' ]]; do
+        completion=${completion%$'\n'}
+    done
     # Add completion to the current buffer
     READLINE_LINE="${text}${completion}"
     # Put the cursor at the end of the line
     READLINE_POINT=${#READLINE_LINE}
 }
+
+# Opt-in speculative prefetch (export CODEX_CLI_PREFETCH=on before this plugin is loaded)
+# Readline has no hook for every key press, so the space key schedules the prefetch: after a pause
+# of CODEX_CLI_PREFETCH_DELAY ms (600 by default) in typing a "#" line, the buffer is sent to the
+# completion server, so the hotkey finds its completion ready
+_codex_cli_prefetch_pid=""
+
+_codex_cli_prefetch()
+{
+    # Only single line queries, not a buffer with its completion
+    [[ $READLINE_LINE == \#* && $READLINE_LINE != *$'\n'* ]] || return
+    # Only the latest scheduled prefetch runs once its pause is over
+    [[ -n $_codex_cli_prefetch_pid ]] && kill $_codex_cli_prefetch_pid 2>/dev/null
+    local text=$READLINE_LINE session=${CODEX_CLI_SESSION-$$}
+    # Started from a command substitution, so that the interactive shell prints no job notices
+    _codex_cli_prefetch_pid=$(
+        {
+            sleep "$(awk "BEGIN { print ${CODEX_CLI_PREFETCH_DELAY:-600} / 1000 }")"
+            echo -n "$text" | CODEX_CLI_SESSION=$session $CODEX_CLI_PATH/src/codex_client.py --shell bash --prefetch
+        } >/dev/null 2>&1 &
+        echo $!
+    )
+}
+
+_codex_cli_space()
+{
+    READLINE_LINE="${READLINE_LINE:0:$READLINE_POINT} ${READLINE_LINE:$READLINE_POINT}"
+    READLINE_POINT=$((READLINE_POINT + 1))
+    _codex_cli_prefetch
+}
+
+if [[ $CODEX_CLI_PREFETCH == on ]]; then
+    bind -x '" ":_codex_cli_space'
+fi
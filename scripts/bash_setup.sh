@@ -91,6 +91,7 @@ configureApp()
     echo "secret_key=$SECRET_KEY" >> $OPENAI_RC_FILE
     echo "engine=$ENGINE_ID" >> $OPENAI_RC_FILE
     chmod +x "$CODEX_CLI_PATH/src/codex_query.py"
+    chmod +x "$CODEX_CLI_PATH/src/codex_client.py"
 }
 
 # Create and load ~/.codexclirc to setup bash 'Ctrl + G' binding
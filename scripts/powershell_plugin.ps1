@@ -12,7 +12,7 @@ function create_completion() {
         return "`nnotepad $profile"
     }
 
-    $output = echo -n $buffer | python $nl_cli_script 
+    $output = echo -n $buffer | python $nl_cli_script --shell powershell
     
     return $output
 }
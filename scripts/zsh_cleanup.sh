@@ -12,7 +12,11 @@ zshrcPath="$HOME/.zshrc"
 sed -i '' '/### Codex CLI setup - start/,/### Codex CLI setup - end/d' $zshrcPath
 echo "Removed settings in $zshrcPath if present"
 
-# 2. Remove opanaiapirc in /.config
+# 2. Stop the completion server if it is running
+python3 "$CODEX_CLI_PATH/src/codex_client.py" --stop &> /dev/null || true
+echo "Stopped the Codex CLI completion server if present"
+
+# 3. Remove opanaiapirc in /.config
 rm -f $openAIConfigPath
 echo "Removed $openAIConfigPath"
 
@@ -69,6 +69,9 @@ configureApp()
     # Change file mode of codex_query.py to allow execution
     chmod +x "$CODEX_CLI_PATH/src/codex_query.py"
     echo "Allow execution of $CODEX_CLI_PATH/src/codex_query.py"
+
+    chmod +x "$CODEX_CLI_PATH/src/codex_client.py"
+    echo "Allow execution of $CODEX_CLI_PATH/src/codex_client.py"
 }
 
 # Start installation
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local keep-alive proxy for the OpenAI API. One-shot processes (CODEX_CLI_DAEMON=off, PowerShell,
+# batch mode) send their requests over plain HTTP to a Unix socket in the private directory of the
+# user (see daemon.get_socket_path), and the proxy forwards them over its warm pooled connections,
+# so they skip the DNS lookup and the TCP and TLS handshakes.
+# It adds no credentials, the Authorization header of each request is forwarded as is, so both ends
+# check that the other runs as the same user: another local user can neither send requests with the
+# API key of the proxy user nor receive the API key by answering in place of the proxy.
+#
+# Enabled with proxy=on in the [client] section of openaiapirc: the first query starts the proxy in
+# the background and goes to the API directly, the next ones use the proxy. It exits when idle.
+#
+# Usage: api_proxy.py --upstream <scheme://host[:port]>
+
+import os
+import sys
+import socket
+
+IDLE_TIMEOUT = 30 * 60
+
+# seconds a query waits for the proxy to accept the connection before going to the API directly
+CONNECT_TIMEOUT = 0.05
+
+# the api_base origin of the requests sent through the proxy, see http_session.UnixAdapter
+PROXY_ORIGIN = 'http://codex-cli-proxy'
+
+# seconds the proxy waits for the API, the requests of the clients carry their own deadline
+UPSTREAM_TIMEOUT = 600
+
+API_PROXY_PATH = os.path.realpath(__file__)
+
+# per connection headers are not forwarded, the body is re-chunked and already decoded by requests
+HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+               'transfer-encoding', 'upgrade', 'host', 'content-length', 'content-encoding'}
+
+def get_socket_path(upstream):
+    """
+    Returns: the socket of the proxy to upstream, None if the private directory of the user is not available
+    """
+    import hashlib
+    import daemon
+
+    return daemon.get_socket_path('proxy-{}.sock'.format(hashlib.sha256(upstream.encode('utf-8')).hexdigest()[:16]))
+
+def is_running(socket_path):
+    """
+    Returns: True if a proxy of the current user accepts connections on the socket
+    """
+    import daemon
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(CONNECT_TIMEOUT)
+            s.connect(socket_path)
+            return daemon.is_same_user(s)
+    except OSError:
+        return False
+
+def spawn(upstream):
+    """
+    Start the proxy in the background, detached from the calling shell
+    """
+    import subprocess
+
+    subprocess.Popen(
+        [sys.executable, API_PROXY_PATH, '--upstream', upstream],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        start_new_session=True)
+
+def get_proxy_base(api_base):
+    """
+    Returns: the (proxy api_base, upstream origin) of an openai api_base
+    """
+    from urllib.parse import urlsplit
+
+    url = urlsplit(api_base)
+    return PROXY_ORIGIN + url.path, '{}://{}'.format(url.scheme, url.netloc)
+
+def _create_server(socket_path, upstream):
+    import socketserver
+    import daemon
+    from http.server import BaseHTTPRequestHandler
+    from http_session import get_session
+
+    session = get_session()
+
+    class ProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def forward(self):
+            self.server.idle = False
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length > 0 else None
+            headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_HEADERS}
+
+            try:
+                response = session.request(self.command, upstream + self.path, headers=headers, data=body,
+                                           stream=True, timeout=UPSTREAM_TIMEOUT)
+            except Exception as e:
+                message = ('{"error": {"message": "Codex CLI proxy: %s", "type": "proxy_error"}}' % type(e).__name__).encode('utf-8')
+                self.send_response(502)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(message)))
+                self.end_headers()
+                self.wfile.write(message)
+                return
+
+            with response:
+                self.send_response(response.status_code)
+                for name, value in response.headers.items():
+                    if name.lower() not in HOP_HEADERS:
+                        self.send_header(name, value)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                # streamed completions are forwarded as the events arrive
+                for chunk in response.iter_content(chunk_size=None):
+                    if chunk:
+                        self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+                        self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+                self.wfile.flush()
+
+        do_GET = forward
+        do_POST = forward
+        do_DELETE = forward
+
+    class ProxyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        timeout = IDLE_TIMEOUT
+        idle = False
+
+        def handle_timeout(self):
+            self.idle = True
+
+        def verify_request(self, request, client_address):
+            return daemon.is_same_user(request)
+
+    return ProxyServer(socket_path, ProxyHandler)
+
+def serve(upstream):
+    """
+    Forward the requests on the proxy socket of the user to upstream until idle
+    """
+    import daemon
+    import http_session
+
+    socket_path = get_socket_path(upstream)
+    if socket_path is None or not daemon.remove_stale_socket(socket_path):
+        return
+
+    # only the current user may connect to the socket
+    old_umask = os.umask(0o077)
+    try:
+        server = _create_server(socket_path, upstream)
+    except OSError:
+        # another proxy won the race for the socket
+        return
+    finally:
+        os.umask(old_umask)
+
+    try:
+        while not server.idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        http_session.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+if __name__ == '__main__':
+    upstream = sys.argv[sys.argv.index('--upstream') + 1].rstrip('/')
+    serve(upstream)
@@ -0,0 +1,237 @@
+import time
+import threading
+
+# Completion backends. "openai" is the API of the [openai] section of openaiapirc, other OpenAI
+# compatible servers (e.g. a model hosted on-prem) are added as [backend <name>] sections:
+#
+# [backend onprem]
+# api_base=http://10.0.0.5:8000/v1
+# engine=starcoder
+# api_key=<key of the server>
+# timeout=30
+# max_concurrent=2
+# content_filter=local
+# rate_limit=off
+#
+# engine replaces the engine of the context, timeout bounds each request (seconds), max_concurrent
+# limits the requests in flight from one process, content_filter is api (the OpenAI content filter),
+# local (only the allow/deny rules and cached verdicts) or off, and rate_limit shares the token bucket
+# of the [client] section. content_filter defaults to api only for an api_base on the OpenAI API host,
+# a backend elsewhere does not get its content sent to OpenAI unless it asks for it. The OpenAI secret
+# key is never sent to another backend.
+#
+# "# set backend <name>" picks the backend of a context, caching, contexts and filtering work the same
+# whichever backend answers. The built-in "standin" backend answers in-process, for tests and demos.
+
+DEFAULT_BACKEND = 'openai'
+STANDIN_BACKEND = 'standin'
+
+CONTENT_FILTER_MODES = ['api', 'local', 'off']
+
+OPENAI_API_HOST = 'api.openai.com'
+
+def is_openai(api_base):
+    """
+    Returns: True if api_base is the OpenAI API (None is the api_base of the [openai] section)
+    """
+    if api_base is None:
+        return True
+    from urllib.parse import urlparse
+    return (urlparse(api_base).hostname or '').lower() == OPENAI_API_HOST
+
+class Backend:
+    """
+    An OpenAI compatible Completions endpoint
+    """
+
+    def __init__(self, name, api_base=None, api_key=None, organization=None, engine=None, timeout=None,
+                 max_concurrent=0, content_filter='api', rate_limit=True):
+        self.name = name
+        self.api_base = api_base
+        self.api_key = api_key
+        self.organization = organization
+        self.engine = engine
+        self.timeout = timeout
+        self.content_filter = content_filter if content_filter in CONTENT_FILTER_MODES else 'api'
+        self.rate_limit = rate_limit
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent > 0 else None
+
+    @staticmethod
+    def from_section(name, section):
+        """
+        Returns: the backend of a [backend <name>] section of openaiapirc
+        """
+        return Backend(
+            name,
+            api_base=section.get('api_base'),
+            # openai requires a key, the OpenAI one is not sent to other servers
+            api_key=section.get('api_key', 'none'),
+            organization=section.get('organization', ''),
+            engine=section.get('engine'),
+            timeout=float(section['timeout']) if 'timeout' in section else None,
+            max_concurrent=int(section.get('max_concurrent', 0)),
+            content_filter=section.get('content_filter', 'api' if is_openai(section.get('api_base')) else 'local'),
+            rate_limit=section.get('rate_limit', 'on') == 'on')
+
+    def qualify(self, engine):
+        """
+        Returns: the engine name of the cache, prefetch and metrics keys, other backends may serve the same name
+        """
+        return engine if self.name == DEFAULT_BACKEND else '{}/{}'.format(self.name, engine)
+
+    def create(self, timeout=None, **kwargs):
+        """
+        openai.Completion.create on this backend, waiting for a free slot if max_concurrent are in flight
+        timeout bounds the request in seconds, the backend timeout applies too
+
+        Returns: the response, or a generator of events for streamed requests
+        """
+        import openai
+
+        if self.timeout is not None:
+            timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        if timeout is not None:
+            kwargs['request_timeout'] = timeout
+
+        if self.slots is not None and not self.slots.acquire(timeout=timeout):
+            raise openai.error.Timeout('No free {} backend slot before the deadline'.format(self.name))
+        try:
+            response = self._create(**kwargs)
+        except Exception:
+            self._release()
+            raise
+        if kwargs.get('stream'):
+            # the slot is held until the stream is read or dropped
+            return self._release_after(response)
+        self._release()
+        return response
+
+    def _create(self, **kwargs):
+        import openai
+
+        if self.api_base is not None:
+            kwargs.update(api_base=self.api_base, api_key=self.api_key, organization=self.organization)
+        return openai.Completion.create(**kwargs)
+
+    def _release(self):
+        if self.slots is not None:
+            self.slots.release()
+
+    def _release_after(self, events):
+        try:
+            yield from events
+        finally:
+            self._release()
+
+def split_tokens(text):
+    """
+    Rough tokens of the stand-in backend: words with their leading whitespace
+    """
+    tokens = []
+    for i, character in enumerate(text):
+        if i == 0 or (character.isspace() and not text[i - 1].isspace()):
+            tokens.append(character)
+        else:
+            tokens[-1] += character
+    return tokens
+
+class StandInBackend(Backend):
+    """
+    Answers in-process like an OpenAI compatible server would: the last comment of the prompt
+    becomes an echo command (or the configured completion), cut by the stop sequences and max_tokens
+    """
+
+    def __init__(self, name=STANDIN_BACKEND, completion=None, latency=0.0, content_filter='local', **options):
+        super().__init__(name, content_filter=content_filter, rate_limit=False, **options)
+        self.completion = completion
+        self.latency = latency
+
+    @staticmethod
+    def from_section(name, section):
+        return StandInBackend(
+            name,
+            completion=section['completion'].replace('\\n', '\n') if 'completion' in section else None,
+            latency=float(section.get('latency', 0)),
+            engine=section.get('engine'),
+            max_concurrent=int(section.get('max_concurrent', 0)),
+            content_filter=section.get('content_filter', 'local'))
+
+    def complete(self, prompt, max_tokens, stop):
+        """
+        Returns: the completion of a prompt and its finish reason
+        """
+        text = self.completion
+        if text is None:
+            lines = prompt.rstrip().splitlines()
+            query = lines[-1].lstrip('#').strip() if len(lines) > 0 else ''
+            text = "\necho '{}'".format(query.replace("'", ''))
+        for sequence in [stop] if isinstance(stop, str) else stop or []:
+            if sequence in text:
+                text = text[:text.index(sequence)]
+        tokens = split_tokens(text)
+        if len(tokens) > max_tokens:
+            return ''.join(tokens[:max_tokens]), 'length'
+        return text, 'stop'
+
+    def _create(self, engine=None, prompt='', max_tokens=16, stop=None, n=1, stream=False, logprobs=None, **kwargs):
+        time.sleep(self.latency)
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        response = {'id': 'cmpl-standin', 'object': 'text_completion', 'created': int(time.time()), 'model': engine}
+
+        choices = []
+        for i, text in enumerate(prompts):
+            completion, finish_reason = self.complete(text, int(max_tokens), stop)
+            tokens = split_tokens(completion)
+            for j in range(int(n or 1)):
+                choices.append({
+                    'text': completion,
+                    'index': i * int(n or 1) + j,
+                    'logprobs': {'tokens': tokens, 'token_logprobs': [-0.1] * len(tokens), 'top_logprobs': None} if logprobs is not None else None,
+                    'finish_reason': finish_reason})
+
+        if stream:
+            return self._events(response, choices)
+        prompt_tokens = sum(len(split_tokens(text)) for text in prompts)
+        completion_tokens = sum(len(split_tokens(choice['text'])) for choice in choices)
+        return dict(response, choices=choices, usage={'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                                                      'total_tokens': prompt_tokens + completion_tokens})
+
+    def _events(self, response, choices):
+        for choice in choices:
+            tokens = split_tokens(choice['text']) or ['']
+            for i, token in enumerate(tokens):
+                # the last event of a choice carries its finish reason
+                finish_reason = choice['finish_reason'] if i == len(tokens) - 1 else None
+                yield dict(response, choices=[{'text': token, 'index': choice['index'], 'logprobs': None, 'finish_reason': finish_reason}])
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def configure(sections):
+    """
+    Define the backends of openaiapirc, sections maps a backend name to its settings
+    A section with standin=on defines another stand-in backend, e.g. with a fixed completion
+    """
+    with _backends_lock:
+        _backends.clear()
+        _backends[DEFAULT_BACKEND] = Backend(DEFAULT_BACKEND)
+        _backends[STANDIN_BACKEND] = StandInBackend()
+        for name, section in sections.items():
+            if section.get('standin', 'off') == 'on':
+                _backends[name] = StandInBackend.from_section(name, section)
+            else:
+                _backends[name] = Backend.from_section(name, section)
+
+def get_backend(name=DEFAULT_BACKEND):
+    """
+    Returns: the backend of that name, None if it is not defined
+    """
+    with _backends_lock:
+        if len(_backends) == 0:
+            _backends[DEFAULT_BACKEND] = Backend(DEFAULT_BACKEND)
+            _backends[STANDIN_BACKEND] = StandInBackend()
+        return _backends.get(name)
+
+def get_names():
+    with _backends_lock:
+        return sorted(_backends) if len(_backends) > 0 else [DEFAULT_BACKEND, STANDIN_BACKEND]
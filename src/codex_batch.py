@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Batch mode: answer a file or stream of natural language queries in one pass.
+#
+# Input is one query per line, or JSONL objects with a "query" and an optional "id".
+# Queries are packed into multi-prompt Completion requests of --batch-size prompts,
+# up to --concurrency requests are in flight, and the results are written to stdout
+# as JSONL in input order as soon as they are known. A line that cannot be parsed
+# gets an error entry, the other queries are answered.
+#
+# Usage: codex_batch.py [file] [--shell bash] [--batch-size 20] [--concurrency 4]
+
+import sys
+import json
+import argparse
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import codex_query
+
+BATCH_SIZE = 20
+CONCURRENCY = 4
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Answer natural language queries in bulk')
+    parser.add_argument('file', nargs='?', help='input file, one query per line or JSONL (default: stdin)')
+    parser.add_argument('--shell', default='bash', help='shell to generate commands for')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='prompts per Completion request')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='maximum requests in flight')
+    return parser.parse_args()
+
+def read_queries(lines):
+    """
+    Parse the input lines, plain queries get a "# " prefix like in the shell
+
+    Yields: (id, query, error) tuples, the id defaults to the line number,
+    error describes a JSONL line without a query string and is None otherwise
+    """
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if line == '':
+            continue
+        id = number
+        if line.startswith('{'):
+            try:
+                item = json.loads(line)
+                id = item.get('id', number)
+                line = item['query'].strip()
+            except (ValueError, KeyError, AttributeError, TypeError):
+                yield id, line, 'Invalid input line {}, expected a JSON object with a "query" string'.format(number + 1)
+                continue
+        if not line.startswith('#'):
+            line = '# ' + line
+        yield id, line + '\n', None
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def complete_batch(batch, context, config, backend=None):
+    """
+    Answer a batch of (id, query, cached completion, input error) with a single multi-prompt
+    request to the backend, and screen the new answers with a single content filter request
+    Runs in a worker thread, cached answers are resolved by the caller
+
+    Returns: a result dictionary per query, in batch order
+    """
+    from content_filter import screen_contents
+
+    pending = [i for i, (_, _, completion, error) in enumerate(batch) if completion is None and error is None]
+
+    try:
+        if len(pending) > 0:
+            codex_query.load_openai()
+            from openai_client import create_completion
+            response = create_completion(
+                engine=config['engine'],
+                prompt=[context + batch[i][1] for i in pending],
+                temperature=config['temperature'],
+                max_tokens=config['max_tokens'],
+                stop=codex_query.STOP,
+                backend=backend,
+                traffic='batch')
+            # choices are matched to prompts by index, the order is not guaranteed
+            for choice in response['choices']:
+                i = pending[choice['index']]
+                batch[i] = batch[i][:2] + (choice['text'], None)
+
+        # the queries and the completions are screened apart, all of them at once
+        mode = backend.content_filter if backend else 'api'
+        verdicts = screen_contents([batch[i][1] for i in pending] + [batch[i][2] for i in pending], mode)
+    except Exception as e:
+        error = codex_query.error_message(e)
+        return [{'id': id, 'query': query.strip(), 'error': input_error or error} for id, query, _, input_error in batch]
+
+    sensitive = {i for position, i in enumerate(pending) if verdicts[position] or verdicts[len(pending) + position]}
+    results = []
+    for i, (id, query, completion, error) in enumerate(batch):
+        if error is not None:
+            results.append({'id': id, 'query': query.strip(), 'error': error})
+        elif i in sensitive:
+            results.append({'id': id, 'query': query.strip(), 'redacted': True})
+        else:
+            results.append({'id': id, 'query': query.strip(), 'completion': completion, 'cached': i not in pending})
+    return results
+
+def run_batch(lines, shell, batch_size, concurrency, output=sys.stdout):
+    from completion_cache import CompletionCache
+
+    codex_query.set_shell(shell)
+    prompt_file = codex_query.initialize()
+    backend, config = codex_query.get_backend(prompt_file.config)
+    if backend is None:
+        sys.exit('Unknown backend {}, see # set backend'.format(config.get('backend')))
+    engine = backend.qualify(config['engine'])
+
+    # the context is built once and shared by every query of the run
+    context = codex_query.get_prefix(config) + prompt_file.read_prompt_file('', ranked=False)
+
+    cache = CompletionCache() if CompletionCache.is_cacheable(config) else None
+
+    def make_key(query):
+        return cache.make_key(engine, config['temperature'], config['max_tokens'], codex_query.STOP, context + query)
+
+    def write(results):
+        for result in results:
+            if cache is not None and 'completion' in result and not result['cached']:
+                cache.put(make_key(result['query'] + '\n'), result['completion'], cache.make_query_key(engine, result['query']))
+            output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for chunk in chunks(read_queries(lines), batch_size):
+            batch = [(id, query, cache.get(make_key(query)) if cache is not None and error is None else None, error) for id, query, error in chunk]
+            in_flight.append(executor.submit(complete_batch, batch, context, config, backend))
+
+            # results go out in input order, the oldest batch is awaited first
+            while len(in_flight) >= concurrency:
+                write(in_flight.popleft().result())
+
+        while len(in_flight) > 0:
+            write(in_flight.popleft().result())
+
+    prompt_file.flush()
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.file:
+        with open(args.file, 'r') as f:
+            run_batch(f, args.shell, args.batch_size, args.concurrency)
+    else:
+        run_batch(sys.stdin, args.shell, args.batch_size, args.concurrency)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Thin client used by the shell plugins. It forwards the buffer to the long-lived
+# completion server (codex_query.py --server) and falls back to the one-shot path
+# when no server is running, starting one in the background for the next request.
+#
+# Usage: codex_client.py [--shell <bash|zsh|powershell>] [--stream] [--prefetch] [--stop]
+# Arguments are parsed by hand, argparse alone would double the client startup time.
+
+import os
+import sys
+import signal
+
+import daemon
+import metrics
+
+def get_option(name):
+    """
+    Returns: the value following name on the command line, or None
+    """
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
+
+if __name__ == '__main__':
+    # exit quietly when the plugin stops reading, e.g. a cancelled query
+    if hasattr(signal, 'SIGPIPE'):
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    shell = get_option('--shell')
+    stream = '--stream' in sys.argv
+
+    if '--stop' in sys.argv:
+        if daemon.is_supported():
+            daemon.send_request({'command': 'stop'}, sys.stdout)
+        sys.exit(0)
+
+    entry = sys.stdin.read()
+
+    # speculative prefetch while the user is typing, only the completion server keeps the result
+    if '--prefetch' in sys.argv:
+        if daemon.is_enabled():
+            request = {'entry': entry, 'shell': shell, 'prefetch': True, 'session': os.environ.get('CODEX_CLI_SESSION') or None}
+            if not daemon.send_request(request, sys.stdout):
+                daemon.spawn_server()
+        sys.exit(0)
+
+    if daemon.is_enabled():
+        # the server answers every terminal, each request names the context session of its terminal
+        request = {'entry': entry, 'shell': shell, 'stream': stream, 'started': metrics.process_start_time(),
+                   'session': os.environ.get('CODEX_CLI_SESSION') or None}
+        if daemon.send_request(request, sys.stdout):
+            sys.exit(0)
+        daemon.spawn_server()
+
+    import codex_query
+    codex_query.run_once(entry, shell, stream)
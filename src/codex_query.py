@@ -1,30 +1,68 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import openai
 import sys
 import os
-import configparser
-import re
-import psutil
+import time
 
-from pathlib import Path
-from prompt_file import PromptFile
+import metrics
+from prompt_file import PromptFile, get_session
 from commands import get_command_result
+from tokenizer import CONTEXT_LIMITS
+
+# openai, psutil, the caches and the content filter are imported on first use,
+# so commands like "# set temperature" never pay for loading them
 
 MULTI_TURN = "off"
 SHELL = ""
 
 ENGINE = ''
+API_KEY = ''
+ORGANIZATION = ''
 TEMPERATURE = 0
 MAX_TOKENS = 300
+# number of ranked examples in the prompt, 0 uses the whole context
+EXAMPLES = 0
+# engine name answering from the shell history and saved contexts, without the API
+LOCAL_ENGINE = 'local'
+# milliseconds a query may take before the best fallback is shown, 0 waits for the model
+DEADLINE = 10000
+# racing: comma separated engines queried together (the engine alone if empty),
+# candidates per engine and the mode picking the answer, see engine_race.MODES
+ENGINES = ''
+MODE = 'single'
+CANDIDATES = 1
+STOP = "#"
+# on: max_tokens and the stop sequences are fitted to the past completions, see completion_stats.py
+ADAPTIVE = 'on'
+# the server answering the queries, "openai" or a [backend <name>] section of openaiapirc, see backends.py
+BACKEND = 'openai'
+
+# stream mode writes tokens as they arrive, RETRACT tells the plugin to drop the text written so far
+# the stream mode and the shell are passed with each query, the completion server answers several terminals at once
+RETRACT = '\x18'
 
 DEBUG_MODE = False
 
 # api keys located in the same directory as this file
 API_KEYS_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'openaiapirc')
 
-PROMPT_CONTEXT = Path(__file__).with_name('current_context.txt')
+# [client] section of openaiapirc, see openai_client.configure
+CLIENT_CONFIG = {}
+
+# set in the long-lived completion server
+SERVER_MODE = False
+
+# [prefetch] section of openaiapirc, see prefetch.configure
+PREFETCH_CONFIG = {}
+
+# [filter] section of openaiapirc, see content_filter.configure
+FILTER_CONFIG = {}
+
+# [backend <name>] sections of openaiapirc by name, see backends.configure
+BACKEND_CONFIG = {}
+
+PROMPT_CONTEXT = os.path.join(os.path.dirname(__file__), 'current_context.txt')
 
 
 # Read the secret_key from the ini file ~/.config/openaiapirc
@@ -46,182 +84,624 @@ def create_template_ini_file():
         print('# engine=<engine-id>')
         sys.exit(1)
 
-def initialize():
+def initialize(session=None, shell=None):
     """
-    Initialize openAI and shell mode
+    Read the openAI settings and initialize the shell mode, session selects the context of a terminal
+    and shell its shell, the one of set_shell by default
     """
     global ENGINE
+    global API_KEY
+    global ORGANIZATION
+    import configparser
 
     # Check if file at API_KEYS_LOCATION exists
     create_template_ini_file()
     config = configparser.ConfigParser()
     config.read(API_KEYS_LOCATION)
 
-    openai.api_key = config['openai']['secret_key'].strip('"').strip("'")
-    openai.organization = config['openai']['organization_id'].strip('"').strip("'")
+    API_KEY = config['openai']['secret_key'].strip('"').strip("'")
+    ORGANIZATION = config['openai']['organization_id'].strip('"').strip("'")
     ENGINE = config['openai']['engine'].strip('"').strip("'")
 
+    # optional per engine context window overrides, for example code-davinci-002=8001
+    if config.has_section('context_limits'):
+        for engine, limit in config['context_limits'].items():
+            CONTEXT_LIMITS[engine] = int(limit)
+
+    # optional rate limiter, retry and hedging settings, read once openai is loaded
+    if config.has_section('client'):
+        CLIENT_CONFIG.update(config['client'])
+    if config.has_section('prefetch'):
+        PREFETCH_CONFIG.update(config['prefetch'])
+    if config.has_section('filter'):
+        FILTER_CONFIG.update(config['filter'])
+
+    # optional OpenAI compatible servers, e.g. a model hosted on-prem
+    import backends
+    for section in config.sections():
+        if section.startswith('backend '):
+            BACKEND_CONFIG[section[len('backend '):].strip()] = dict(config[section])
+    backends.configure(BACKEND_CONFIG)
+
+    shell = shell or SHELL
+    prompt_context = get_prompt_context(shell)
     prompt_config = {
         'engine': ENGINE,
         'temperature': TEMPERATURE,
         'max_tokens': MAX_TOKENS,
-        'shell': SHELL,
+        'shell': shell,
         'multi_turn': MULTI_TURN,
-        'token_count': 0
+        'token_count': 0,
+        'examples': EXAMPLES,
+        'deadline': DEADLINE,
+        'engines': ENGINES,
+        'mode': MODE,
+        'candidates': CANDIDATES,
+        'adaptive': ADAPTIVE,
+        'backend': BACKEND,
+        'context': os.path.basename(prompt_context)[:-len('.txt')]
     }
     
-    return PromptFile(PROMPT_CONTEXT.name, prompt_config)
+    return PromptFile(os.path.basename(prompt_context), prompt_config, session)
 
-def is_sensitive_content(content):
+def load_openai():
     """
-    Check if the content contains sensitive content
-    Refer to https://beta.openai.com/docs/engines/content-filter for explanation
+    Import and configure the openai package, only needed once Codex is actually queried
+
+    Returns: the openai module
     """
+    import openai
 
-    if len(content) == 0:
-        return False
-    
-    response = openai.Completion.create(
-        engine="content-filter-alpha",
-        prompt = "<|endoftext|>"+content+"\n--\nLabel:",
-        temperature=0,
-        max_tokens=1,
-        top_p=0,
-        logprobs=10
-        )
-    
-    output_label = response["choices"][0]["text"]
-
-    # This is the probability at which we evaluate that a "2" is likely real
-    # vs. should be discarded as a false positive
-    toxic_threshold = -0.355
-
-    if output_label == "2":
-        # If the model returns "2", return its confidence in 2 or other output-labels
-        logprobs = response["choices"][0]["logprobs"]["top_logprobs"][0]
-
-        # If the model is not sufficiently confident in "2",
-        # choose the most probable of "0" or "1"
-        # Guaranteed to have a confidence for 2 since this was the selected token.
-        if logprobs["2"] < toxic_threshold:
-            logprob_0 = logprobs.get("0", None)
-            logprob_1 = logprobs.get("1", None)
-
-            # If both "0" and "1" have probabilities, set the output label
-            # to whichever is most probable
-            if logprob_0 is not None and logprob_1 is not None:
-                if logprob_0 >= logprob_1:
-                    output_label = "0"
-                else:
-                    output_label = "1"
-            # If only one of them is found, set output label to that one
-            elif logprob_0 is not None:
-                output_label = "0"
-            elif logprob_1 is not None:
-                output_label = "1"
-
-            # If neither "0" or "1" are available, stick with "2"
-            # by leaving output_label unchanged.
-
-        # if the most probable token is none of "0", "1", or "2"
-        # this should be set as unsafe
-        if output_label not in ["0", "1", "2"]:
-            output_label = "2"
-
-    return (output_label != "0")
-
-def get_query(prompt_file):
+    openai.api_key = API_KEY
+    openai.organization = ORGANIZATION
+
+    import openai_client
+    openai_client.configure(CLIENT_CONFIG)
+    # the completion server keeps its own connections warm, a proxy_port (earlier versions) turns the proxy on
+    proxy = CLIENT_CONFIG.get('proxy', 'on' if int(CLIENT_CONFIG.get('proxy_port', 0)) > 0 else 'off')
+    if proxy == 'on' and not SERVER_MODE:
+        openai_client.use_proxy()
+    return openai
+
+def read_entry():
     """
     uses the stdin to get user input
-    input is either treated as a command or as a Codex query
 
-    Returns: command result or context + input from stdin
+    Returns: the raw entry, a command or a Codex query
     """
 
     # get input from terminal or stdin
     if DEBUG_MODE:
-        entry = input("prompt: ") + '\n'
-    else:
-        entry = sys.stdin.read()
-    # first we check if the input is a command
-    command_result, prompt_file = get_command_result(entry, prompt_file)
-
-    # if input is not a command, then query Codex, otherwise exit command has been run successfully
-    if command_result == "":
-        return entry, prompt_file
-    else:
-        sys.exit(0)
+        return input("prompt: ") + '\n'
+    return sys.stdin.read()
 
 def detect_shell():
-    global SHELL
-    global PROMPT_CONTEXT
+    """
+    Fallback when the plugin does not pass --shell: walk up to the parent process
+    """
+    import re
+    import psutil
 
     parent_process_name = psutil.Process(os.getppid()).name()
     POWERSHELL_MODE = bool(re.fullmatch('pwsh|pwsh.exe|powershell.exe', parent_process_name))
     BASH_MODE = bool(re.fullmatch('bash|bash.exe', parent_process_name))
     ZSH_MODE = bool(re.fullmatch('zsh|zsh.exe', parent_process_name))
 
-    SHELL = "powershell" if POWERSHELL_MODE else "bash" if BASH_MODE else "zsh" if ZSH_MODE else "unknown"
+    set_shell("powershell" if POWERSHELL_MODE else "bash" if BASH_MODE else "zsh" if ZSH_MODE else "unknown")
+
+def set_shell(shell):
+    """
+    Set the shell mode of the one-shot and batch paths and pick the matching default context
+    """
+    global SHELL
+    global PROMPT_CONTEXT
+
+    SHELL = shell
+    PROMPT_CONTEXT = get_prompt_context(shell)
 
-    shell_prompt_file = Path(os.path.join(os.path.dirname(__file__), "..", "contexts", "{}-context.txt".format(SHELL)))
+def get_prompt_context(shell):
+    """
+    Returns: the default context of the shell
+    """
+    shell_prompt_file = os.path.join(os.path.dirname(__file__), "..", "contexts", "{}-context.txt".format(shell))
+    if os.path.isfile(shell_prompt_file):
+        return shell_prompt_file
+    return os.path.join(os.path.dirname(__file__), 'current_context.txt')
 
-    if shell_prompt_file.is_file():
-        PROMPT_CONTEXT = shell_prompt_file
+def stream_completion(response, screen, deadline=None, request_start=None):
+    """
+    Write the completion to stdout as the tokens arrive
+    Stops early if the query pre-screen flags the query or the time.time() deadline passes,
+    the events are read in a daemon thread so that a stalled stream is abandoned at the deadline
+    The time to the first token since request_start (time.perf_counter()) goes to the metrics
 
-if __name__ == '__main__':
-    detect_shell()
-    prompt_file = initialize()
+    Returns: a tuple of (the completion written so far, True if the deadline passed, the finish reason)
+    """
+    import queue
+    import threading
+
+    events = queue.Queue()
+    def read():
+        try:
+            for event in response:
+                events.put(event)
+            events.put(None)
+        except Exception as e:
+            events.put(e)
+
+    threading.Thread(target=metrics.bind(read), daemon=True).start()
+
+    completion_all = ''
+    finish_reason = None
+    while True:
+        try:
+            if deadline is None:
+                event = events.get()
+            else:
+                event = events.get(timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+            return completion_all, True, finish_reason
+        if event is None:
+            break
+        if isinstance(event, Exception):
+            raise event
+        if screen.query_flagged():
+            break
+        text = event['choices'][0]['text']
+        finish_reason = event['choices'][0].get('finish_reason') or finish_reason
+        if completion_all == '' and text != '' and request_start is not None:
+            metrics.current().add('first_token', time.perf_counter() - request_start)
+        completion_all += text
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    return completion_all, False, finish_reason
+
+def generate(prompt, config, max_tokens, stop, screen, deadline=None, request_start=None, backend=None, stream=False):
+    """
+    Request a single completion from the backend, streamed if stream is True
 
-    try:
-        user_query, prompt_file = get_query(prompt_file)
-        
-        config = prompt_file.config if prompt_file else {
-            'engine': ENGINE,
-            'temperature': TEMPERATURE,
-            'max_tokens': MAX_TOKENS,
-            'shell': SHELL,
-            'multi_turn': MULTI_TURN,
-            'token_count': 0
-        }
-
-        # use query prefix to prime Codex for correct scripting language
-        prefix = ""
-        # prime codex for the corresponding shell type
-        if config['shell'] == "zsh":
-            prefix = '#!/bin/zsh\n\n'
-        elif config['shell'] == "bash":
-            prefix = '#!/bin/bash\n\n'
-        elif config['shell'] == "powershell":
-            prefix = '<# powershell #>\n\n'
-        elif config['shell'] == "unknown":
-            print("\n#\tUnsupported shell type, please use # set shell <shell>")
-        else:
-            prefix = '#' + config['shell'] + '\n\n'
+    Returns: a tuple of (the completion, True if the deadline passed, the finish reason,
+    its token count reported by the API or None, streamed responses do not report their usage)
+    """
+    from openai_client import create_completion
+
+    response = create_completion(engine=config['engine'], prompt=prompt, temperature=config['temperature'], max_tokens=max_tokens, stop=stop, stream=stream,
+                                 deadline=deadline, backend=backend)
+    if stream:
+        return stream_completion(response, screen, deadline, request_start) + (None,)
+    usage = response.get('usage') or {}
+    return response['choices'][0]['text'], False, response['choices'][0].get('finish_reason'), usage.get('completion_tokens')
+
+def error_message(e):
+    """
+    Map an exception to the message shown in the shell
+    """
+    if isinstance(e, FileNotFoundError):
+        return 'Prompt file not found, try again'
+
+    # openai is only loaded if Codex was queried
+    if 'openai' in sys.modules:
+        import openai
+        if isinstance(e, openai.error.RateLimitError):
+            return 'Rate limit exceeded, try later'
+        if isinstance(e, openai.error.APIConnectionError):
+            return 'API connection error, are you connected to the internet?'
+        if isinstance(e, openai.error.InvalidRequestError):
+            return 'Invalid request - ' + str(e)
+        if isinstance(e, openai.error.Timeout):
+            return 'Request timed out, try again'
+
+    return 'Unexpected exception - ' + str(e)
+
+def print_error(message, stream=False):
+    """
+    Print an error, dropping any partially streamed completion first
+    """
+    if stream:
+        sys.stdout.write(RETRACT)
+    print('\n\n# Codex CLI error: ' + message)
+
+def get_backend(config):
+    """
+    Returns: the backend of the context and its config, with the engine of the backend if it has one
+    """
+    from backends import get_backend
 
-        codex_query = prefix + prompt_file.read_prompt_file(user_query) + user_query
+    backend = get_backend(config.get('backend', BACKEND))
+    if backend is not None and backend.engine:
+        config = dict(config, engine=backend.engine)
+    return backend, config
+
+def get_prefix(config):
+    """
+    Returns: the query prefix that primes Codex for the scripting language of the shell
+    """
+    prefix = ""
+    # prime codex for the corresponding shell type
+    if config['shell'] == "zsh":
+        prefix = '#!/bin/zsh\n\n'
+    elif config['shell'] == "bash":
+        prefix = '#!/bin/bash\n\n'
+    elif config['shell'] == "powershell":
+        prefix = '<# powershell #>\n\n'
+    elif config['shell'] == "unknown":
+        print("\n#\tUnsupported shell type, please use # set shell <shell>")
+    else:
+        prefix = '#' + config['shell'] + '\n\n'
+    return prefix
+
+def complete(user_query, prompt_file, stream=False):
+    """
+    Query Codex with the context and user query and print the completion, streamed if stream is True
+    """
+    run = metrics.current()
+    # the deadline counts from the key press, the client startup included
+    start = run.started
+    config = prompt_file.config if prompt_file else {
+        'engine': ENGINE,
+        'temperature': TEMPERATURE,
+        'max_tokens': MAX_TOKENS,
+        'shell': SHELL,
+        'multi_turn': MULTI_TURN,
+        'token_count': 0,
+        'examples': EXAMPLES,
+        'deadline': DEADLINE,
+        'engines': ENGINES,
+        'mode': MODE,
+        'candidates': CANDIDATES,
+        'adaptive': ADAPTIVE,
+        'backend': BACKEND
+    }
+
+    if config['engine'] == LOCAL_ENGINE:
+        run.set('engine', LOCAL_ENGINE)
+        with run.phase('local'):
+            completion_all = complete_local(user_query, prompt_file)
+        if completion_all is None:
+            print("\n#   No local answer found")
+            return
+        print(completion_all)
+        if config['multi_turn'] == "on":
+            prompt_file.add_input_output_pair(user_query, completion_all)
+        return
+
+    backend, config = get_backend(config)
+    if backend is None:
+        print("\n#   Unknown backend {}, see # set backend".format(config.get('backend')))
+        return
+
+    with run.phase('prompt'):
+        codex_query = get_prefix(config) + prompt_file.read_prompt_file(user_query) + user_query
+
+    # the content filter and the engines are only loaded once the cache has no answer
+    from completion_cache import CompletionCache
+    from engine_race import is_racing, get_cache_engine
+
+    # several engines or candidates are raced without streaming
+    racing = is_racing(config)
+    # the cache and prefetch keys name the backend, another server may serve the same engine name
+    engine = backend.qualify(config['engine'])
+    cache_engine = backend.qualify(get_cache_engine(config)) if racing else engine
+    run.set('engine', cache_engine)
+
+    # deterministic queries are answered from the completion cache when possible
+    cache = None
+    cache_key = None
+    completion_all = None
+    if CompletionCache.is_cacheable(config):
+        cache = CompletionCache()
+        with run.phase('cache'):
+            cache_key = cache.make_key(cache_engine, config['temperature'], config['max_tokens'], STOP, codex_query)
+            completion_all = cache.get(cache_key)
+        run.set('cache', 'miss' if completion_all is None else 'hit')
+
+    # the whole query, content filter included, has to be answered by the deadline
+    budget = int(config.get('deadline', DEADLINE)) / 1000
+    deadline = start + budget if budget > 0 else None
+    generation_deadline = None
+    if completion_all is None:
+        import content_filter
+        content_filter.configure(FILTER_CONFIG)
+        if deadline is not None:
+            generation_deadline = deadline - min(content_filter.FILTER_BUDGET, budget / 4)
+
+    # a completion prefetched while the user was typing has passed the content filter already
+    if completion_all is None and SERVER_MODE and not racing:
+        import prefetch
+        prefetch.configure(PREFETCH_CONFIG)
+        with run.phase('prefetch'):
+            completion_all = prefetch.take(prefetch.make_key(engine, config['temperature'], config['max_tokens'], STOP, codex_query), generation_deadline)
+        if completion_all is not None:
+            run.set('prefetch', 'hit')
+            if cache is not None:
+                cache.put(cache_key, completion_all, cache.make_query_key(engine, user_query))
+
+    streamed = False
+    if completion_all is None:
+        openai = load_openai()
+        from content_filter import ContentScreen
+        from engine_race import race
+
+        # a max_tokens and stop sequences fitted to the completions of this context, see completion_stats.py
+        max_tokens, stop = int(config['max_tokens']), STOP
+        if not racing and config.get('adaptive', ADAPTIVE) == 'on':
+            from completion_stats import get_stats
+            max_tokens, stop = get_stats().choose(config, STOP)
+            run.set('max_tokens', max_tokens)
+
+        # the user query is pre-screened while codex generates the completion
+        screen = ContentScreen(user_query, mode=backend.content_filter)
 
         # get the response from codex
-        response = openai.Completion.create(engine=config['engine'], prompt=codex_query, temperature=config['temperature'], max_tokens=config['max_tokens'], stop="#")
+        timed_out = False
+        reason = None
+        generation_start = time.perf_counter()
+        try:
+            if racing:
+                winner = race(codex_query, config, screen, STOP, generation_deadline, backend)
+                if winner is None:
+                    print("\n" + screen.get_message())
+                    return
+                completion_all = winner[1]
+            else:
+                completion_all, timed_out, finish_reason, completion_tokens = generate(codex_query, config, max_tokens, stop, screen, generation_deadline, generation_start, backend, stream)
+                streamed = stream
+
+                # a completion cut by the adapted budget, or emptied by the blank line stop, is continued once
+                # with the rest of max_tokens and the configured stop sequence
+                truncated = finish_reason == 'length' and max_tokens < int(config['max_tokens'])
+                retried = not timed_out and (truncated or (completion_all.strip() == '' and stop != STOP))
+                if retried:
+                    run.set('adaptive', 'retry')
+                    continuation, timed_out, finish_reason, continuation_tokens = generate(codex_query + completion_all, config, int(config['max_tokens']) - (max_tokens if truncated else 0),
+                                                                      STOP, screen, generation_deadline, backend=backend, stream=stream)
+                    completion_all += continuation
+                    completion_tokens = None if completion_tokens is None or continuation_tokens is None else completion_tokens + continuation_tokens
+                if not timed_out and config.get('adaptive', ADAPTIVE) == 'on':
+                    from completion_stats import get_stats
+                    estimated = completion_tokens is None
+                    if estimated:
+                        # the offline tokenizer estimates the length of streamed completions
+                        from tokenizer import count_tokens
+                        completion_tokens = count_tokens(completion_all, config['engine'])
+                    get_stats().record(config, completion_all, completion_tokens, finish_reason, max_tokens, stop, retried, estimated)
+        except openai.error.Timeout:
+            if deadline is None:
+                raise
+            completion_all = ''
+            timed_out = True
+        except openai.error.APIConnectionError:
+            completion_all = ''
+            reason = "Codex is unreachable"
+            run.set('error', 'APIConnectionError')
+        run.add('completion', time.perf_counter() - generation_start)
+
+        if timed_out:
+            reason = "Codex timed out after {} ms".format(config.get('deadline', DEADLINE))
+            run.set('error', 'Timeout')
+        if reason is not None:
+            complete_fallback(user_query, completion_all, prompt_file, cache, screen, deadline, reason, engine)
+            return
+
+        # in stream mode the check runs on the full completion, the streamed text is retracted if it fails
+        # raced candidates have been checked already, only the query verdict is left
+        if not racing:
+            screen.check_completion(completion_all)
+        with run.phase('filter_wait'):
+            sensitive = screen.is_sensitive(deadline)
+        if sensitive:
+            if streamed:
+                sys.stdout.write(RETRACT)
+            print("\n" + screen.get_message())
+            return
+
+        # only completions that passed the content filter are cached
+        if cache is not None:
+            cache.put(cache_key, completion_all, cache.make_query_key(engine, user_query))
+
+    if not streamed:
+        print(completion_all)
+
+    # append output to prompt context file
+    if config['multi_turn'] == "on":
+        if completion_all != "" or len(completion_all) > 0:
+            with run.phase('context_write'):
+                prompt_file.add_input_output_pair(user_query, completion_all)
+
+def prefetch_entry(user_query, prompt_file, owner):
+    """
+    Request the completion of a buffer the user has not sent yet in the background, see prefetch.py
+    Commands, the offline engine and raced queries are not prefetched, nothing is printed
+    """
+    from commands import may_be_command
+    from engine_race import is_racing
+
+    backend, config = get_backend(prompt_file.config)
+    if not user_query.lstrip().startswith('#') or may_be_command(user_query) or config['engine'] == LOCAL_ENGINE or is_racing(config) or backend is None:
+        return
+
+    import prefetch
+    prefetch.configure(PREFETCH_CONFIG)
+    codex_query = get_prefix(config) + prompt_file.read_prompt_file(user_query) + user_query
+
+    load_openai()
+    from openai_client import create_completion
+    import content_filter
+    from content_filter import ContentScreen
+    content_filter.configure(FILTER_CONFIG)
+
+    budget = int(config.get('deadline', DEADLINE)) / 1000
+    def request(task):
+        deadline = time.time() + budget if budget > 0 else None
+        screen = ContentScreen(user_query, mode=backend.content_filter)
+        # streamed, so that a superseded prefetch stops generating
+        response = create_completion(engine=config['engine'], prompt=codex_query, temperature=config['temperature'], max_tokens=config['max_tokens'], stop=STOP, stream=True,
+                                     deadline=deadline, backend=backend)
+        completion_all = ''
+        for event in response:
+            if task.cancelled:
+                return None
+            completion_all += event['choices'][0]['text']
+        screen.check_completion(completion_all)
+        if screen.is_sensitive(deadline):
+            return None
+        return completion_all
+
+    prefetch.start(owner, prefetch.make_key(backend.qualify(config['engine']), config['temperature'], config['max_tokens'], STOP, codex_query), request)
+
+def complete_local(user_query, prompt_file):
+    """
+    Answer from the shell history, the saved contexts and the multi-turn log
 
-        completion_all = response['choices'][0]['text']
+    Returns: the completion, or None if the local engine has no answer
+    """
+    from local_engine import LocalEngine
+
+    # ENGINE is the openaiapirc engine, used to count the tokens of the context examples
+    return LocalEngine(prompt_file.config['shell'], ENGINE, prompt_file.store).answer(user_query)
+
+def complete_fallback(user_query, partial, prompt_file, cache, screen, deadline, reason, engine):
+    """
+    The model missed the deadline or could not be reached, print the best answer available instead:
+    a cached answer to the same query (engine is the cache engine) from another context, the complete
+    lines streamed so far, an answer of the local engine, or just the reason
+    Fallback answers are not cached nor added to the multi-turn context
+    """
+    marker = "#   " + reason
 
-        if is_sensitive_content(user_query + '\n' + completion_all):
-            print("\n#   Sensitive content detected, response has been redacted")
+    from completion_cache import CompletionCache
+
+    # answers cached at temperature 0 are good enough as a fallback at any temperature
+    cache = cache or CompletionCache()
+    fallback = cache.get_by_query(cache.make_query_key(engine, user_query))
+    if fallback is not None:
+        marker += ", showing a cached answer"
+    else:
+        # a cut off line could be a dangerous command, only whole lines are kept
+        fallback = partial[:partial.rfind('\n') + 1]
+        if fallback.strip() != '':
+            marker += ", showing a partial answer"
+            screen.check_completion(fallback)
         else:
-            print(completion_all)
-
-            # append output to prompt context file
-            if config['multi_turn'] == "on":
-                if completion_all != "" or len(completion_all) > 0:
-                    prompt_file.add_input_output_pair(user_query, completion_all)
-        
-    except FileNotFoundError:
-        print('\n\n# Codex CLI error: Prompt file not found, try again')
-    except openai.error.RateLimitError:
-        print('\n\n# Codex CLI error: Rate limit exceeded, try later')
-    except openai.error.APIConnectionError:
-        print('\n\n# Codex CLI error: API connection error, are you connected to the internet?')
-    except openai.error.InvalidRequestError as e:
-        print('\n\n# Codex CLI error: Invalid request - ' + str(e))
+            fallback = complete_local(user_query, prompt_file)
+            if fallback is not None:
+                marker += ", showing a local answer"
+            else:
+                fallback = ''
+
+    if partial != '':
+        sys.stdout.write(RETRACT)
+    # a cached answer passed the filter together with the same query, only a partial answer is screened
+    if screen.completion_verdict is not None and screen.is_sensitive(deadline):
+        print("\n" + screen.get_message())
+        return
+    print(fallback.rstrip('\n') + '\n' + marker)
+
+def handle_entry(entry, prompt_file, stream=False):
+    """
+    input is either treated as a command or as a Codex query
+    prints the command result or the Codex completion, streamed if stream is True
+
+    Returns: the prompt file, possibly updated by a command
+    """
+    run = metrics.current()
+    try:
+        # first we check if the input is a command
+        with run.phase('command'):
+            command_result, prompt_file = get_command_result(entry, prompt_file)
+
+        # if input is not a command, then query Codex, otherwise the command has been run successfully
+        if command_result == "":
+            complete(entry, prompt_file, stream)
+        else:
+            run.set('engine', 'commands')
+
     except Exception as e:
-        print('\n\n# Codex CLI error: Unexpected exception - ' + str(e))
+        run.set('error', type(e).__name__)
+        print_error(error_message(e), stream)
+    finally:
+        # a turn writes the config at most once
+        if prompt_file is not None:
+            with run.phase('context_write'):
+                prompt_file.flush()
+        run.finish()
+
+    return prompt_file
+
+def run_once(entry, shell=None, stream=False):
+    """
+    One-shot path: initialize, answer a single entry and exit
+    """
+    run = metrics.start_run(metrics.process_start_time())
+    if shell:
+        set_shell(shell)
+    else:
+        with run.phase('detect_shell'):
+            detect_shell()
+    with run.phase('initialize'):
+        prompt_file = initialize(get_session())
+    metrics.profile(handle_entry, entry, prompt_file, stream)
+
+def run_server():
+    """
+    Long-lived server mode: the config, the loaded contexts and the HTTP session
+    of the openai client stay warm between requests
+    Requests of different terminals are answered concurrently, those of the same terminal one at a time
+    """
+    global SERVER_MODE
+    import daemon
+    import threading
+
+    SERVER_MODE = True
+    prompt_files = {}
+    config_mtimes = {}
+    # (shell, session) -> lock of the terminal
+    terminal_locks = {}
+    lock = threading.Lock()
+
+    def handler(request):
+        # the client sends its own start time, startup then covers its interpreter and the round trip
+        run = metrics.start_run(request.get('started'))
+        stream = request.get('stream', False)
+        shell = request.get('shell') or "unknown"
+        # the session of the terminal that sent the request, not of the server
+        key = (shell, request.get('session'))
+
+        with lock:
+            terminal_lock = terminal_locks.setdefault(key, threading.Lock())
+        with terminal_lock:
+            with run.phase('initialize'):
+                prompt_file = prompt_files.get(key)
+                if prompt_file is None:
+                    prompt_file = initialize(request.get('session'), shell)
+                elif prompt_file.has_config():
+                    # another process may have changed the config since the last request
+                    mtime = os.path.getmtime(prompt_file.config_path)
+                    if mtime != config_mtimes.get(key):
+                        prompt_file.read_config()
+
+            if request.get('prefetch'):
+                # the hotkey request of the same buffer takes the result, this one is not recorded
+                prompt_files[key] = prompt_file
+                try:
+                    prefetch_entry(request.get('entry', ''), prompt_file, key)
+                except Exception:
+                    pass
+                return
+
+            prompt_files[key] = prompt_file = metrics.profile(handle_entry, request.get('entry', ''), prompt_file, stream)
+            if prompt_file is not None and prompt_file.has_config():
+                config_mtimes[key] = os.path.getmtime(prompt_file.config_path)
+
+    create_template_ini_file()
+    daemon.serve(handler)
+
+if __name__ == '__main__':
+    if '--server' in sys.argv:
+        run_server()
+    else:
+        # the plugins pass the shell, so it does not need to be detected from the process tree
+        shell = None
+        if '--shell' in sys.argv and sys.argv.index('--shell') + 1 < len(sys.argv):
+            shell = sys.argv[sys.argv.index('--shell') + 1]
+        run_once(read_entry(), shell, stream='--stream' in sys.argv)
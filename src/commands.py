@@ -1,9 +1,23 @@
 import os
 import time
 
-from pathlib import Path
 from prompt_file import *
 
+# an entry is only run as a command if it contains one of these
+COMMAND_WORDS = ['set', 'cache stats', 'clear cache', 'filter stats', 'show stats', 'show config', 'multi-turn', 'context']
+
+def is_command(input, command):
+    """
+    Returns: True if the whole entry is the command, for commands a query mentioning them must not run
+    """
+    return ' '.join(input.strip().lstrip('#').split()) == command
+
+def may_be_command(input):
+    """
+    Returns: True if get_command_result could treat the input as a command, without running it
+    """
+    return any(input.__contains__(word) for word in COMMAND_WORDS)
+
 def get_command_result(input, prompt_file):
     """
     Checks if the input is a command and if so, executes it
@@ -13,13 +27,27 @@ def get_command_result(input, prompt_file):
     - default context
     - show context <n>
     - view context
+    - compact context
     - save context
     - clear context
     - load context <filename>
+    - list contexts
+    - search contexts <text>
     - set engine <engine>
     - set temperature <temperature>
     - set max_tokens <max_tokens>
     - set shell <shell>
+    - set examples <k>
+    - set deadline <ms>
+    - set engines <engine>,<engine>
+    - set mode <single|latency|quality>
+    - set candidates <n>
+    - set adaptive <on|off>
+    - set backend <name>
+    - cache stats
+    - clear cache
+    - filter stats
+    - show stats
 
     Returns: command result or "" if no command matched
     """
@@ -27,10 +55,34 @@ def get_command_result(input, prompt_file):
         return "", None
     
     config = prompt_file.config
+
+    # archive commands come first, the search text may contain any other command word
+    if input.__contains__("search contexts"):
+        prompt_file.search_contexts(input.split("search contexts", 1)[1].strip())
+        return "contexts searched", prompt_file
+
+    if input.__contains__("list contexts"):
+        prompt_file.list_contexts()
+        return "contexts listed", prompt_file
+
     # configuration setting commands
     if input.__contains__("set"):
+        # set backend <name>, first as the name may contain any other setting, see backends.py
+        if input.__contains__("backend"):
+            from backends import get_backend, get_names
+            input = input.split()
+            if len(input) == 4 and get_backend(input[3]) is not None:
+                config['backend'] = input[3]
+                prompt_file.set_config(config)
+                print("# Backend set to " + str(config['backend']))
+                return "config set", prompt_file
+            elif len(input) == 4:
+                print("# Unknown backend " + input[3] + ", the backends are " + ', '.join(get_names()))
+                return "backend not found", prompt_file
+            else:
+                return "", prompt_file
         # set temperature <temperature>
-        if input.__contains__("temperature"):
+        elif input.__contains__("temperature"):
             input = input.split()
             if len(input) == 4:
                 config['temperature'] = float(input[3])
@@ -58,6 +110,66 @@ def get_command_result(input, prompt_file):
                 return "config set", prompt_file
             else:
                 return "", prompt_file
+        # set examples <k>, 0 sends the whole context
+        elif input.__contains__("examples"):
+            input = input.split()
+            if len(input) == 4:
+                config['examples'] = int(input[3])
+                prompt_file.set_config(config)
+                print("# Examples set to " + str(config['examples']))
+                return "config set", prompt_file
+            else:
+                return "", prompt_file
+        # set deadline <ms>, 0 waits for the model however long it takes
+        elif input.__contains__("deadline"):
+            input = input.split()
+            if len(input) == 4:
+                config['deadline'] = int(input[3])
+                prompt_file.set_config(config)
+                print("# Deadline set to " + str(config['deadline']) + " ms")
+                return "config set", prompt_file
+            else:
+                return "", prompt_file
+        # set engines <engine>,<engine>, the engines raced in latency and quality mode
+        elif input.__contains__("engines"):
+            input = input.split()
+            if len(input) >= 4:
+                config['engines'] = ','.join(engine.strip(',') for engine in input[3:] if engine.strip(',') != '')
+                prompt_file.set_config(config)
+                print("# Engines set to " + str(config['engines']))
+                return "config set", prompt_file
+            else:
+                return "", prompt_file
+        # set mode <single|latency|quality>, see engine_race.MODES
+        elif input.__contains__("mode"):
+            input = input.split()
+            if len(input) == 4 and input[3] in ['single', 'latency', 'quality']:
+                config['mode'] = input[3]
+                prompt_file.set_config(config)
+                print("# Mode set to " + str(config['mode']))
+                return "config set", prompt_file
+            else:
+                return "", prompt_file
+        # set candidates <n>, the completions requested from each engine
+        elif input.__contains__("candidates"):
+            input = input.split()
+            if len(input) == 4:
+                config['candidates'] = int(input[3])
+                prompt_file.set_config(config)
+                print("# Candidates set to " + str(config['candidates']))
+                return "config set", prompt_file
+            else:
+                return "", prompt_file
+        # set adaptive <on|off>, max_tokens and stop sequences fitted to the past completions
+        elif input.__contains__("adaptive"):
+            input = input.split()
+            if len(input) == 4 and input[3] in ['on', 'off']:
+                config['adaptive'] = input[3]
+                prompt_file.set_config(config)
+                print("# Adaptive max_tokens set to " + str(config['adaptive']))
+                return "config set", prompt_file
+            else:
+                return "", prompt_file
         elif input.__contains__("engine"):
             input = input.split()
             if len(input) == 4:
@@ -68,6 +180,31 @@ def get_command_result(input, prompt_file):
             else:
                 return "", prompt_file
 
+    # completion cache commands, sqlite is only loaded when they are used
+    # the stats and cache commands have to be the whole entry, "# clear cache for pip" is a query
+    if is_command(input, "cache stats"):
+        from completion_cache import CompletionCache
+        CompletionCache().show_stats()
+        return "cache stats shown", prompt_file
+
+    if is_command(input, "clear cache"):
+        from completion_cache import CompletionCache
+        CompletionCache().clear()
+        return "cache cleared", prompt_file
+
+    if is_command(input, "filter stats"):
+        # imported here, the content filter pulls in the openai package
+        from content_filter import VerdictCache
+        VerdictCache().show_stats()
+        return "filter stats shown", prompt_file
+
+    if is_command(input, "show stats"):
+        import metrics
+        from completion_stats import get_stats
+        metrics.show_stats()
+        get_stats().show_stats()
+        return "stats shown", prompt_file
+
     if input.__contains__("show config"):
         prompt_file.show_config()
         return "config shown", prompt_file
@@ -89,31 +226,28 @@ def get_command_result(input, prompt_file):
     
     # context file commands
     if input.__contains__("context"):
+        # compact context, only the most recent of near duplicate interactions is kept
+        if input.__contains__("compact"):
+            prompt_file.compact_context()
+            return "context compacted", prompt_file
+
         if input.__contains__("default"):
             prompt_file.default_context()
             return "stopped context", prompt_file
         
-        # show context <n>
+        # show context <n>, the last n interactions
         if input.__contains__("show"):
-            print('\n')
-            with open(prompt_file.file_name, 'r') as f:
-                lines = f.readlines()
-                lines = lines[6:] # skip headers
-            
-            line_numbers = 0
+            interactions = None
             if len(input.split()) > 3:
-                line_numbers = int(input.split()[3])
+                interactions = int(input.split()[3])
             
-            if line_numbers != 0:
-                for line in lines[-line_numbers:]:
-                    print('\n# '+line, end='')
-            else:
-                print('\n# '.join(lines))
+            prompt_file.show_context(interactions)
             return "context shown", prompt_file
         
         # edit context
         if input.__contains__("view"):
-            # open the prompt file in text editor
+            # open a snapshot of the context in text editor
+            prompt_file.write_snapshot()
             if config['shell'] != 'powershell':
                 os.system('open {}'.format(prompt_file.file_path))
             else:
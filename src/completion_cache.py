@@ -0,0 +1,188 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+
+# cache database located in the install directory, next to current_context.txt
+CACHE_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "completion_cache.db")
+
+# entries older than this many seconds are evicted
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# least recently used entries are evicted once the completions, keys included, take more bytes than this
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# last_used is only written again after this many seconds, so that most hits are read-only
+LAST_USED_RESOLUTION = 60 * 60
+
+# bytes of an entry, as counted against CACHE_MAX_BYTES
+ENTRY_SIZE = 'LENGTH(CAST(completion AS BLOB)) + LENGTH(key) + COALESCE(LENGTH(query), 0)'
+
+# sqlite3.connect timeout: a database locked longer than this by another process is treated as a
+# cache miss (sqlite3.OperationalError), the cache never fails a query, and the cache commands
+# print LOCKED_MESSAGE instead of a traceback
+LOCKED_MESSAGE = "\n#   The cache database is locked by another Codex CLI process, try again"
+
+class CompletionCache:
+    """
+    Persistent cache of Codex completions keyed by engine, sampling parameters and prompt
+    Only deterministic (temperature 0) queries are cached
+    """
+
+    def __init__(self, path=CACHE_LOCATION, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path, timeout=1)
+        try:
+            self._create_tables()
+        except sqlite3.OperationalError:
+            # locked by another process, which created the tables already
+            pass
+
+    def _create_tables(self):
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS completions ('
+                'key TEXT PRIMARY KEY, completion TEXT, created REAL, last_used REAL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            # caches created before the timeout fallback have no query column
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(completions)')]
+            if 'query' not in columns:
+                self.connection.execute('ALTER TABLE completions ADD COLUMN query TEXT')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS completions_query ON completions (query)')
+
+    @staticmethod
+    def is_cacheable(config):
+        """
+        Sampling with a temperature above 0 is expected to give different answers
+        """
+        return float(config['temperature']) == 0
+
+    @staticmethod
+    def make_key(engine, temperature, max_tokens, stop, prompt):
+        """
+        Hash of everything that determines the completion
+        """
+        key = json.dumps([engine, float(temperature), int(max_tokens), stop, prompt])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def make_query_key(engine, user_query):
+        """
+        Hash of the engine and the user query alone, whatever the context
+        """
+        key = json.dumps([engine, user_query.strip()])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        The hits and misses are counted in the metrics log, see stats
+
+        Returns: the cached completion or None
+        """
+        now = time.time()
+        try:
+            row = self.connection.execute(
+                'SELECT completion, last_used FROM completions WHERE key = ? AND created > ?',
+                (key, now - self.ttl)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None:
+            return None
+        if now - row[1] > LAST_USED_RESOLUTION:
+            try:
+                with self.connection:
+                    self.connection.execute('UPDATE completions SET last_used = ? WHERE key = ?', (now, key))
+            except sqlite3.OperationalError:
+                # still a hit, only its place in the eviction order is not refreshed
+                pass
+        return row[0]
+
+    def get_by_query(self, query_key):
+        """
+        Fallback lookup when the model does not answer in time
+
+        Returns: the most recent completion of the same query in any context, or None
+        """
+        try:
+            row = self.connection.execute(
+                'SELECT completion FROM completions WHERE query = ? AND created > ? ORDER BY created DESC LIMIT 1',
+                (query_key, time.time() - self.ttl)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row is not None else None
+
+    def put(self, key, completion, query_key=None):
+        """
+        Store a completion and evict expired and least recently used entries,
+        nothing is stored if the database stays locked
+        """
+        now = time.time()
+        try:
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO completions (key, completion, created, last_used, query) VALUES (?, ?, ?, ?, ?)',
+                    (key, completion, now, now, query_key))
+                self.connection.execute('DELETE FROM completions WHERE created <= ?', (now - self.ttl,))
+                # the most recently used entries that fit in max_bytes are kept
+                self.connection.execute(
+                    'DELETE FROM completions WHERE key IN (SELECT key FROM '
+                    '(SELECT key, SUM({}) OVER (ORDER BY last_used DESC, created DESC) AS total FROM completions) '
+                    'WHERE total > ?)'.format(ENTRY_SIZE), (self.max_bytes,))
+        except sqlite3.OperationalError:
+            pass
+
+    def stats(self):
+        """
+        Returns: a dictionary with the entry count, size in bytes and the hits and misses
+        of the queries recorded in the metrics log since the cache was last cleared,
+        None if the database stays locked
+        """
+        import metrics
+
+        try:
+            entries, size = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM({}), 0) FROM completions'.format(ENTRY_SIZE)).fetchone()
+            cleared = self.connection.execute("SELECT value FROM counters WHERE name = 'cleared'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        outcomes = [record.get('cache') for record in metrics.read_records() if record.get('time', 0) > (cleared[0] if cleared else 0)]
+        hits = outcomes.count('hit')
+        misses = outcomes.count('miss')
+        return {
+            'entries': entries,
+            'size': size,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses > 0 else 0.0
+        }
+
+    def show_stats(self):
+        stats = self.stats()
+        if stats is None:
+            print(LOCKED_MESSAGE)
+            return
+        print('\n')
+        lines = []
+        for key, value in stats.items():
+            if key == 'hit_rate':
+                value = '{:.1%}'.format(value)
+            lines.append('# {}: {}\n'.format(key, value))
+        print(''.join(lines))
+
+    def clear(self):
+        """
+        Remove every cached completion and reset the counters
+        """
+        try:
+            with self.connection:
+                self.connection.execute('DELETE FROM completions')
+                # the hit rate only counts the queries after this
+                self.connection.execute("INSERT OR REPLACE INTO counters VALUES ('cleared', ?)", (time.time(),))
+        except sqlite3.OperationalError:
+            print(LOCKED_MESSAGE)
+            return
+        print("\n#   Completion cache has been cleared")
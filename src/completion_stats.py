@@ -0,0 +1,195 @@
+import os
+import json
+import math
+import threading
+
+# Most shell answers are a single line of a few dozen tokens, yet every request used to ask for the
+# full max_tokens. The length (in tokens) and finish reason of the completions are kept per shell
+# and per context, and once there are enough of them a query asks for the 99th percentile length
+# plus a margin instead, capped by max_tokens. Lengths reported by the API's usage are kept apart from
+# the offline tokenizer estimates of streamed completions, which only stand in until there are enough
+# reported ones. When the completions of a context never contain a
+# blank line, a blank line is added to the stop sequences as well.
+#
+# A completion cut by the smaller budget is continued once with the rest of max_tokens, so answers
+# stay the same, only rambling completions get cheaper. "# set adaptive off" asks for max_tokens again.
+STATS_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "completion_stats.json")
+
+# lengths kept per shell and per context
+MAX_SAMPLES = 200
+# lengths needed before the budget is adapted
+MIN_SAMPLES = 20
+PERCENTILE = 99
+# the budget is the percentile length times MARGIN, at least MIN_TOKENS
+MARGIN = 1.5
+MIN_TOKENS = 32
+
+BLANK_LINE = '\n\n'
+# a blank line stops the completions once fewer of them than this contain one
+BLANK_LINE_RATE = 0.01
+
+_thread_lock = threading.Lock()
+
+def get_budget(lengths):
+    """
+    Returns: the (PERCENTILE length, budget) of a list of completion lengths
+    """
+    lengths = sorted(lengths)
+    length = lengths[max(0, math.ceil(PERCENTILE / 100 * len(lengths)) - 1)] if len(lengths) > 0 else 0
+    return length, max(MIN_TOKENS, math.ceil(length * MARGIN))
+
+def get_lengths(stats):
+    """
+    Returns: the lengths reported by the API if there are enough of them, else the estimated ones
+    """
+    if len(stats['lengths']) >= MIN_SAMPLES:
+        return stats['lengths']
+    return stats.get('estimated_lengths', [])
+
+class StatsLock:
+    """
+    Held while the stats are read and written back, by the threads of the completion server and by
+    the other processes of the user. Falls back to an in-process lock where fcntl is not available
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        _thread_lock.acquire()
+        self.lock_file = None
+        try:
+            import fcntl
+            self.lock_file = open(self.path, 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        except (ImportError, OSError):
+            # stats never break a query
+            pass
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self.lock_file is not None:
+                self.lock_file.close()
+        finally:
+            _thread_lock.release()
+
+class CompletionStats:
+    """
+    Completion lengths and adaptive budget outcomes per shell and per context, stored as JSON
+    """
+
+    def __init__(self, path=STATS_LOCATION):
+        self.path = path
+        self.lock = StatsLock(path + '.lock')
+        self.mtime = None
+        self.keys = {}
+        self.reload()
+
+    def reload(self, force=False):
+        """
+        Read the stats again if another process wrote them, or in any case with force
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.mtime and not force:
+                return
+            with open(self.path, 'r') as f:
+                self.keys = json.load(f)
+            self.mtime = mtime
+        except (OSError, ValueError):
+            self.keys = {}
+
+    def _write(self):
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self.keys, f)
+            os.replace(temp_path, self.path)
+            self.mtime = os.path.getmtime(self.path)
+        except OSError:
+            # stats never break a query
+            pass
+
+    @staticmethod
+    def get_keys(config):
+        """
+        Returns: the context key first, then the shell key
+        """
+        return ['context:' + config.get('context', ''), 'shell:' + config['shell']]
+
+    def _samples(self, config):
+        """
+        Returns: the stats of the context if it has enough lengths, else those of the shell, else None
+        """
+        for key in self.get_keys(config):
+            stats = self.keys.get(key)
+            if stats is not None and len(get_lengths(stats)) >= MIN_SAMPLES:
+                return stats
+        return None
+
+    def choose(self, config, stop):
+        """
+        Returns: the (max_tokens, stop sequences) to request, max_tokens is the configured one
+        while there are fewer than MIN_SAMPLES lengths
+        """
+        self.reload()
+        max_tokens = int(config['max_tokens'])
+        stats = self._samples(config)
+        if stats is None:
+            return max_tokens, stop
+
+        budget = min(max_tokens, get_budget(get_lengths(stats))[1])
+
+        blank_lines = stats.get('blank_lines', [])
+        if len(blank_lines) >= MIN_SAMPLES and sum(blank_lines) < BLANK_LINE_RATE * len(blank_lines):
+            stop = [stop, BLANK_LINE] if isinstance(stop, str) else list(stop) + [BLANK_LINE]
+        return budget, stop
+
+    def record(self, config, completion, tokens, finish_reason, max_tokens, stop, retried, estimated=False):
+        """
+        Add the length in tokens of a completion from the API, requested with max_tokens and stop,
+        retried is True if it was continued after being cut by the adapted budget, estimated is True
+        if the length was estimated offline instead of reported by the API
+        """
+        adapted = max_tokens < int(config['max_tokens'])
+        with self.lock:
+            # the samples written by other threads and processes since the last read are kept
+            self.reload(force=True)
+            for key in self.get_keys(config):
+                stats = self.keys.setdefault(key, {'lengths': [], 'blank_lines': [], 'queries': 0, 'adapted': 0, 'retried': 0, 'truncated': 0})
+                lengths = 'estimated_lengths' if estimated else 'lengths'
+                stats[lengths] = (stats.get(lengths, []) + [tokens])[-MAX_SAMPLES:]
+                # with a blank line stop the completions cannot contain one, they tell nothing
+                if BLANK_LINE not in stop:
+                    stats['blank_lines'] = (stats['blank_lines'] + [int(BLANK_LINE in completion.strip('\n'))])[-MAX_SAMPLES:]
+                stats['queries'] += 1
+                stats['adapted'] += int(adapted)
+                stats['retried'] += int(retried)
+                stats['truncated'] += int(finish_reason == 'length')
+            self._write()
+
+    def show_stats(self):
+        self.reload()
+        if len(self.keys) == 0:
+            return
+        lines = ['#\n# {:<24}{:>8}{:>8}{:>8}{:>10}{:>10}{:>11}\n'.format('adaptive max_tokens', 'queries', 'p99', 'budget', 'hit rate', 'retries', 'truncated')]
+        for key, stats in sorted(self.keys.items()):
+            lengths = get_lengths(stats)
+            length, budget = get_budget(lengths)
+            # the share of adapted queries answered within the smaller budget
+            hit_rate = '{:.0%}'.format(1 - stats['retried'] / stats['adapted']) if stats['adapted'] > 0 else '-'
+            lines.append('# {:<24}{:>8}{:>8}{:>8}{:>10}{:>10}{:>11}\n'.format(
+                key, stats['queries'], length, budget if len(lengths) >= MIN_SAMPLES else '-', hit_rate, stats['retried'], stats['truncated']))
+        print(''.join(lines))
+
+_stats = None
+
+def get_stats():
+    """
+    Returns: the stats of the process, kept between the queries of the completion server
+    """
+    global _stats
+    if _stats is None:
+        _stats = CompletionStats()
+    return _stats
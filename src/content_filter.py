@@ -0,0 +1,426 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+import metrics
+
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from completion_cache import CACHE_LOCATION, CACHE_TTL, LOCKED_MESSAGE
+
+# extra seconds we are willing to wait for a filter verdict once the completion is done
+FILTER_BUDGET = 1.0
+
+# verdict used when the filter errors out or misses the budget:
+# "closed" withholds the answer, "open" lets it through
+FILTER_POLICY = "closed"
+
+# both can be overridden in a [filter] section of openaiapirc, e.g. budget=2.5 and policy=open
+
+# local allow/deny rules that can settle a verdict without calling the content filter
+RULES_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "content_filter_rules.txt")
+
+# contents screened by one multi-prompt content filter request at most, see screen_contents
+FILTER_BATCH_SIZE = 20
+
+# counters reported by the filter stats command
+FILTER_COUNTERS = ['filter_rule_allow', 'filter_rule_deny', 'filter_cache_hits', 'filter_local_pass', 'filter_api_calls']
+
+# the content_filter mode of a backend: "api" calls the OpenAI content filter when the rules and
+# the cache do not settle the verdict, "local" lets such content through, "off" screens nothing
+
+_rules = None
+_rules_mtime = None
+
+def configure(section):
+    """
+    Apply the [filter] section of openaiapirc
+    """
+    global FILTER_BUDGET, FILTER_POLICY
+
+    FILTER_BUDGET = float(section.get('budget', FILTER_BUDGET))
+    policy = section.get('policy', FILTER_POLICY)
+    FILTER_POLICY = policy if policy in ['closed', 'open'] else FILTER_POLICY
+
+def is_sensitive_content(content):
+    """
+    Check if the content contains sensitive content
+    Refer to https://beta.openai.com/docs/engines/content-filter for explanation
+    """
+
+    if len(content) == 0:
+        return False
+
+    return are_sensitive_contents([content])[0]
+
+def are_sensitive_contents(contents):
+    """
+    Check several contents with a single multi-prompt content filter request
+
+    Returns: a verdict per content, in order
+    """
+    # openai is only loaded once a verdict is not settled locally
+    from openai_client import create_completion
+
+    # runs in a filter thread, concurrently with the other phases
+    with metrics.current().phase('filter_call'):
+        response = create_completion(
+            engine="content-filter-alpha",
+            prompt = ["<|endoftext|>"+content+"\n--\nLabel:" for content in contents],
+            temperature=0,
+            max_tokens=1,
+            top_p=0,
+            logprobs=10,
+            traffic='filter'
+            )
+
+    # choices are matched to prompts by index, the order is not guaranteed, a missing label is unsafe
+    verdicts = [True] * len(contents)
+    for choice in response["choices"]:
+        verdicts[choice["index"]] = is_sensitive_choice(choice)
+    return verdicts
+
+def is_sensitive_choice(choice):
+    """
+    Returns: True unless the content filter labelled the content of a choice safe ("0")
+    """
+    output_label = choice["text"]
+
+    # This is the probability at which we evaluate that a "2" is likely real
+    # vs. should be discarded as a false positive
+    toxic_threshold = -0.355
+
+    if output_label == "2":
+        # If the model returns "2", return its confidence in 2 or other output-labels
+        logprobs = choice["logprobs"]["top_logprobs"][0]
+
+        # If the model is not sufficiently confident in "2",
+        # choose the most probable of "0" or "1"
+        # Guaranteed to have a confidence for 2 since this was the selected token.
+        if logprobs["2"] < toxic_threshold:
+            logprob_0 = logprobs.get("0", None)
+            logprob_1 = logprobs.get("1", None)
+
+            # If both "0" and "1" have probabilities, set the output label
+            # to whichever is most probable
+            if logprob_0 is not None and logprob_1 is not None:
+                if logprob_0 >= logprob_1:
+                    output_label = "0"
+                else:
+                    output_label = "1"
+            # If only one of them is found, set output label to that one
+            elif logprob_0 is not None:
+                output_label = "0"
+            elif logprob_1 is not None:
+                output_label = "1"
+
+            # If neither "0" or "1" are available, stick with "2"
+            # by leaving output_label unchanged.
+
+        # if the most probable token is none of "0", "1", or "2"
+        # this should be set as unsafe
+        if output_label not in ["0", "1", "2"]:
+            output_label = "2"
+
+    return (output_label != "0")
+
+def load_rules(path=RULES_LOCATION):
+    """
+    Read the allow/deny rules, one "allow: <regex>" or "deny: <regex>" per line
+    The rules are only parsed again when the file changes
+
+    Returns: a tuple of compiled allow and deny patterns
+    """
+    global _rules
+    global _rules_mtime
+
+    if not os.path.isfile(path):
+        return [], []
+
+    mtime = os.path.getmtime(path)
+    if _rules is None or mtime != _rules_mtime:
+        allow = []
+        deny = []
+        with open(path, 'r') as f:
+            for line in f:
+                kind, _, pattern = line.strip().partition(':')
+                if kind == 'allow':
+                    allow.append(re.compile(pattern.strip()))
+                elif kind == 'deny':
+                    deny.append(re.compile(pattern.strip()))
+        _rules = (allow, deny)
+        _rules_mtime = mtime
+
+    return _rules
+
+def apply_rules(content, rules):
+    """
+    A deny rule matching any line marks the content as sensitive,
+    the content is safe if an allow rule matches every non empty line
+
+    Returns: True/False if the rules settle the verdict, None otherwise
+    """
+    allow, deny = rules
+    lines = [line for line in content.splitlines() if line.strip() != '']
+    if any(pattern.search(line) for pattern in deny for line in lines):
+        return True
+    if len(allow) > 0 and all(any(pattern.search(line) for pattern in allow) for line in lines):
+        return False
+    return None
+
+class VerdictCache:
+    """
+    Content filter verdicts keyed by a hash of the screened content, with its whitespace collapsed
+    Shares the database and expiry of the completion cache, a locked database is a cache miss
+    The filter threads share one instance, see get_verdict_cache
+    """
+
+    def __init__(self, path=CACHE_LOCATION, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=1, check_same_thread=False)
+        try:
+            self._create_tables()
+        except sqlite3.OperationalError:
+            # locked by another process, which created the tables already
+            pass
+
+    def _create_tables(self):
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, sensitive INTEGER, created REAL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+
+    @staticmethod
+    def make_key(content):
+        return hashlib.sha256(' '.join(content.split()).encode('utf-8')).hexdigest()
+
+    def count(self, name):
+        try:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'INSERT INTO counters VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+        except sqlite3.OperationalError:
+            pass
+
+    def get(self, key):
+        """
+        Returns: the cached verdict or None
+        """
+        try:
+            with self.lock:
+                row = self.connection.execute(
+                    'SELECT sensitive FROM verdicts WHERE key = ? AND created > ?',
+                    (key, time.time() - self.ttl)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return None if row is None else bool(row[0])
+
+    def put(self, key, sensitive):
+        now = time.time()
+        try:
+            with self.lock, self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)', (key, int(sensitive), now))
+                self.connection.execute('DELETE FROM verdicts WHERE created <= ?', (now - self.ttl,))
+        except sqlite3.OperationalError:
+            pass
+
+    def show_stats(self):
+        try:
+            counters = dict(self.connection.execute('SELECT name, value FROM counters').fetchall())
+            verdicts = self.connection.execute('SELECT COUNT(*) FROM verdicts').fetchone()[0]
+        except sqlite3.OperationalError:
+            print(LOCKED_MESSAGE)
+            return
+        print('\n')
+        lines = ['# verdicts: {}\n'.format(verdicts)]
+        total = 0
+        for name in FILTER_COUNTERS:
+            total += counters.get(name, 0)
+            lines.append('# {}: {}\n'.format(name, counters.get(name, 0)))
+        local = total - counters.get('filter_api_calls', 0)
+        lines.append('# local_hit_rate: {:.1%}\n'.format(local / total if total > 0 else 0.0))
+        print(''.join(lines))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM verdicts')
+            self.connection.execute(
+                'DELETE FROM counters WHERE name IN ({})'.format(','.join('?' * len(FILTER_COUNTERS))), FILTER_COUNTERS)
+
+_verdict_cache = None
+_verdict_cache_lock = threading.Lock()
+
+def get_verdict_cache():
+    """
+    Returns: the verdict cache of the process, opened once
+    """
+    global _verdict_cache
+    with _verdict_cache_lock:
+        if _verdict_cache is None:
+            _verdict_cache = VerdictCache()
+        return _verdict_cache
+
+def settle_locally(content, mode, cache):
+    """
+    Returns: the verdict of the allow/deny rules, the verdict cache or the mode, None if it takes the content filter API
+    """
+    if len(content.strip()) == 0 or mode == 'off':
+        return False
+
+    verdict = apply_rules(content, load_rules())
+    if verdict is not None:
+        cache.count('filter_rule_deny' if verdict else 'filter_rule_allow')
+        return verdict
+
+    verdict = cache.get(cache.make_key(content))
+    if verdict is not None:
+        cache.count('filter_cache_hits')
+        return verdict
+
+    if mode == 'local':
+        cache.count('filter_local_pass')
+        return False
+    return None
+
+def screen_content(content, mode='api'):
+    """
+    Settle the verdict locally when possible: the allow/deny rules first,
+    then the verdict cache, and only then the content filter API if mode is "api"
+    The query and the completion are screened apart, so that the allow rules can
+    settle the verdict of a completion and a verdict is reused for another query
+
+    Returns: True if the content is sensitive
+    """
+    return screen_contents([content], mode)[0]
+
+def screen_contents(contents, mode='api'):
+    """
+    screen_content for several contents at once, e.g. the queries and completions of a batch:
+    the contents the rules and the cache do not settle are deduplicated and sent to
+    the content filter API in multi-prompt requests of FILTER_BATCH_SIZE contents
+
+    Returns: a verdict per content, in order
+    """
+    cache = get_verdict_cache()
+    verdicts = [settle_locally(content, mode, cache) for content in contents]
+
+    # the positions of each content left to the API, by verdict cache key
+    unsettled = {}
+    for i, verdict in enumerate(verdicts):
+        if verdict is None:
+            unsettled.setdefault(cache.make_key(contents[i]), []).append(i)
+
+    keys = list(unsettled)
+    for start in range(0, len(keys), FILTER_BATCH_SIZE):
+        chunk = keys[start:start + FILTER_BATCH_SIZE]
+        for _ in chunk:
+            cache.count('filter_api_calls')
+        for key, verdict in zip(chunk, are_sensitive_contents([contents[unsettled[key][0]] for key in chunk])):
+            cache.put(key, verdict)
+            for i in unsettled[key]:
+                verdicts[i] = verdict
+    return verdicts
+
+def run_async(function, *args):
+    """
+    Run function in a daemon thread, so a slow filter call never delays the process exit
+
+    Returns: a future holding the result
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=metrics.bind(run), daemon=True).start()
+    return future
+
+class ContentScreen:
+    """
+    Screens the user query concurrently with the generation and the completion right after it
+    """
+
+    def __init__(self, user_query, budget=None, policy=None, mode='api'):
+        self.budget = FILTER_BUDGET if budget is None else budget
+        self.policy = policy or FILTER_POLICY
+        self.mode = mode
+        # why the latest verdict came back sensitive: None if the filter flagged the content,
+        # "timed out" or "failed" if the policy decided instead
+        self.failure = None
+        self.query_verdict = run_async(screen_content, user_query, mode)
+        self.completion_verdict = None
+
+    def query_flagged(self):
+        """
+        Non-blocking: True once the query pre-screen has come back sensitive
+        """
+        return self.query_verdict.done() and self._verdict(self.query_verdict, 0)
+
+    def check_completion(self, completion):
+        """
+        Start screening the completion, call as soon as the full text is known,
+        the query has its own verdict
+        """
+        self.completion_verdict = run_async(screen_content, completion, self.mode)
+
+    def check_candidate(self, completion):
+        """
+        Start screening one of several candidate completions, they are all screened in parallel
+
+        Returns: the future verdict, see candidate_flagged
+        """
+        return run_async(screen_content, completion, self.mode)
+
+    def candidate_flagged(self, verdict, deadline=None):
+        """
+        Wait at most the latency budget, and never past the time.time() deadline, for a candidate verdict
+        """
+        budget = self.budget
+        if deadline is not None:
+            budget = min(budget, max(deadline - time.time(), 0))
+        return self._verdict(verdict, budget)
+
+    def is_sensitive(self, deadline=None):
+        """
+        Wait at most the latency budget, and never past the time.time() deadline, for both verdicts
+
+        Returns: True if the query or the completion should be redacted
+        """
+        budget = self.budget
+        if deadline is not None:
+            budget = min(budget, max(deadline - time.time(), 0))
+        deadline = time.monotonic() + budget
+        for verdict in (self.query_verdict, self.completion_verdict):
+            if verdict is not None and self._verdict(verdict, max(deadline - time.monotonic(), 0)):
+                return True
+        return False
+
+    def get_message(self):
+        """
+        Returns: the line shown instead of a withheld answer, a filter failure is not reported as sensitive content
+        """
+        if self.failure is not None:
+            return "#   Content filter {}, response has been withheld (filter policy {})".format(self.failure, self.policy)
+        return "#   Sensitive content detected, response has been redacted"
+
+    def _verdict(self, verdict, timeout):
+        # a filter error or a missed budget falls back to the policy
+        failure = None
+        try:
+            sensitive = verdict.result(timeout=timeout)
+        except FutureTimeoutError:
+            failure = 'timed out'
+            sensitive = self.policy == "closed"
+        except Exception:
+            failure = 'failed'
+            sensitive = self.policy == "closed"
+        if sensitive:
+            self.failure = failure
+        return sensitive
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import gzip
+
+from context_store import StoreLock
+from context_format import serialize_context, parse_context
+
+# Saved contexts ("# save context <name>") and the history dropped by "clear context" are kept
+# as gzip compressed context files in archive/ of the install directory, with a small JSON index
+# (name, kind, shell, token count, time, size and the words of the queries) to list and search them
+# without decompressing anything. Loading a context only decompresses that entry.
+#
+# Cleared contexts are evicted after RETENTION_DAYS, and the oldest ones once the archive is larger
+# than ARCHIVE_MAX_BYTES. Saved contexts are never evicted.
+ARCHIVE_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "archive")
+DELETED_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "deleted")
+
+SAVED = 'saved'
+CLEARED = 'cleared'
+
+RETENTION_DAYS = 30
+ARCHIVE_MAX_BYTES = 20 * 1024 * 1024
+
+# words of the queries kept per entry for searching
+MAX_TERMS = 256
+
+class ContextArchive:
+    """
+    Compressed store of saved and cleared contexts with a metadata index
+    """
+
+    def __init__(self, path=ARCHIVE_LOCATION):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        os.makedirs(path, exist_ok=True)
+        # the index is replaced atomically, only writers take the lock
+        self.lock = StoreLock(os.path.join(path, 'index.lock'))
+
+    def entries(self, kind=None):
+        """
+        Returns: the index entries, newest first
+        """
+        if not os.path.isfile(self.index_path):
+            return []
+        with open(self.index_path, 'r') as f:
+            entries = json.load(f)
+        return [entry for entry in entries if kind is None or entry['kind'] == kind]
+
+    def _write_index(self, entries):
+        entries.sort(key=lambda entry: -entry['time'])
+        temp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.index_path)
+
+    def add(self, name, kind, config, interactions, created=None):
+        """
+        Archive (query, completion, tokens) interactions with their config,
+        a saved context replaces the saved context of the same name
+
+        Returns: the index entry
+        """
+        from example_index import get_terms
+
+        created = created or time.time()
+        text = serialize_context(config, ''.join(query + completion for query, completion, _ in interactions),
+                                 [tokens for _, _, tokens in interactions])
+        terms = []
+        for query, _, _ in interactions:
+            for term in get_terms(query):
+                if term not in terms and len(terms) < MAX_TERMS:
+                    terms.append(term)
+
+        safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        file_name = '{}-{}-{}.txt.gz'.format(kind, time.strftime('%Y%m%d%H%M%S', time.localtime(created)), safe_name)
+        with gzip.open(os.path.join(self.path, file_name), 'wt', encoding='utf-8') as f:
+            f.write(text)
+        entry = {
+            'name': name,
+            'kind': kind,
+            'file': file_name,
+            'shell': config.get('shell', ''),
+            'token_count': sum(tokens for _, _, tokens in interactions),
+            'interactions': len(interactions),
+            'time': created,
+            'size': os.path.getsize(os.path.join(self.path, file_name)),
+            'terms': terms,
+        }
+
+        with self.lock:
+            entries = self.entries()
+            replaced = [old for old in entries if kind == SAVED and old['kind'] == SAVED and old['name'] == name]
+            entries = [old for old in entries if old not in replaced] + [entry]
+            evicted = self.evict(entries)
+            self._write_index([old for old in entries if old not in evicted])
+            for old in replaced + evicted:
+                if old['file'] != file_name and os.path.isfile(os.path.join(self.path, old['file'])):
+                    os.remove(os.path.join(self.path, old['file']))
+        return entry
+
+    def evict(self, entries):
+        """
+        Returns: the cleared entries past their retention or over the size limit, oldest first
+        """
+        now = time.time()
+        cleared = sorted((entry for entry in entries if entry['kind'] == CLEARED), key=lambda entry: entry['time'])
+        evicted = [entry for entry in cleared if now - entry['time'] > RETENTION_DAYS * 24 * 3600]
+        size = sum(entry['size'] for entry in entries if entry not in evicted)
+        for entry in cleared:
+            if size <= ARCHIVE_MAX_BYTES:
+                break
+            if entry not in evicted:
+                evicted.append(entry)
+                size -= entry['size']
+        return evicted
+
+    def find(self, name):
+        """
+        Returns: the newest entry with that name (saved before cleared), None if there is none
+        """
+        for kind in (SAVED, CLEARED):
+            for entry in self.entries(kind):
+                if entry['name'] == name:
+                    return entry
+        return None
+
+    def read(self, entry):
+        """
+        Returns: the (config, body, token_counts) of an entry, only this entry is decompressed
+        """
+        with gzip.open(os.path.join(self.path, entry['file']), 'rt', encoding='utf-8') as f:
+            config, body, token_counts, _ = parse_context(f.read())
+        return config, body, token_counts
+
+    def search(self, text):
+        """
+        Returns: the entries whose name or query words match every word of text, newest first
+        """
+        from example_index import get_terms
+
+        words = get_terms(text)
+        matches = []
+        for entry in self.entries():
+            name = entry['name'].lower()
+            if all(word in name or any(term.startswith(word) for term in entry['terms']) for word in words):
+                matches.append(entry)
+        return matches
+
+    def import_deleted(self, count_interactions, deleted_path=DELETED_LOCATION):
+        """
+        Move the plain text copies earlier versions wrote to deleted/ into the archive,
+        count_interactions adds the token counts to (query, completion) pairs
+        """
+        from context_store import parse_interactions
+
+        if not os.path.isdir(deleted_path):
+            return
+        for file_name in sorted(os.listdir(deleted_path)):
+            path = os.path.join(deleted_path, file_name)
+            if not file_name.endswith('.txt') or not os.path.isfile(path):
+                continue
+            with open(path, 'r') as f:
+                interactions = count_interactions(parse_interactions(f.read()))
+            self.add(file_name[:-len('.txt')], CLEARED, {}, interactions, os.path.getmtime(path))
+            os.remove(path)
+
+def show_entries(entries, title):
+    """
+    Print archive entries, one per line
+    """
+    if len(entries) == 0:
+        print('\n#   {}: none'.format(title))
+        return
+    lines = ['# {}:\n'.format(title)]
+    for entry in entries:
+        lines.append('# {:<8}{:<12}{:>8} tokens {:>5} turns  {}  {}\n'.format(
+            entry['kind'], entry['shell'] or '-', entry['token_count'], entry['interactions'],
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['time'])), entry['name']))
+    print('\n')
+    print(''.join(lines))
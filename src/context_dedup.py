@@ -0,0 +1,69 @@
+import re
+import random
+import hashlib
+
+# The same question asked again, or asked another way, used to add another interaction to the
+# multi-turn context each time, until the repeats filled the context window. Every interaction
+# now gets a signature: a hash of its normalized command (lower case, numbers and quoted strings
+# replaced, whitespace collapsed) and a MinHash of the word pairs of its query and command.
+# Two interactions are near duplicates if their commands normalize to the same text or if their
+# estimated word pair similarity reaches DUPLICATE_SIMILARITY, and only the most recent one is kept.
+
+NUM_HASHES = 16
+DUPLICATE_SIMILARITY = 0.8
+
+NUMBER = re.compile(r'\d+')
+QUOTED = re.compile(r'"[^"\n]*"|\'[^\'\n]*\'')
+WHITESPACE = re.compile(r'\s+')
+
+# 2^61 - 1, a prime larger than the 32 bit shingle hashes
+PRIME = (1 << 61) - 1
+# fixed, the signatures are stored in the context log and compared across processes
+_generator = random.Random(1729)
+PERMUTATIONS = [(_generator.randrange(1, PRIME), _generator.randrange(PRIME)) for _ in range(NUM_HASHES)]
+
+def normalize(text):
+    """
+    Returns: text in lower case with numbers and quoted strings replaced and whitespace collapsed
+    """
+    text = QUOTED.sub("''", text.lower())
+    text = NUMBER.sub('0', text)
+    return WHITESPACE.sub(' ', text).strip()
+
+def get_signature(query, completion):
+    """
+    Returns: the signature of an interaction, a dictionary stored with it in the context log
+    """
+    command = normalize(completion)
+    words = normalize(query.replace('#', ' ') + ' ' + completion).split(' ')
+    shingles = set(' '.join(words[i:i + 2]) for i in range(max(len(words) - 1, 1)))
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little') for shingle in shingles]
+    return {
+        'command': hashlib.sha1(command.encode('utf-8')).hexdigest()[:16] if command != '' else None,
+        'minhash': [min((a * value + b) % PRIME for value in hashes) & 0xffffffff for a, b in PERMUTATIONS],
+    }
+
+def is_duplicate(signature, other):
+    """
+    Returns: True if the two signatures belong to near duplicate interactions
+    """
+    if signature['command'] is not None and signature['command'] == other['command']:
+        return True
+    same = sum(1 for a, b in zip(signature['minhash'], other['minhash']) if a == b)
+    return same >= DUPLICATE_SIMILARITY * NUM_HASHES
+
+def find_duplicates(signatures, last_only=False):
+    """
+    signatures of the interactions, oldest first, last_only only looks for duplicates of the last one
+
+    Returns: the positions of the interactions with a more recent near duplicate
+    """
+    kept = []
+    duplicates = []
+    for position in range(len(signatures) - 1, -1, -1):
+        signature = signatures[position]
+        if any(is_duplicate(signature, other) for other in kept):
+            duplicates.append(position)
+        elif not last_only or len(kept) == 0:
+            kept.append(signature)
+    return sorted(duplicates)
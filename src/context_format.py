@@ -0,0 +1,117 @@
+import os
+
+# Context files (contexts/*.txt and current_context.config) share one format:
+#
+# ## codex-cli-context: 2
+# ## engine: code-cushman-001
+# ## temperature: 0
+# ...
+# ## token_counts: 21 17 30
+#
+# # what's my IP?
+# curl ifconfig.me
+#
+# Every header is a "## key: value" line, the body holds the example interactions.
+# Version 1 files have the six config lines below in this fixed order.
+FORMAT_VERSION = 2
+VERSION_KEY = 'codex-cli-context'
+V1_KEYS = ['engine', 'temperature', 'max_tokens', 'shell', 'multi_turn', 'token_count']
+
+# config values that are not strings
+CONFIG_TYPES = {
+    'temperature': float,
+    'max_tokens': int,
+    'token_count': int,
+    'examples': int,
+    'deadline': int,
+    'candidates': int,
+}
+
+def parse_value(key, value):
+    value = value.strip()
+    if key == 'token_counts':
+        return [int(count) for count in value.split()]
+    return CONFIG_TYPES.get(key, str)(value)
+
+def parse_context(text):
+    """
+    Parse a context file of any version
+
+    Returns: a tuple of (config, body, token_counts, version)
+    token_counts is None if the file does not hold them
+    """
+    lines = text.splitlines(True)
+
+    config = {}
+    token_counts = None
+    version = 1
+    header_size = 0
+
+    if len(lines) > 0 and lines[0].startswith('## {}:'.format(VERSION_KEY)):
+        version = int(lines[0].split(':', 1)[1])
+        header_size = 1
+        for line in lines[1:]:
+            if not line.startswith('## '):
+                break
+            key, _, value = line[3:].partition(':')
+            key = key.strip()
+            if key == 'token_counts':
+                token_counts = parse_value(key, value)
+            else:
+                config[key] = parse_value(key, value)
+            header_size += 1
+    else:
+        # version 1: six positional lines, with a "## " prefix in saved contexts
+        for key, line in zip(V1_KEYS, lines[:len(V1_KEYS)]):
+            config[key] = parse_value(key, line.split(':', 1)[1])
+        header_size = len(V1_KEYS)
+
+    # the blank line separating the headers from the body is not part of the body
+    if header_size < len(lines) and lines[header_size].strip() == '':
+        header_size += 1
+
+    return config, ''.join(lines[header_size:]), token_counts, version
+
+def serialize_context(config, body='', token_counts=None):
+    """
+    Returns: the text of a context file in the current format
+    """
+    lines = ['## {}: {}\n'.format(VERSION_KEY, FORMAT_VERSION)]
+    for key, value in config.items():
+        lines.append('## {}: {}\n'.format(key, value))
+    if token_counts is not None:
+        lines.append('## token_counts: {}\n'.format(' '.join(str(count) for count in token_counts)))
+    if body != '':
+        lines.append('\n')
+        lines.append(body)
+    return ''.join(lines)
+
+def read_context_file(path):
+    """
+    Read a context file, version 1 files are migrated to the current format in place
+
+    Returns: a tuple of (config, body, token_counts)
+    """
+    with open(path, 'r') as f:
+        config, body, token_counts, version = parse_context(f.read())
+
+    if version < FORMAT_VERSION:
+        write_context_file(path, config, body, token_counts)
+
+    return config, body, token_counts
+
+def write_context_file(path, config, body='', token_counts=None):
+    """
+    Atomically replace the context file: write a temp file, fsync it and rename it over the old one
+    """
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(serialize_context(config, body, token_counts))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
@@ -0,0 +1,449 @@
+import os
+import time
+import struct
+import threading
+
+# json (and the re module it loads) is imported when the log is read or written, this module
+# is loaded on the startup path of every command
+
+# index file layout: a header with the format, the generation of the log, the first live entry and
+# the live token count, followed by one fixed size record per entry: its log offset, its token count
+# and its near duplicate signature (see context_dedup.py), whether it has a command, the command hash
+# and the 16 (NUM_HASHES) MinHash values, so that duplicates are found without reading the log
+INDEX_FORMAT = b'codexix2'
+HEADER = struct.Struct('<8sQQQ')
+RECORD = struct.Struct('<QI?8s16I')
+
+# indexes written by earlier versions: the first live entry and the live token count,
+# then (log offset, token count) per entry, the signatures were stored in the log
+LEGACY_HEADER = struct.Struct('<QQ')
+LEGACY_RECORD = struct.Struct('<QI')
+
+# the log is compacted once more than half of it, and at least this many entries, have been trimmed
+COMPACT_MIN_ENTRIES = 64
+
+# the lock file holds a sequence number, odd while a mutation is in progress
+SEQUENCE = struct.Struct('<Q')
+# lock-free reads are retried this many times (1 ms apart) before falling back to the lock
+SNAPSHOT_RETRIES = 50
+
+def parse_interactions(text):
+    """
+    Split a context (e.g. contexts/bash-context.txt) into (query, completion) pairs
+    An interaction starts at a comment line that follows a non comment line
+
+    Returns: a list of (query, completion) tuples, query + completion gives back the text
+    """
+    interactions = []
+    query = ''
+    completion = ''
+    for line in text.splitlines(True):
+        is_comment = line.lstrip().startswith('#')
+        if is_comment and completion.strip() != '':
+            interactions.append((query, completion))
+            query = ''
+            completion = ''
+        if is_comment and completion == '':
+            query += line
+        else:
+            completion += line
+    if query != '' or completion != '':
+        interactions.append((query, completion))
+    return interactions
+
+class StoreLock:
+    """
+    Advisory lock held by every mutation of a store (and of its config), shared by all the processes
+    using it and reentrant within a process. Where fcntl is not available only the threads are serialized.
+
+    The lock file also works as a sequence lock: a mutation makes the sequence odd and bumps it
+    back to even when done, readers take a consistent snapshot without locking by retrying
+    until the sequence is even and unchanged around their read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+
+    def sequence(self):
+        """
+        Returns: the current sequence number, 0 for a new lock file
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read(SEQUENCE.size)
+        except OSError:
+            return 0
+        return SEQUENCE.unpack(data)[0] if len(data) == SEQUENCE.size else 0
+
+    def _write_sequence(self, sequence):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, SEQUENCE.pack(sequence))
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.depth += 1
+        if self.depth > 1:
+            return self
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            import fcntl
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        # a writer that died mid-mutation leaves the sequence odd, it stays odd until this one is done
+        sequence = self.sequence()
+        self.sequence_end = sequence + 2 if sequence % 2 == 0 else sequence + 1
+        self._write_sequence(self.sequence_end - 1)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.depth -= 1
+            if self.depth == 0:
+                self._write_sequence(self.sequence_end)
+                # closing the descriptor releases the flock
+                os.close(self.fd)
+        finally:
+            self.thread_lock.release()
+
+class ContextStore:
+    """
+    Append-only log of the multi-turn interactions with an offset index
+    Appending, trimming from the front and undoing the last interaction never rewrite the log
+    Mutations hold the store lock, reads are lock-free snapshots (see StoreLock)
+
+    A rewrite (reset, compaction, duplicate removal) writes the log of the next generation next to
+    the current one and then replaces the index, which names the generation of its log, so the
+    index and the log are swapped in a single rename and a crash leaves either the old or the new store
+    """
+
+    def __init__(self, log_path, index_path):
+        self.log_path = log_path
+        self.index_path = index_path
+        self.lock = StoreLock(log_path + '.lock')
+        if not self._is_current():
+            with self.lock:
+                if not self._is_current():
+                    self._upgrade()
+
+    def get_log_path(self, generation):
+        """
+        Returns: the path of the log of a generation, log_path itself for the first one
+        """
+        return self.log_path if generation == 0 else '{}.{}'.format(self.log_path, generation)
+
+    def _read_generation(self):
+        """
+        Returns: the generation of the store, -1 if there is no index in the current format
+        """
+        try:
+            with open(self.index_path, 'rb') as index:
+                return self._read_header(index)[0]
+        except (OSError, ValueError, struct.error):
+            return -1
+
+    def _is_current(self):
+        generation = self._read_generation()
+        return generation >= 0 and os.path.isfile(self.get_log_path(generation))
+
+    def _upgrade(self):
+        """
+        Rewrite the live entries of a store of an earlier version in the current format,
+        or create an empty store
+        """
+        import json
+
+        entries = []
+        if os.path.isfile(self.log_path):
+            try:
+                with open(self.index_path, 'rb') as index:
+                    head, _ = LEGACY_HEADER.unpack(index.read(LEGACY_HEADER.size))
+                    index.seek(LEGACY_HEADER.size + head * LEGACY_RECORD.size)
+                    record = index.read(LEGACY_RECORD.size)
+                # every entry was trimmed if there is no record at the head
+                offset = LEGACY_RECORD.unpack(record)[0] if len(record) == LEGACY_RECORD.size else None
+            except (OSError, struct.error):
+                offset = 0
+            if offset is not None:
+                with open(self.log_path, 'rb') as log:
+                    log.seek(offset)
+                    entries = [json.loads(line.decode('utf-8')) for line in log.read().splitlines()]
+        self._rewrite([(entry['query'], entry['completion'], entry['tokens'], entry.get('signature')) for entry in entries])
+
+    def snapshot(self, read):
+        """
+        Run read() without taking the lock, again until no mutation overlapped it
+
+        Returns: the result of read()
+        """
+        for _ in range(SNAPSHOT_RETRIES):
+            before = self.lock.sequence()
+            if before % 2 == 0:
+                try:
+                    result = read()
+                    if self.lock.sequence() == before:
+                        return result
+                except (OSError, ValueError, KeyError, struct.error):
+                    # torn read of files being rewritten
+                    pass
+            time.sleep(0.001)
+
+        # a mutation is slow or its process died, wait for the lock instead
+        with self.lock:
+            return read()
+
+    def _read_header(self, f):
+        """
+        Returns: the (generation, first live entry, live token count) of an index
+        """
+        f.seek(0)
+        index_format, generation, head, total_tokens = HEADER.unpack(f.read(HEADER.size))
+        if index_format != INDEX_FORMAT:
+            raise ValueError('Unknown context index format')
+        return generation, head, total_tokens
+
+    def _write_header(self, f, generation, head, total_tokens):
+        f.seek(0)
+        f.write(HEADER.pack(INDEX_FORMAT, generation, head, total_tokens))
+
+    def _read_record(self, f, position):
+        """
+        Returns: the (log offset, token count) of an entry
+        """
+        f.seek(HEADER.size + position * RECORD.size)
+        return RECORD.unpack(f.read(RECORD.size))[:2]
+
+    def _read_signatures(self, f, first, count):
+        """
+        Returns: the signatures of the entries from first to count
+        """
+        f.seek(HEADER.size + first * RECORD.size)
+        data = f.read((count - first) * RECORD.size)
+        signatures = []
+        for _, _, has_command, command, *minhash in RECORD.iter_unpack(data):
+            signatures.append({'command': command.hex() if has_command else None, 'minhash': minhash})
+        return signatures
+
+    def _count(self, f):
+        f.seek(0, os.SEEK_END)
+        return (f.tell() - HEADER.size) // RECORD.size
+
+    @staticmethod
+    def _encode(query, completion, tokens):
+        """
+        Returns: the log line of an interaction
+        """
+        import json
+
+        return (json.dumps({'query': query, 'completion': completion, 'tokens': tokens}) + '\n').encode('utf-8')
+
+    @staticmethod
+    def _pack_record(offset, tokens, signature):
+        command = signature['command']
+        return RECORD.pack(offset, tokens, command is not None, bytes.fromhex(command) if command is not None else bytes(8), *signature['minhash'])
+
+    def _rewrite(self, interactions):
+        """
+        Replace the store with (query, completion, tokens, signature) interactions, a signature of None
+        is computed, the log of the next generation is written first and the index is swapped atomically
+        """
+        from context_dedup import get_signature
+
+        generation = self._read_generation()
+        if generation < 0 and os.path.isfile(self.log_path):
+            # the log of an earlier version is replaced like a generation of its own
+            generation = 0
+        log_path = self.get_log_path(generation + 1)
+        index_path = self.index_path + '.tmp'
+        offset = 0
+        records = []
+        total_tokens = 0
+        with open(log_path, 'wb') as log:
+            for query, completion, tokens, signature in interactions:
+                data = self._encode(query, completion, tokens)
+                log.write(data)
+                records.append(self._pack_record(offset, tokens, signature or get_signature(query, completion)))
+                offset += len(data)
+                total_tokens += tokens
+        with open(index_path, 'wb') as index:
+            index.write(HEADER.pack(INDEX_FORMAT, generation + 1, 0, total_tokens))
+            index.writelines(records)
+        os.replace(index_path, self.index_path)
+
+        if generation >= 0:
+            try:
+                os.remove(self.get_log_path(generation))
+            except OSError:
+                pass
+
+    def reset(self, interactions=()):
+        """
+        Replace the whole store with the given (query, completion, tokens) interactions
+        """
+        interactions = [(query, completion, tokens, None) for query, completion, tokens in interactions]
+        with self.lock:
+            self._rewrite(interactions)
+
+    def append(self, query, completion, tokens):
+        """
+        Append an interaction, O(1)
+        """
+        from context_dedup import get_signature
+
+        data = self._encode(query, completion, tokens)
+        signature = get_signature(query, completion)
+        with self.lock:
+            with open(self.index_path, 'r+b') as index:
+                generation, head, total_tokens = self._read_header(index)
+                with open(self.get_log_path(generation), 'ab') as log:
+                    offset = log.tell()
+                    log.write(data)
+                index.seek(0, os.SEEK_END)
+                index.write(self._pack_record(offset, tokens, signature))
+                self._write_header(index, generation, head, total_tokens + tokens)
+
+    def __len__(self):
+        def read():
+            with open(self.index_path, 'rb') as index:
+                _, head, _ = self._read_header(index)
+                return self._count(index) - head
+        return self.snapshot(read)
+
+    def token_count(self):
+        """
+        Returns: the token count of the live interactions, O(1)
+        """
+        def read():
+            with open(self.index_path, 'rb') as index:
+                return self._read_header(index)[2]
+        return self.snapshot(read)
+
+    def trim(self, budget):
+        """
+        Drop whole interactions from the front until the live token count fits the budget
+        Only the index header is rewritten, the log is compacted once mostly dead
+
+        Returns: the live token count
+        """
+        # most turns fit, they do not need the lock
+        total_tokens = self.token_count()
+        if total_tokens <= budget:
+            return total_tokens
+
+        with self.lock:
+            with open(self.index_path, 'r+b') as index:
+                generation, head, total_tokens = self._read_header(index)
+                count = self._count(index)
+                if total_tokens <= budget:
+                    return total_tokens
+                while head < count and total_tokens > budget:
+                    total_tokens -= self._read_record(index, head)[1]
+                    head += 1
+                self._write_header(index, generation, head, total_tokens)
+
+            if head >= COMPACT_MIN_ENTRIES and head * 2 >= count:
+                self.compact()
+        return total_tokens
+
+    def pop(self):
+        """
+        Undo the last interaction by truncating the log and the index
+
+        Returns: the removed (query, completion) or None if the store is empty
+        """
+        import json
+
+        with self.lock:
+            with open(self.index_path, 'r+b') as index:
+                generation, head, total_tokens = self._read_header(index)
+                count = self._count(index)
+                if count <= head:
+                    return None
+                offset, tokens = self._read_record(index, count - 1)
+                index.truncate(HEADER.size + (count - 1) * RECORD.size)
+                self._write_header(index, generation, head, total_tokens - tokens)
+
+            with open(self.get_log_path(generation), 'r+b') as log:
+                log.seek(offset)
+                entry = json.loads(log.readline().decode('utf-8'))
+                log.truncate(offset)
+        return entry['query'], entry['completion']
+
+    def _entries(self, n):
+        """
+        Returns: the log entries (dictionaries) of the last n live interactions, all of them if n is None
+        """
+        import json
+
+        with open(self.index_path, 'rb') as index:
+            generation, head, _ = self._read_header(index)
+            count = self._count(index)
+            first = head if n is None else max(head, count - n)
+            if first >= count:
+                return []
+            offset = self._read_record(index, first)[0]
+
+        with open(self.get_log_path(generation), 'rb') as log:
+            log.seek(offset)
+            return [json.loads(line.decode('utf-8')) for line in log.read().splitlines()[:count - first]]
+
+    def _tail(self, n):
+        return [(entry['query'], entry['completion'], entry['tokens']) for entry in self._entries(n)]
+
+    def tail(self, n=None):
+        """
+        Read the last n live interactions (all of them if n is None) with a single seek
+
+        Returns: a list of (query, completion, tokens) tuples
+        """
+        return self.snapshot(lambda: self._tail(n))
+
+    def holds(self, interactions):
+        """
+        Returns: True if the live interactions are the given (query, completion) pairs, in order
+        """
+        return [(query, completion) for query, completion, _ in self.tail()] == [tuple(interaction[:2]) for interaction in interactions]
+
+    def render(self, n=None):
+        """
+        Returns: the live interactions as prompt text
+        """
+        return ''.join(query + completion for query, completion, _ in self.tail(n))
+
+    def _live_signatures(self):
+        with open(self.index_path, 'rb') as index:
+            _, head, _ = self._read_header(index)
+            return self._read_signatures(index, head, self._count(index))
+
+    def compact(self):
+        """
+        Rewrite the log without the trimmed interactions
+        """
+        with self.lock:
+            entries = self._entries(None)
+            signatures = self._live_signatures()
+            self._rewrite([(entry['query'], entry['completion'], entry['tokens'], signature) for entry, signature in zip(entries, signatures)])
+
+    def drop_duplicates(self, last_only=False):
+        """
+        Remove the live interactions that have a more recent near duplicate, see context_dedup.py
+        last_only only compares the last interaction with the others, enough after every append
+        The signatures are read from the index, the log is only read and rewritten if there is something to remove
+
+        Returns: the removed (query, completion, tokens) interactions
+        """
+        from context_dedup import find_duplicates
+
+        with self.lock:
+            signatures = self._live_signatures()
+            positions = find_duplicates(signatures, last_only)
+            if len(positions) == 0:
+                return []
+            entries = self._entries(None)
+            removed = set(positions)
+            self._rewrite([(entry['query'], entry['completion'], entry['tokens'], signature)
+                           for position, (entry, signature) in enumerate(zip(entries, signatures)) if position not in removed])
+        return [(entries[position]['query'], entries[position]['completion'], entries[position]['tokens']) for position in positions]
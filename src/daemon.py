@@ -0,0 +1,269 @@
+import os
+import sys
+import stat
+import codecs
+import socket
+
+# this module is imported by the thin client on every key press, so the
+# server-only modules (socketserver, subprocess, threading, contextvars) and json, which the
+# one-shot path without a server does not need, are imported lazily
+#
+# The socket lives in a directory only the current user can enter, and both ends check that the
+# process on the other side runs as the same user where the platform tells (SO_PEERCRED), so
+# another local user can neither read the queries nor answer them.
+
+# the server shuts itself down after this many seconds without a request
+IDLE_TIMEOUT = 30 * 60
+# seconds between two checks of the idle timeout and of a stop request
+POLL_INTERVAL = 0.5
+
+# seconds the client waits for the server before falling back to the one-shot path
+CONNECT_TIMEOUT = 0.5
+
+CODEX_QUERY_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'codex_query.py')
+
+
+def is_private(path):
+    """
+    Returns: True if path is a directory (not a link) of the current user that nobody else may enter
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and info.st_mode & 0o077 == 0
+
+def get_socket_path(name='server.sock'):
+    """
+    Per-user location of the completion server socket (or of another socket of the user, e.g. the
+    local API proxy), in a private directory created on first use
+
+    Returns: None if the directory cannot be created or another user could get into it
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+    directory = os.path.join(runtime_dir, 'codex-cli-{}'.format(os.getuid()))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return None
+    if not is_private(directory):
+        return None
+    return os.path.join(directory, name)
+
+def get_peer_uid(s):
+    """
+    Returns: the uid of the process at the other end of a connected Unix socket, None if the platform does not tell
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    import struct
+    _, uid, _ = struct.unpack('3i', s.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+def is_same_user(s):
+    uid = get_peer_uid(s)
+    return uid is None or uid == os.getuid()
+
+def is_supported():
+    """
+    Unix sockets are not available on every platform (e.g. older Windows builds)
+    """
+    return hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid')
+
+def is_enabled():
+    """
+    The server can be turned off with CODEX_CLI_DAEMON=off
+    """
+    return is_supported() and os.environ.get('CODEX_CLI_DAEMON', 'on') != 'off'
+
+
+def _create_server(socket_path, handler):
+    """
+    Build the socket server, the handler prints its result and
+    the output is streamed back to the client
+    """
+    import json
+    import time
+    import threading
+    import contextvars
+    import socketserver
+
+    # the client of the request being answered by the current thread
+    output = contextvars.ContextVar('output', default=None)
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        """
+        Reads one JSON request line and streams everything the handler prints back to the client
+        Each request runs in its own thread
+        """
+        def handle(self):
+            if not is_same_user(self.connection):
+                return
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+            except ValueError:
+                return
+
+            if request.get('command') == 'stop':
+                self.server.stopped = True
+                return
+
+            with self.server.active_lock:
+                self.server.active += 1
+            output.set(TextWriter(self.wfile))
+            try:
+                self.server.handler(request)
+            except SystemExit:
+                pass
+            finally:
+                with self.server.active_lock:
+                    self.server.active -= 1
+                    self.server.last_request = time.time()
+            sys.stdout.flush()
+
+    class RequestOutput:
+        """
+        sys.stdout of the server, what a request prints goes to its own client,
+        the threads working for a request inherit its output with metrics.bind
+        """
+        encoding = 'utf-8'
+
+        def __init__(self, default):
+            self.default = default
+
+        def write(self, text):
+            return (output.get() or self.default).write(text)
+
+        def flush(self):
+            (output.get() or self.default).flush()
+
+    class TextWriter:
+        """
+        Minimal text wrapper around the binary socket stream
+        """
+        encoding = 'utf-8'
+
+        def __init__(self, stream):
+            self.stream = stream
+
+        def write(self, text):
+            self.stream.write(text.encode('utf-8'))
+            return len(text)
+
+        def flush(self):
+            self.stream.flush()
+
+    class CompletionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        # a slow completion in one terminal does not hold up the others
+        daemon_threads = True
+        timeout = POLL_INTERVAL
+        stopped = False
+
+        def __init__(self, socket_path, handler):
+            self.handler = handler
+            self.active = 0
+            self.active_lock = threading.Lock()
+            self.last_request = time.time()
+            super().__init__(socket_path, RequestHandler)
+
+        def is_idle(self):
+            with self.active_lock:
+                return self.active == 0 and time.time() - self.last_request > IDLE_TIMEOUT
+
+    sys.stdout = RequestOutput(sys.stdout)
+    return CompletionServer(socket_path, handler)
+
+def remove_stale_socket(socket_path):
+    """
+    Remove a socket left behind by a server that did not shut down cleanly
+
+    Returns: False if a live server is already listening on the socket
+    """
+    if not os.path.exists(socket_path):
+        return True
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socket_path)
+        return False
+    except OSError:
+        os.unlink(socket_path)
+        return True
+
+def serve(handler, socket_path=None):
+    """
+    Serve completion requests on the per-user socket until idle or stopped
+    handler(request) prints its result, the output is streamed back to the client,
+    it is called concurrently for requests of different clients
+    """
+    socket_path = socket_path or get_socket_path()
+    if socket_path is None or not remove_stale_socket(socket_path):
+        return
+
+    # only the current user may connect to the socket
+    old_umask = os.umask(0o077)
+    try:
+        server = _create_server(socket_path, handler)
+    except OSError:
+        # another server won the race for the socket
+        return
+    finally:
+        os.umask(old_umask)
+
+    try:
+        while not server.stopped and not server.is_idle():
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def spawn_server():
+    """
+    Start the completion server in the background, detached from the calling shell
+    """
+    import subprocess
+
+    subprocess.Popen(
+        [sys.executable, CODEX_QUERY_PATH, '--server'],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        start_new_session=True)
+
+def send_request(request, output, socket_path=None):
+    """
+    Send a request to the completion server and copy its response into output
+
+    Returns: False if no server is listening
+    """
+    import json
+
+    socket_path = socket_path or get_socket_path()
+    if socket_path is None:
+        return False
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(CONNECT_TIMEOUT)
+        s.connect(socket_path)
+    except OSError:
+        s.close()
+        return False
+    if not is_same_user(s):
+        s.close()
+        return False
+
+    with s:
+        s.settimeout(None)
+        s.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        s.shutdown(socket.SHUT_WR)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            chunk = s.recv(4096)
+            output.write(decoder.decode(chunk, final=not chunk))
+            output.flush()
+            if not chunk:
+                break
+    return True
@@ -0,0 +1,115 @@
+import time
+
+# single: one request to the engine of the config
+# latency: every engine is queried at once, the first acceptable candidate wins
+# quality: every candidate of every engine is collected, deduplicated and ranked by mean logprob
+MODES = ['single', 'latency', 'quality']
+
+def get_engines(config):
+    """
+    Returns: the engines to query, the "engines" config is a comma separated list
+    """
+    engines = [engine.strip() for engine in str(config.get('engines', '')).split(',') if engine.strip() != '']
+    return engines if len(engines) > 0 else [config['engine']]
+
+def is_racing(config):
+    """
+    Returns: True if the query should fan out to several engines or candidates
+    """
+    return config.get('mode', 'single') != 'single' and (len(get_engines(config)) > 1 or int(config.get('candidates', 1)) > 1)
+
+def get_cache_engine(config):
+    """
+    Returns: the engine part of the completion cache key, a race gives other answers than a single engine
+    """
+    return '{}:{}:{}'.format(config['mode'], ','.join(get_engines(config)), config.get('candidates', 1))
+
+def mean_logprob(choice):
+    """
+    Returns: the average token logprob of a choice, -inf if the engine did not return them
+    """
+    logprobs = choice.get('logprobs') or {}
+    tokens = [logprob for logprob in logprobs.get('token_logprobs') or [] if logprob is not None]
+    return sum(tokens) / len(tokens) if len(tokens) > 0 else float('-inf')
+
+def normalize(text):
+    return ' '.join(text.split())
+
+def request_candidates(engine, prompt, config, stop, deadline, backend=None):
+    """
+    Returns: the (engine, text, mean logprob) candidates of one engine of the backend
+    """
+    from openai_client import create_completion
+
+    options = {}
+    if config['mode'] == 'quality':
+        options['logprobs'] = 1
+    response = create_completion(
+        engine=engine,
+        prompt=prompt,
+        temperature=config['temperature'],
+        max_tokens=config['max_tokens'],
+        stop=stop,
+        n=int(config.get('candidates', 1)),
+        deadline=deadline,
+        backend=backend,
+        **options)
+    return [(engine, choice['text'], mean_logprob(choice)) for choice in response['choices']]
+
+def race(prompt, config, screen, stop, deadline=None, backend=None):
+    """
+    Query every engine of the backend concurrently for the configured number of candidates,
+    each candidate goes through the content filter as soon as it arrives
+
+    Returns: the (engine, completion) of the chosen candidate, or None if every candidate was flagged
+    Raises the error of the engines if none answered, openai.error.Timeout once past the deadline
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+    from content_filter import run_async
+
+    requests = [run_async(request_candidates, engine, prompt, config, stop, deadline, backend) for engine in get_engines(config)]
+
+    # (engine, text, mean logprob, future verdict) in arrival order
+    candidates = []
+    errors = []
+    pending = set(requests)
+    while len(pending) > 0:
+        done, pending = wait(pending, timeout=None if deadline is None else max(deadline - time.time(), 0), return_when=FIRST_COMPLETED)
+        if len(done) == 0:
+            break
+
+        arrived = []
+        for request in done:
+            if request.exception() is not None:
+                errors.append(request.exception())
+                continue
+            for engine, text, logprob in request.result():
+                if text.strip() != '':
+                    arrived.append((engine, text, logprob, screen.check_candidate(text)))
+        candidates.extend(arrived)
+
+        if config['mode'] == 'latency':
+            for engine, text, _, verdict in sorted(arrived, key=lambda candidate: -candidate[2]):
+                if not screen.candidate_flagged(verdict, deadline):
+                    return engine, text
+
+    if config['mode'] == 'quality':
+        # duplicates keep their best logprob, the best ranked acceptable candidate wins
+        best = {}
+        for candidate in candidates:
+            key = normalize(candidate[1])
+            if key not in best or candidate[2] > best[key][2]:
+                best[key] = candidate
+        for engine, text, _, verdict in sorted(best.values(), key=lambda candidate: -candidate[2]):
+            if not screen.candidate_flagged(verdict, deadline):
+                return engine, text
+
+    if len(candidates) > 0:
+        return None
+    if len(pending) > 0:
+        import openai
+        raise openai.error.Timeout('Request deadline exceeded')
+    if len(errors) > 0:
+        raise errors[0]
+    # every engine answered with an empty completion
+    return get_engines(config)[0], ''
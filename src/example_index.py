@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import math
+
+from tokenizer import count_tokens
+from context_store import parse_interactions
+from context_format import read_context_file
+from context_archive import ContextArchive, ARCHIVE_LOCATION, SAVED
+
+CONTEXTS_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "contexts")
+
+# cached parse of every context file, only files that changed since the last build are parsed again
+INDEX_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "example_index.json")
+INDEX_VERSION = 1
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+TERM_PATTERN = re.compile(r'[a-z0-9]+')
+
+def get_terms(text):
+    return TERM_PATTERN.findall(text.lower())
+
+class ExampleIndex:
+    """
+    BM25 index over the query/command examples of every saved context of a shell,
+    the context files and the contexts saved to the archive
+    """
+
+    def __init__(self, shell, engine, contexts_path=CONTEXTS_LOCATION, index_path=INDEX_LOCATION, archive_path=ARCHIVE_LOCATION):
+        self.shell = shell
+        self.engine = engine
+        self.contexts_path = contexts_path
+        self.archive_path = archive_path
+        self.index_path = index_path
+        self.files = {}
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION:
+                self.files = index['files']
+
+    def save(self):
+        temp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'files': self.files}, f)
+        os.replace(temp_path, self.index_path)
+
+    def update(self):
+        """
+        Parse the context files added or changed since the last build and forget deleted ones
+
+        Returns: True if the index changed
+        """
+        changed = False
+        names = set(name for name in os.listdir(self.contexts_path) if name.endswith('.txt'))
+        # archived contexts are keyed by their file in the archive, they never change once written
+        archive = ContextArchive(self.archive_path)
+        saved = {'archive/' + entry['file']: entry for entry in archive.entries(SAVED)}
+        names.update(saved)
+
+        for name in list(self.files):
+            if name not in names:
+                del self.files[name]
+                changed = True
+
+        for name in names:
+            if name in saved:
+                if name in self.files:
+                    continue
+                config, body, token_counts = archive.read(saved[name])
+                mtime, size = saved[name]['time'], saved[name]['size']
+            else:
+                path = os.path.join(self.contexts_path, name)
+                stat = os.stat(path)
+                entry = self.files.get(name)
+                if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                    continue
+
+                config, body, token_counts = read_context_file(path)
+                # the migration in read_context_file may have rewritten the file
+                stat = os.stat(path)
+                mtime, size = stat.st_mtime, stat.st_size
+
+            interactions = parse_interactions(body)
+            if token_counts is None or len(token_counts) != len(interactions):
+                token_counts = [count_tokens(query + completion, self.engine) for query, completion in interactions]
+
+            self.files[name] = {
+                'mtime': mtime,
+                'size': size,
+                'shell': config.get('shell', ''),
+                'examples': [[query, completion, tokens] for (query, completion), tokens in zip(interactions, token_counts)]
+            }
+            changed = True
+
+        if changed:
+            self.save()
+        return changed
+
+    def examples(self):
+        """
+        Returns: the (query, completion, tokens) examples of every context of the shell
+        """
+        examples = []
+        for name in sorted(self.files):
+            if self.files[name]['shell'] == self.shell:
+                examples.extend(tuple(example) for example in self.files[name]['examples'])
+        return examples
+
+    def select(self, input, budget, history=(), k=8):
+        """
+        Rank the examples and the multi-turn history against the input with BM25
+        and pick the k best that fit the token budget
+
+        Returns: the selected (query, completion, tokens) examples, least relevant first
+        so that the most relevant ones end up right before the input
+        """
+        documents = []
+        seen = set()
+        for query, completion, tokens in list(self.examples()) + list(history):
+            key = (query.strip(), completion.strip())
+            if key not in seen and completion.strip() != '':
+                seen.add(key)
+                documents.append((query, completion, tokens, get_terms(query + ' ' + completion)))
+
+        if len(documents) == 0:
+            return []
+
+        average_length = sum(len(terms) for _, _, _, terms in documents) / len(documents)
+        document_frequency = {}
+        for _, _, _, terms in documents:
+            for term in set(terms):
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+
+        query_terms = set(get_terms(input))
+        scored = []
+        for position, (query, completion, tokens, terms) in enumerate(documents):
+            score = 0.0
+            for term in query_terms:
+                frequency = terms.count(term)
+                if frequency == 0:
+                    continue
+                idf = math.log(1 + (len(documents) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                score += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * len(terms) / average_length))
+            scored.append((score, position, (query, completion, tokens)))
+
+        # best first, ties keep the original order
+        scored.sort(key=lambda item: (-item[0], item[1]))
+
+        selected = []
+        for score, _, example in scored:
+            if len(selected) >= k:
+                break
+            if example[2] <= budget:
+                selected.append(example)
+                budget -= example[2]
+        selected.reverse()
+        return selected
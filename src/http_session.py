@@ -0,0 +1,193 @@
+import time
+import socket
+import threading
+
+import requests
+import urllib3
+
+# openai 0.x keeps one requests session per thread and create_completion runs each call in its own
+# thread, so every completion and content filter request used to open a new TCP and TLS connection.
+# All the requests of a process now share the pooled keep-alive connections of one session, the
+# host names they connect to are resolved once per DNS_TTL, and the completion server (and the local
+# proxy, see api_proxy.py) keep the connections warm between queries. requests only speaks HTTP/1.1,
+# connections are reused instead of multiplexed.
+
+# connections kept open per host, e.g. the racing engines and the content filter in parallel
+POOL_SIZE = 10
+# seconds a resolved address is reused
+DNS_TTL = 300
+
+_session = None
+_session_lock = threading.Lock()
+
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+
+def configure(section):
+    """
+    Apply the pool_size of the [client] section of openaiapirc
+    """
+    global POOL_SIZE
+    POOL_SIZE = int(section.get('pool_size', POOL_SIZE))
+
+def resolve(host, port):
+    """
+    Returns: an address of host resolved by this process in the last DNS_TTL seconds,
+    host itself if it cannot be resolved, the connection then reports the error
+    """
+    key = (host, port)
+    with _dns_cache_lock:
+        cached = _dns_cache.get(key)
+    if cached is not None and time.time() - cached[0] < DNS_TTL:
+        return cached[1]
+    try:
+        address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4][0]
+    except OSError:
+        return host
+    with _dns_cache_lock:
+        _dns_cache[key] = (time.time(), address)
+    return address
+
+class CachedDNS:
+    """
+    urllib3 connection mixin: the connection goes to the cached address of its host, the TLS
+    server name and the certificate check still use the host name. Only the connections of the
+    pooled session resolve through the cache, socket.getaddrinfo is left alone.
+    """
+
+    @property
+    def host(self):
+        return self._host_name.rstrip('.')
+
+    @host.setter
+    def host(self, host):
+        self._host_name = host
+
+    @property
+    def _dns_host(self):
+        # the address urllib3 opens the socket to
+        return resolve(self._host_name, self.port)
+
+    @_dns_host.setter
+    def _dns_host(self, host):
+        self._host_name = host
+
+class CachedDNSHTTPConnection(CachedDNS, urllib3.connection.HTTPConnection):
+    pass
+
+class CachedDNSHTTPSConnection(CachedDNS, urllib3.connection.HTTPSConnection):
+    pass
+
+class CachedDNSHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+class CachedDNSHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+class PooledAdapter(requests.adapters.HTTPAdapter):
+    """
+    Keep-alive connection pools whose connections resolve their host through the DNS cache
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CachedDNSHTTPConnectionPool, 'https': CachedDNSHTTPSConnectionPool}
+
+class UnixConnection(urllib3.connection.HTTPConnection):
+    """
+    HTTP over a Unix socket, to a process of the current user only
+    """
+
+    def __init__(self, *args, socket_path=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        import daemon
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if isinstance(self.timeout, (int, float)):
+                s.settimeout(self.timeout)
+            s.connect(self.socket_path)
+            if not daemon.is_same_user(s):
+                raise OSError('{} is served by another user'.format(self.socket_path))
+        except OSError as e:
+            s.close()
+            raise urllib3.exceptions.NewConnectionError(self, 'Failed to connect to {}: {}'.format(self.socket_path, e))
+        return s
+
+class UnixConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = UnixConnection
+
+    def __init__(self, socket_path, **kwargs):
+        super().__init__('localhost', socket_path=socket_path, **kwargs)
+
+class UnixAdapter(requests.adapters.HTTPAdapter):
+    """
+    Sends every request of its prefix to the HTTP server on a Unix socket, e.g. the local proxy
+    """
+
+    def __init__(self, socket_path):
+        super().__init__(max_retries=0)
+        self.pool = UnixConnectionPool(socket_path, maxsize=POOL_SIZE)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def close(self):
+        self.pool.close()
+        super().close()
+
+class PooledSession(requests.Session):
+    """
+    The session of the process, it owns the pooled connections and closing it closes them
+    """
+
+class ThreadSession(requests.Session):
+    """
+    The session openai keeps per thread (openai.requestssession), over the adapters of the pooled
+    session. openai closes it after a few minutes, the shared connections are left open.
+    """
+
+    def __init__(self):
+        super().__init__()
+        for prefix, adapter in get_session().adapters.items():
+            self.mount(prefix, adapter)
+
+    def close(self):
+        # the adapters belong to the pooled session
+        self.adapters.clear()
+
+def get_session():
+    """
+    Returns: the pooled session of the process, created on first use
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = PooledSession()
+            for prefix in ('https://', 'http://'):
+                # openai retries failed connections twice as well
+                session.mount(prefix, PooledAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=2))
+            _session = session
+        return _session
+
+def mount(prefix, adapter):
+    """
+    Send the requests of the pooled session (and of the thread sessions created afterwards) to adapter
+    """
+    get_session().mount(prefix, adapter)
+
+def close():
+    """
+    Close the pooled connections of the process
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,488 @@
+import os
+import sys
+import json
+import math
+import mmap
+import struct
+import hashlib
+
+from array import array
+
+from example_index import ExampleIndex, CONTEXTS_LOCATION, get_terms
+from context_archive import ContextArchive, SAVED
+
+# Offline engine answering from the shell history, the saved contexts and the multi-turn log.
+#
+# The main index is a binary file that is memory-mapped on every query:
+# - the documents, (query, command, count) records pointing into a string table
+# - a token inverted index, sorted terms with their posting lists, for "# natural language" queries
+# - a prefix trie of the commands in preorder, each node holding its subtree size and the most
+#   used command below it, for partially typed commands
+#
+# Commands appended to the history since the last build go to a small delta kept in the JSON
+# metadata file, the main index is only rebuilt when the contexts change, the history file
+# is rewritten or the delta is full.
+INDEX_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "local_index_{}")
+INDEX_VERSION = 1
+
+HEADER = struct.Struct('<4sIIIIQQQQQ')
+MAGIC = b'CCLI'
+# string offset, query and command length in bytes, use count
+DOC = struct.Struct('<QIII')
+# string offset, length in bytes, first posting, posting count
+TERM = struct.Struct('<QIQI')
+# trie nodes are (character, subtree size, best document) uint32 triples
+NODE_FIELDS = 3
+NO_DOC = 0xFFFFFFFF
+
+# appended history commands kept out of the main index before it is rebuilt
+DELTA_MAX = 256
+# longer commands are searchable but not completed by prefix
+MAX_COMMAND_LENGTH = 500
+# share of the query terms (idf weighted) an answer has to match
+MIN_COVERAGE = 0.5
+# bytes before the parsed end of the history used to detect a rewritten file
+TAIL_SIZE = 64
+
+def get_history_path(shell):
+    """
+    Returns: the history file of the shell, or None
+    """
+    if shell in ('bash', 'zsh'):
+        if os.environ.get('HISTFILE'):
+            return os.environ['HISTFILE']
+        return os.path.join(os.path.expanduser('~'), '.{}_history'.format(shell))
+    if shell == 'powershell':
+        if sys.platform == 'win32':
+            base = os.path.join(os.environ.get('APPDATA', ''), 'Microsoft', 'Windows', 'PowerShell')
+        else:
+            base = os.path.join(os.path.expanduser('~'), '.local', 'share', 'powershell')
+        return os.path.join(base, 'PSReadLine', 'ConsoleHost_history.txt')
+    return None
+
+def unmetafy(data):
+    """
+    zsh escapes some bytes of its history as 0x83 followed by the byte xor 0x20
+    """
+    if b'\x83' not in data:
+        return data
+    result = bytearray()
+    escaped = False
+    for byte in data:
+        if escaped:
+            result.append(byte ^ 0x20)
+            escaped = False
+        elif byte == 0x83:
+            escaped = True
+        else:
+            result.append(byte)
+    return bytes(result)
+
+def parse_history(data):
+    """
+    Parse bash (with or without timestamps), zsh (plain or extended) and PowerShell history
+
+    Returns: the commands, oldest first
+    """
+    commands = []
+    command = ''
+    for line in unmetafy(data).decode('utf-8', errors='replace').splitlines():
+        # zsh extended history ": <start>:<duration>;command"
+        if command == '' and line.startswith(': ') and ';' in line:
+            line = line.split(';', 1)[1]
+        # zsh and PowerShell continue multi-line commands with a trailing backslash or backtick
+        if line.endswith('\\') or line.endswith('`'):
+            command += line[:-1] + '\n'
+            continue
+        command += line
+        # bash timestamps and comments, including queries typed for Codex
+        if command.strip() != '' and not command.lstrip().startswith('#'):
+            commands.append(command.strip())
+        command = ''
+    return commands
+
+class IndexReader:
+    """
+    Read-only view of a memory-mapped index file
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.doc_count, self.term_count, self.node_count, \
+            self.docs_offset, self.strings_offset, self.terms_offset, postings_offset, nodes_offset = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != INDEX_VERSION:
+            self.close()
+            raise ValueError('Unsupported local index ' + path)
+        self.view = memoryview(self.map)
+        self.postings = self.view[postings_offset:nodes_offset].cast('I')
+        self.nodes = self.view[nodes_offset:nodes_offset + self.node_count * NODE_FIELDS * 4].cast('I')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # the map can only be closed once no view is exported
+        for name in ('nodes', 'postings', 'view'):
+            if hasattr(self, name):
+                getattr(self, name).release()
+        self.map.close()
+        self.file.close()
+
+    def doc(self, id):
+        """
+        Returns: the (query, command, count) of a document
+        """
+        offset, query_length, command_length, count = DOC.unpack_from(self.map, self.docs_offset + id * DOC.size)
+        start = self.strings_offset + offset
+        query = self.map[start:start + query_length].decode('utf-8')
+        command = self.map[start + query_length:start + query_length + command_length].decode('utf-8')
+        return query, command, count
+
+    def term_postings(self, term):
+        """
+        Binary search of the sorted term table
+
+        Returns: the ids of the documents holding the term
+        """
+        term = term.encode('utf-8')
+        low = 0
+        high = self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            offset, length, first, count = TERM.unpack_from(self.map, self.terms_offset + middle * TERM.size)
+            start = self.strings_offset + offset
+            current = self.map[start:start + length]
+            if current == term:
+                return self.postings[first:first + count]
+            if current < term:
+                low = middle + 1
+            else:
+                high = middle
+        return self.postings[0:0]
+
+    def prefix_best(self, prefix, longer=False):
+        """
+        Walk the trie along the prefix, longer skips the command that is the prefix itself
+
+        Returns: the id of the most used command starting with the prefix, or None
+        """
+        nodes = self.nodes
+        node = 0
+        for character in prefix:
+            code = ord(character)
+            child = node + 1
+            end = node + nodes[node * NODE_FIELDS + 1]
+            while child < end and nodes[child * NODE_FIELDS] != code:
+                child += nodes[child * NODE_FIELDS + 1]
+            if child >= end:
+                return None
+            node = child
+        best = nodes[node * NODE_FIELDS + 2]
+        if best == NO_DOC or not longer or self.doc(best)[1] != prefix:
+            return None if best == NO_DOC else best
+
+        # the prefix itself ends at this node, the best of the child subtrees is the next one
+        # with the tie-break of build_trie
+        best = None
+        child = node + 1
+        end = node + nodes[node * NODE_FIELDS + 1]
+        while child < end:
+            id = nodes[child * NODE_FIELDS + 2]
+            if id != NO_DOC and (best is None or (self.doc(id)[2], id) > best):
+                best = (self.doc(id)[2], id)
+            child += nodes[child * NODE_FIELDS + 1]
+        return None if best is None else best[1]
+
+def build_trie(docs):
+    """
+    Build the preorder trie from the sorted commands, keeping only the path of the current command in memory
+
+    Returns: the nodes as a flat uint32 array
+    """
+    entries = sorted((command, count, id) for id, (_, command, count) in enumerate(docs)
+                     if 0 < len(command) <= MAX_COMMAND_LENGTH)
+    nodes = array('I', [0, 0, NO_DOC])
+    # open nodes of the current path: [node, (count, id) of the best command below]
+    stack = [[0, (-1, -1)]]
+
+    def close(entry):
+        node, best = entry
+        nodes[node * NODE_FIELDS + 1] = len(nodes) // NODE_FIELDS - node
+        nodes[node * NODE_FIELDS + 2] = best[1] if best[1] >= 0 else NO_DOC
+
+    previous = ''
+    for command, count, id in entries:
+        common = 0
+        while common < min(len(previous), len(command)) and previous[common] == command[common]:
+            common += 1
+        while len(stack) > common + 1:
+            close(stack.pop())
+        for character in command[common:]:
+            stack.append([len(nodes) // NODE_FIELDS, (-1, -1)])
+            nodes.extend((ord(character), 0, NO_DOC))
+        # later documents are more recent history, they win ties
+        for entry in stack:
+            if (count, id) > entry[1]:
+                entry[1] = (count, id)
+        previous = command
+
+    while len(stack) > 0:
+        close(stack.pop())
+    return nodes
+
+def write_index(path, docs):
+    """
+    Write the (query, command, count) documents as an index file
+    """
+    strings = bytearray()
+    doc_records = bytearray()
+    term_ids = {}
+    for id, (query, command, count) in enumerate(docs):
+        query_bytes = query.encode('utf-8')
+        command_bytes = command.encode('utf-8')
+        doc_records += DOC.pack(len(strings), len(query_bytes), len(command_bytes), count)
+        strings += query_bytes + command_bytes
+        for term in set(get_terms(query + ' ' + command)):
+            term_ids.setdefault(term, []).append(id)
+
+    term_records = bytearray()
+    postings = array('I')
+    for term in sorted(term_ids):
+        term_bytes = term.encode('utf-8')
+        term_records += TERM.pack(len(strings), len(term_bytes), len(postings), len(term_ids[term]))
+        strings += term_bytes
+        postings.extend(term_ids[term])
+
+    nodes = build_trie(docs)
+
+    def align(data):
+        return bytes(data) + b'\0' * (-len(data) % 8)
+
+    sections = [align(doc_records), align(strings), align(term_records), align(postings.tobytes()), nodes.tobytes()]
+    offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, INDEX_VERSION, len(docs), len(term_ids), len(nodes) // NODE_FIELDS, *offsets))
+        for section in sections:
+            f.write(section)
+    os.replace(temp_path, path)
+
+class LocalEngine:
+    """
+    Answers queries from the shell history, the saved contexts and the multi-turn log without the API
+    """
+
+    def __init__(self, shell, engine, store=None, index_path=None, contexts_path=CONTEXTS_LOCATION):
+        self.shell = shell
+        # only used to count the tokens of the context examples
+        self.engine = engine
+        self.store = store
+        self.contexts_path = contexts_path
+        index_path = index_path or INDEX_LOCATION.format(shell)
+        self.index_path = index_path + '.bin'
+        self.meta_path = index_path + '.json'
+        self.history_path = get_history_path(shell)
+
+    def contexts_signature(self):
+        signature = []
+        for name in sorted(os.listdir(self.contexts_path)):
+            if name.endswith('.txt'):
+                stat = os.stat(os.path.join(self.contexts_path, name))
+                signature.append([name, stat.st_mtime, stat.st_size])
+        for entry in sorted(ContextArchive().entries(SAVED), key=lambda entry: entry['file']):
+            signature.append(['archive/' + entry['file'], entry['time'], entry['size']])
+        return signature
+
+    def history_signature(self):
+        if self.history_path is None or not os.path.isfile(self.history_path):
+            return None
+        stat = os.stat(self.history_path)
+        return {'path': self.history_path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'tail': self.history_tail(stat.st_size)}
+
+    def history_tail(self, size):
+        with open(self.history_path, 'rb') as f:
+            f.seek(max(size - TAIL_SIZE, 0))
+            return hashlib.sha256(f.read(min(size, TAIL_SIZE))).hexdigest()
+
+    def read_history(self, start=0):
+        with open(self.history_path, 'rb') as f:
+            f.seek(start)
+            return parse_history(f.read())
+
+    def load_meta(self):
+        if not os.path.isfile(self.meta_path) or not os.path.isfile(self.index_path):
+            return None
+        with open(self.meta_path, 'r') as f:
+            try:
+                meta = json.load(f)
+            except ValueError:
+                return None
+        if meta.get('version') != INDEX_VERSION or meta.get('index_size') != os.path.getsize(self.index_path):
+            return None
+        return meta
+
+    def save_meta(self, meta):
+        temp_path = '{}.{}.tmp'.format(self.meta_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def update(self):
+        """
+        Bring the index up to date with the history and the saved contexts
+
+        Returns: the metadata of the index, with the delta of appended history commands
+        """
+        meta = self.load_meta()
+        contexts = self.contexts_signature()
+
+        if meta is not None and meta['contexts'] == contexts:
+            old = meta['history']
+            exists = self.history_path is not None and os.path.isfile(self.history_path)
+            if old is None and not exists:
+                return meta
+            if old is not None and exists and old['path'] == self.history_path:
+                stat = os.stat(self.history_path)
+                if old['size'] == stat.st_size and old['mtime'] == stat.st_mtime:
+                    return meta
+                # an appended history only parses the new commands, if the rest of the file is untouched
+                if stat.st_size > old['size'] and self.history_tail(old['size']) == old['tail']:
+                    delta = dict((command, count) for _, command, count in meta['delta'])
+                    for command in self.read_history(old['size']):
+                        delta[command] = delta.pop(command, 0) + 1
+                    if len(delta) <= DELTA_MAX:
+                        meta['delta'] = [['', command, count] for command, count in delta.items()]
+                        meta['history'] = self.history_signature()
+                        self.save_meta(meta)
+                        return meta
+
+        return self.rebuild(contexts)
+
+    def rebuild(self, contexts):
+        """
+        Write the main index from scratch, the contexts parse is cached by the example index
+        """
+        history = self.history_signature()
+
+        docs = {}
+        index = ExampleIndex(self.shell, self.engine, self.contexts_path)
+        index.update()
+        for query, completion, _ in index.examples():
+            key = (query.strip(), completion.strip())
+            if key[1] != '':
+                docs[key] = docs.pop(key, 0) + 1
+
+        # history commands are kept in the order they were last used
+        if history is not None:
+            for command in self.read_history():
+                key = ('', command)
+                docs[key] = docs.pop(key, 0) + 1
+
+        write_index(self.index_path, [(query, command, count) for (query, command), count in docs.items()])
+        meta = {
+            'version': INDEX_VERSION,
+            'index_size': os.path.getsize(self.index_path),
+            'contexts': contexts,
+            'history': history,
+            'delta': []
+        }
+        self.save_meta(meta)
+        return meta
+
+    def extra_docs(self, meta):
+        """
+        Returns: the delta history commands and the live multi-turn interactions, searched linearly
+        """
+        docs = [tuple(doc) for doc in meta['delta']]
+        if self.store is not None:
+            for query, completion, _ in self.store.tail():
+                if completion.strip() != '':
+                    docs.append((query.strip(), completion.strip(), 1))
+        return docs
+
+    def search(self, reader, text, extra):
+        """
+        Score the documents sharing terms with the query, each term weighted by its idf
+
+        Returns: the best command, or None if it matches less than MIN_COVERAGE of the query
+        """
+        terms = set(get_terms(text))
+        if len(terms) == 0:
+            return None
+
+        extra_terms = [set(get_terms(query + ' ' + command)) for query, command, _ in extra]
+        total = reader.doc_count + len(extra)
+        weights = {}
+        scores = {}
+        for term in terms:
+            postings = reader.term_postings(term)
+            extra_ids = [i for i, doc_terms in enumerate(extra_terms) if term in doc_terms]
+            weights[term] = math.log((total + 1) / (len(postings) + len(extra_ids) + 0.5))
+            for id in postings:
+                scores[('index', id)] = scores.get(('index', id), 0) + weights[term]
+            for i in extra_ids:
+                scores[('extra', i)] = scores.get(('extra', i), 0) + weights[term]
+
+        if len(scores) == 0:
+            return None
+
+        def rank(key):
+            query, command, count = reader.doc(key[1]) if key[0] == 'index' else extra[key[1]]
+            # answers to a similar question beat history commands sharing the words, then the most used
+            return (scores[key], query != '', count, key[0] == 'extra', key[1])
+
+        best = max(scores, key=rank)
+        if scores[best] < MIN_COVERAGE * sum(weights.values()):
+            return None
+        return reader.doc(best[1])[1] if best[0] == 'index' else extra[best[1]][1]
+
+    def complete_prefix(self, reader, prefix, extra):
+        """
+        Returns: the most used command longer than the prefix and starting with it, or None
+        """
+        candidates = []
+        id = reader.prefix_best(prefix, longer=True)
+        if id is not None:
+            _, command, count = reader.doc(id)
+            candidates.append((count, 0, command))
+        for _, command, count in extra:
+            if command.startswith(prefix) and command != prefix:
+                candidates.append((count, 1, command))
+        if len(candidates) == 0:
+            return None
+        return max(candidates)[2]
+
+    def answer(self, entry):
+        """
+        Answer a "# natural language" query with a whole command
+        and a partially typed command with the rest of it
+
+        Returns: the completion, or None if nothing local matches
+        """
+        meta = self.update()
+        extra = self.extra_docs(meta)
+        last_line = entry.rstrip('\n').split('\n')[-1]
+
+        with IndexReader(self.index_path) as reader:
+            if last_line.lstrip().startswith('#'):
+                command = self.search(reader, last_line, extra)
+                if command is None:
+                    return None
+                return ('' if entry.endswith('\n') else '\n') + command
+
+            prefix = last_line.lstrip()
+            if prefix == '':
+                return None
+            command = self.complete_prefix(reader, prefix, extra)
+            if command is None:
+                return None
+            return command[len(prefix):]
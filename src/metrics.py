@@ -0,0 +1,221 @@
+import os
+import math
+import time
+import contextvars
+
+# Every query appends one JSON line to the metrics log with the wall time of its phases,
+# the token usage reported by the API, the cache outcome and the error type if any.
+# The log is rotated above METRICS_MAX_BYTES, "# show stats" summarizes it.
+# Set CODEX_CLI_METRICS=off to stop recording.
+METRICS_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "metrics.jsonl")
+METRICS_MAX_BYTES = 1024 * 1024
+METRICS_BACKUPS = 3
+
+PERCENTILES = [50, 95, 99]
+
+def is_enabled():
+    return os.environ.get('CODEX_CLI_METRICS', 'on') != 'off'
+
+def process_start_time():
+    """
+    Returns: the time.time() the current process started, None where /proc is not available
+    """
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # the command name may contain spaces, the fields after it are space separated
+            fields = f.read().rsplit(')', 1)[1].split()
+        # both are seconds since boot, btime in /proc/stat would only be precise to the second
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Phase:
+    """
+    Adds the wall time of a with block to a phase of the run
+    """
+
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.run.add(self.name, time.perf_counter() - self.start)
+
+class Run:
+    """
+    Measurements of a single query, written as one line of the metrics log
+    """
+
+    def __init__(self, started=None):
+        self.start = time.perf_counter()
+        # time.time() the query was sent, its deadline counts from there
+        self.started = started if started is not None else time.time()
+        self.record = {'time': time.time(), 'phases': {}}
+        # interpreter startup (and the client round trip in server mode), when the process start is known
+        if started is not None:
+            self.record['phases']['startup'] = max(time.time() - started, 0)
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        phases = self.record['phases']
+        phases[name] = phases.get(name, 0) + seconds
+
+    def set(self, key, value):
+        self.record[key] = value
+
+    def count(self, key, n=1):
+        counts = self.record.setdefault('counts', {})
+        counts[key] = counts.get(key, 0) + n
+
+    def add_usage(self, engine, usage):
+        """
+        Sum the prompt and completion tokens reported by the API per engine
+        """
+        if not usage:
+            return
+        totals = self.record.setdefault('usage', {}).setdefault(engine, {})
+        for key in ('prompt_tokens', 'completion_tokens'):
+            totals[key] = totals.get(key, 0) + int(usage.get(key, 0))
+
+    def finish(self, path=METRICS_LOCATION):
+        self.record['phases']['total'] = time.perf_counter() - self.start + self.record['phases'].get('startup', 0)
+        if is_enabled():
+            write_record(self.record, path)
+
+# the completion server answers several queries at once, each in its own context
+_current = contextvars.ContextVar('run', default=Run())
+
+def start_run(started=None):
+    """
+    Start measuring a new query, started is the process start time if known
+
+    Returns: the run, also available as current() in this thread and the threads started with bind()
+    """
+    run = Run(started)
+    _current.set(run)
+    return run
+
+def current():
+    return _current.get()
+
+def bind(function):
+    """
+    Returns: function running in a copy of the current context, the target of a thread working for
+    the current query, call it once per thread
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+def write_record(record, path=METRICS_LOCATION):
+    """
+    Append a record to the log, rotating it once it is too large
+    """
+    # json (and the re module it loads) stays off the startup path
+    import json
+
+    try:
+        if os.path.isfile(path) and os.path.getsize(path) > METRICS_MAX_BYTES:
+            for i in range(METRICS_BACKUPS - 1, 0, -1):
+                if os.path.isfile('{}.{}'.format(path, i)):
+                    os.replace('{}.{}'.format(path, i), '{}.{}'.format(path, i + 1))
+            os.replace(path, path + '.1')
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError:
+        # metrics never break a query
+        pass
+
+def read_records(path=METRICS_LOCATION):
+    """
+    Returns: the records of the log and its rotated files, oldest first
+    """
+    import json
+
+    records = []
+    for name in ['{}.{}'.format(path, i) for i in range(METRICS_BACKUPS, 0, -1)] + [path]:
+        if not os.path.isfile(name):
+            continue
+        with open(name, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of sorted values
+    """
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize(records):
+    """
+    Returns: a dictionary with the sorted phase times per engine, the cache outcomes, the errors and the token usage
+    """
+    summary = {'phases': {}, 'cache': {}, 'errors': {}, 'usage': {}}
+    for record in records:
+        engine = record.get('engine', '-')
+        for phase, seconds in record.get('phases', {}).items():
+            summary['phases'].setdefault(engine, {}).setdefault(phase, []).append(seconds)
+        if 'cache' in record:
+            summary['cache'][record['cache']] = summary['cache'].get(record['cache'], 0) + 1
+        if 'error' in record:
+            summary['errors'][record['error']] = summary['errors'].get(record['error'], 0) + 1
+        for usage_engine, usage in record.get('usage', {}).items():
+            totals = summary['usage'].setdefault(usage_engine, {})
+            for key, value in usage.items():
+                totals[key] = totals.get(key, 0) + value
+    for phases in summary['phases'].values():
+        for values in phases.values():
+            values.sort()
+    return summary
+
+def show_stats(path=METRICS_LOCATION):
+    records = read_records(path)
+    if len(records) == 0:
+        print('\n#   No metrics recorded yet')
+        return
+
+    summary = summarize(records)
+    lines = ['# {} queries\n'.format(len(records))]
+    for engine in sorted(summary['phases']):
+        lines.append('#\n# engine: {}\n'.format(engine))
+        lines.append('# {:<16}{:>8}{:>10}{:>10}{:>10}\n'.format('phase (ms)', 'count', *['p{}'.format(p) for p in PERCENTILES]))
+        for phase, values in sorted(summary['phases'][engine].items()):
+            lines.append('# {:<16}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}\n'.format(
+                phase, len(values), *[percentile(values, p) * 1000 for p in PERCENTILES]))
+    if len(summary['cache']) > 0:
+        lines.append('#\n# cache: {}\n'.format(', '.join('{} {}'.format(key, value) for key, value in sorted(summary['cache'].items()))))
+    if len(summary['errors']) > 0:
+        lines.append('# errors: {}\n'.format(', '.join('{} {}'.format(key, value) for key, value in sorted(summary['errors'].items()))))
+    for engine, usage in sorted(summary['usage'].items()):
+        lines.append('# tokens {}: {} prompt, {} completion\n'.format(engine, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)))
+    print('\n')
+    print(''.join(lines))
+
+def profile(function, *args):
+    """
+    Run function under cProfile if CODEX_CLI_PROFILE names an output file,
+    the stats can be read with python -m pstats <file>
+
+    Returns: the result of function
+    """
+    path = os.environ.get('CODEX_CLI_PROFILE')
+    if not path:
+        return function(*args)
+
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(path)
@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import random
+import threading
+
+import openai
+import metrics
+import backends
+import http_session
+
+from concurrent.futures import Future, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+
+# Every Completion request (queries, the content filter and batches) goes through create_completion:
+# - token buckets shared by all local processes limit the request rate, one for the queries of the
+#   shells and one for batch mode, a rate halves on rate limit errors and recovers over the next minutes
+#   content filter calls are not limited, there is at most one per query or batch request
+# - retryable errors are retried with jittered exponential backoff, honoring Retry-After hints
+# - a deadline bounds the whole call, retries included
+# - optionally a duplicate (hedged) request is sent when the first one is slower than usual
+# - the request goes to a backend (see backends.py), the OpenAI API by default
+#
+# The defaults below can be overridden in a [client] section of openaiapirc
+
+# token bucket: sustained requests per minute and burst size
+REQUESTS_PER_MINUTE = 60
+BURST = 10
+# the bucket of batch mode, so that a batch neither waits for nor drains the budget of the shells
+BATCH_REQUESTS_PER_MINUTE = 300
+BATCH_BURST = 20
+# the adaptive rate never goes below this many requests per minute
+MIN_REQUESTS_PER_MINUTE = 6
+# requests per minute a halved rate gets back every minute without rate limit errors
+RATE_RECOVERY = 30
+
+# the traffic classes of create_completion, "filter" is not rate limited
+TRAFFIC = ['query', 'batch', 'filter']
+
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+# send a duplicate request once the first one is slower than this percentile of recent latencies
+HEDGE = False
+HEDGE_PERCENTILE = 0.95
+# latencies kept per engine to compute the hedging threshold, in memory, so the completion
+# server and batch mode hedge on what they have seen and no request writes them to the state file
+LATENCY_SAMPLES = 100
+
+STATE_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "client_state.json")
+LOCK_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "client_state.lock")
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+)
+
+_thread_lock = threading.Lock()
+
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+def configure(section):
+    """
+    Apply the [client] section of openaiapirc
+    """
+    global REQUESTS_PER_MINUTE, BURST, BATCH_REQUESTS_PER_MINUTE, BATCH_BURST, MAX_RETRIES, HEDGE, HEDGE_PERCENTILE
+
+    REQUESTS_PER_MINUTE = float(section.get('requests_per_minute', REQUESTS_PER_MINUTE))
+    BURST = float(section.get('burst', BURST))
+    BATCH_REQUESTS_PER_MINUTE = float(section.get('batch_requests_per_minute', BATCH_REQUESTS_PER_MINUTE))
+    BATCH_BURST = float(section.get('batch_burst', BATCH_BURST))
+    MAX_RETRIES = int(section.get('max_retries', MAX_RETRIES))
+    HEDGE = section.get('hedge', 'on' if HEDGE else 'off') == 'on'
+    HEDGE_PERCENTILE = float(section.get('hedge_percentile', HEDGE_PERCENTILE))
+
+    # completions and content filter calls share the pooled keep-alive connections of the process,
+    # openai creates a session per thread
+    http_session.configure(section)
+    openai.requestssession = http_session.ThreadSession
+
+def use_proxy():
+    """
+    Send the requests through the local keep-alive proxy of the user, starting it for the next
+    process if it is not running yet
+    """
+    import api_proxy
+
+    proxy_base, upstream = api_proxy.get_proxy_base(openai.api_base)
+    socket_path = api_proxy.get_socket_path(upstream)
+    if socket_path is None:
+        return
+    if api_proxy.is_running(socket_path):
+        http_session.mount(api_proxy.PROXY_ORIGIN + '/', http_session.UnixAdapter(socket_path))
+        openai.api_base = proxy_base
+    else:
+        api_proxy.spawn(upstream)
+
+class SharedState:
+    """
+    Limiter state shared by every process of the user through a locked JSON file
+    Falls back to an in-process lock where fcntl is not available
+    """
+
+    def __enter__(self):
+        _thread_lock.acquire()
+        self.lock_file = None
+        try:
+            import fcntl
+            self.lock_file = open(LOCK_LOCATION, 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+
+        self.state = {}
+        if os.path.isfile(STATE_LOCATION):
+            try:
+                with open(STATE_LOCATION, 'r') as f:
+                    self.state = json.load(f)
+            except ValueError:
+                self.state = {}
+        return self.state
+
+    def __exit__(self, *exc):
+        try:
+            temp_path = '{}.{}.tmp'.format(STATE_LOCATION, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(temp_path, STATE_LOCATION)
+        finally:
+            if self.lock_file is not None:
+                self.lock_file.close()
+            _thread_lock.release()
+
+def get_limits(traffic):
+    """
+    Returns: the requests per minute and the burst of the bucket of a traffic class
+    """
+    if traffic == 'batch':
+        return BATCH_REQUESTS_PER_MINUTE, BATCH_BURST
+    return REQUESTS_PER_MINUTE, BURST
+
+def get_rate(bucket, now, requests_per_minute):
+    """
+    Returns: the current requests per minute of a bucket, recovering since its last rate limit error
+    """
+    rate = bucket.get('rate', requests_per_minute) + (now - bucket.get('limited', now)) / 60 * RATE_RECOVERY
+    return min(requests_per_minute, rate)
+
+def acquire(deadline=None, traffic='query'):
+    """
+    Take a token from the shared bucket of the traffic class, sleeping until one is available
+
+    Returns: False if no token becomes available before the deadline
+    """
+    requests_per_minute, burst = get_limits(traffic)
+    while True:
+        with SharedState() as state:
+            bucket = state.setdefault(traffic, {})
+            now = time.time()
+            rate = get_rate(bucket, now, requests_per_minute) / 60
+            tokens = min(burst, bucket.get('tokens', burst) + (now - bucket.get('updated', now)) * rate)
+            bucket['updated'] = now
+            if tokens >= 1:
+                bucket['tokens'] = tokens - 1
+                return True
+            bucket['tokens'] = tokens
+            wait_time = (1 - tokens) / rate
+
+        if deadline is not None and time.time() + wait_time > deadline:
+            return False
+        time.sleep(wait_time)
+
+def record_rate_limit(traffic='query'):
+    """
+    Halve the shared request rate of the traffic class after a rate limit error
+    """
+    requests_per_minute, _ = get_limits(traffic)
+    with SharedState() as state:
+        bucket = state.setdefault(traffic, {})
+        now = time.time()
+        bucket['rate'] = max(MIN_REQUESTS_PER_MINUTE, get_rate(bucket, now, requests_per_minute) / 2)
+        bucket['limited'] = now
+        # no more bursts until the rate recovers
+        bucket['tokens'] = min(bucket.get('tokens', 1), 1)
+
+def record_latency(engine, latency):
+    """
+    Remember the latency of a successful request for hedging
+    """
+    with _latencies_lock:
+        latencies = _latencies.setdefault(engine, [])
+        latencies.append(latency)
+        del latencies[:-LATENCY_SAMPLES]
+
+def hedge_threshold(engine):
+    """
+    Returns: the latency percentile after which a duplicate request is sent, None without enough samples
+    """
+    with _latencies_lock:
+        latencies = sorted(_latencies.get(engine, []))
+    if len(latencies) < 10:
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * HEDGE_PERCENTILE))]
+
+def retry_delay(error, attempt):
+    """
+    Jittered exponential backoff, a Retry-After hint from the API takes precedence
+    """
+    headers = getattr(error, 'headers', None) or {}
+    retry_after = headers.get('retry-after') or headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def _call(kwargs, deadline, backend):
+    return backend.create(timeout=None if deadline is None else max(deadline - time.time(), 0.1), **kwargs)
+
+def _request(kwargs, deadline, backend):
+    """
+    Send the request, a request still running at the deadline is abandoned to its daemon thread
+    request_timeout alone only bounds each socket operation, not the whole request
+    """
+    if deadline is None:
+        return _call(kwargs, deadline, backend)
+
+    future = Future()
+    def run():
+        try:
+            future.set_result(_call(kwargs, deadline, backend))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=metrics.bind(run), daemon=True).start()
+    try:
+        return future.result(timeout=max(deadline - time.time(), 0))
+    except FutureTimeoutError:
+        raise openai.error.Timeout('Request deadline exceeded')
+
+def _hedged_request(kwargs, deadline, threshold, backend, limited, traffic):
+    """
+    Send the request, and a duplicate if the first one is not back after threshold seconds
+
+    Returns: the first successful response
+    """
+    def run(future):
+        try:
+            future.set_result(_call(kwargs, deadline, backend))
+        except Exception as e:
+            future.set_exception(e)
+
+    futures = [Future()]
+    threading.Thread(target=metrics.bind(run), args=(futures[0],), daemon=True).start()
+    done, _ = wait(futures, timeout=threshold)
+    # the duplicate is only sent if the limiter has a token to spare right now
+    if len(done) == 0 and (not limited or acquire(time.time(), traffic)):
+        metrics.current().count('hedged')
+        futures.append(Future())
+        threading.Thread(target=metrics.bind(run), args=(futures[1],), daemon=True).start()
+
+    timeout = None if deadline is None else max(deadline - time.time(), 0)
+    pending = futures
+    error = None
+    while len(pending) > 0:
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if len(done) == 0:
+            raise openai.error.Timeout('Request timed out')
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+def create_completion(deadline=None, hedge=None, backend=None, traffic='query', **kwargs):
+    """
+    openai.Completion.create with rate limiting, retries, a deadline (time.time() based)
+    and optional hedging, streamed requests are never hedged
+    backend is a backends.Backend, the OpenAI API if None
+    traffic ("query", "batch" or "filter", see TRAFFIC) picks the rate limiter bucket
+
+    Returns: the Completion response
+    """
+    hedge = HEDGE if hedge is None else hedge
+    backend = backend or backends.get_backend()
+    engine = backend.qualify(kwargs.get('engine', ''))
+    limited = backend.rate_limit and traffic != 'filter'
+    attempt = 0
+
+    while True:
+        if limited and not acquire(deadline, traffic):
+            raise openai.error.Timeout('Request deadline exceeded while waiting for the rate limiter')
+
+        start = time.time()
+        try:
+            threshold = hedge_threshold(engine) if hedge and not kwargs.get('stream') else None
+            if threshold is not None:
+                response = _hedged_request(kwargs, deadline, threshold, backend, limited, traffic)
+            else:
+                response = _request(kwargs, deadline, backend)
+            record_latency(engine, time.time() - start)
+            # streamed responses do not report their usage
+            if not kwargs.get('stream'):
+                metrics.current().add_usage(engine, response.get('usage'))
+            return response
+        except RETRYABLE_ERRORS as e:
+            # the rate of a shared bucket is not lowered by traffic outside of it
+            if isinstance(e, openai.error.RateLimitError) and limited:
+                record_rate_limit(traffic)
+            metrics.current().count('retries')
+            delay = retry_delay(e, attempt)
+            attempt += 1
+            if attempt > MAX_RETRIES or (deadline is not None and time.time() + delay > deadline):
+                raise
+            time.sleep(delay)
@@ -0,0 +1,129 @@
+import json
+import time
+import hashlib
+import threading
+
+from collections import deque
+
+# Speculative prefetch, opt-in with CODEX_CLI_PREFETCH=on for the bash and zsh plugins.
+# After a typing pause on a "#" line the plugin sends the buffer with codex_client.py --prefetch,
+# and the completion server requests the completion in the background, keyed by a hash of the
+# prompt it would send. A newer buffer from the same terminal supersedes the older prefetch.
+# When the hotkey sends the same buffer (with the same context), the query takes the prefetched
+# completion instead of calling the API again. A prefetch still in flight is waited for only
+# briefly, so that a slow or stuck one leaves the normal request enough of the query deadline.
+#
+# The defaults below can be overridden in a [prefetch] section of openaiapirc
+
+# prefetch requests in flight at once, further ones are skipped
+MAX_CONCURRENT = 2
+# prefetch requests started per hour, the spend cap
+MAX_PER_HOUR = 60
+# prefetched completions not taken within this many seconds are dropped
+MAX_AGE = 120
+# seconds a query waits for its prefetch still in flight, at most half of the time left before its
+# deadline, after that the prefetch is cancelled and the query makes its own request
+MAX_WAIT = 2.0
+
+_lock = threading.Lock()
+# key -> Prefetch
+_prefetches = {}
+# (shell, session) -> key of its latest prefetch
+_owners = {}
+# start times of the prefetch requests of the last hour
+_started = deque()
+
+def configure(section):
+    """
+    Apply the [prefetch] section of openaiapirc
+    """
+    global MAX_CONCURRENT, MAX_PER_HOUR, MAX_AGE, MAX_WAIT
+
+    MAX_CONCURRENT = int(section.get('max_concurrent', MAX_CONCURRENT))
+    MAX_PER_HOUR = int(section.get('max_per_hour', MAX_PER_HOUR))
+    MAX_AGE = float(section.get('max_age', MAX_AGE))
+    MAX_WAIT = float(section.get('max_wait', MAX_WAIT))
+
+def make_key(engine, temperature, max_tokens, stop, prompt):
+    """
+    Returns: the hash of everything that determines the completion
+    """
+    data = json.dumps([engine, float(temperature), int(max_tokens), stop, prompt])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class Prefetch:
+    """
+    A completion requested in the background, completion stays None if it failed or was flagged
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.started = time.time()
+        self.done = threading.Event()
+        self.cancelled = False
+        self.completion = None
+
+def _expire(now):
+    for key, prefetch in list(_prefetches.items()):
+        if prefetch.done.is_set() and now - prefetch.started > MAX_AGE:
+            del _prefetches[key]
+    while len(_started) > 0 and now - _started[0] > 3600:
+        _started.popleft()
+
+def start(owner, key, request):
+    """
+    Run request(prefetch) in the background, it returns the completion or None
+    and should stop early once prefetch.cancelled is set
+
+    Returns: False if the prefetch was skipped by the limits
+    """
+    with _lock:
+        now = time.time()
+        _expire(now)
+
+        # the latest buffer of a terminal supersedes its previous prefetch
+        previous = _owners.get(owner)
+        if previous is not None and previous != key and previous in _prefetches:
+            _prefetches.pop(previous).cancelled = True
+        _owners[owner] = key
+        if key in _prefetches:
+            return True
+
+        in_flight = sum(1 for prefetch in _prefetches.values() if not prefetch.done.is_set())
+        if in_flight >= MAX_CONCURRENT or len(_started) >= MAX_PER_HOUR:
+            return False
+        prefetch = Prefetch(key)
+        _prefetches[key] = prefetch
+        _started.append(now)
+
+    def run():
+        try:
+            completion = request(prefetch)
+            prefetch.completion = None if prefetch.cancelled else completion
+        except Exception:
+            prefetch.completion = None
+        finally:
+            prefetch.done.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+def take(key, deadline=None):
+    """
+    Take the prefetched completion of key, waiting for it up to MAX_WAIT seconds if still in flight,
+    and never past half of the time left before the time.time() deadline
+
+    Returns: the completion, None if there is none or it did not arrive in time
+    """
+    with _lock:
+        prefetch = _prefetches.pop(key, None)
+    if prefetch is None:
+        return None
+    timeout = MAX_WAIT
+    if deadline is not None:
+        timeout = min(timeout, max(deadline - time.time(), 0) / 2)
+    if not prefetch.done.wait(timeout):
+        # the normal request takes over with the rest of the deadline
+        prefetch.cancelled = True
+        return None
+    return prefetch.completion
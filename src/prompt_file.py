@@ -1,23 +1,97 @@
 import os
 import time
-import configparser
 
-from pathlib import Path
+from tokenizer import count_tokens, get_context_limit
+from context_store import ContextStore, parse_interactions
+from context_format import read_context_file, write_context_file
 
+# with ranked examples in multi-turn mode, the last interactions are always kept for reference resolution
+RECENT_INTERACTIONS = 2
 
-API_KEYS_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'openaiapirc')
+# CODEX_CLI_SESSION, set by the bash and zsh plugins, gives each terminal its own context and config
+# under sessions/<session>, without it (or when empty) every terminal shares the install directory ones
+SESSION_VARIABLE = 'CODEX_CLI_SESSION'
+SESSIONS_LOCATION = os.path.join(os.path.dirname(__file__), "..", "sessions")
+# sessions unused for this many seconds are removed when a new session starts
+SESSION_MAX_AGE = 7 * 24 * 3600
+
+def get_session():
+    """
+    Returns: the session of the calling terminal, None to use the shared context
+    """
+    return os.environ.get(SESSION_VARIABLE) or None
+
+def get_session_path(session):
+    """
+    Returns: the directory of the session context, created if needed
+    """
+    # e.g. tmux pane ids start with %
+    name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in session).lstrip('.') or '_'
+    path = os.path.join(SESSIONS_LOCATION, name)
+    if not os.path.isdir(path):
+        prune_sessions()
+        os.makedirs(path, exist_ok=True)
+    return path
+
+def prune_sessions():
+    """
+    Remove the sessions whose context was not used for SESSION_MAX_AGE
+    """
+    import shutil
+
+    if not os.path.isdir(SESSIONS_LOCATION):
+        return
+    now = time.time()
+    for name in os.listdir(SESSIONS_LOCATION):
+        path = os.path.join(SESSIONS_LOCATION, name)
+        try:
+            last_used = max([os.path.getmtime(path)] + [os.path.getmtime(os.path.join(path, f)) for f in os.listdir(path)])
+        except OSError:
+            continue
+        if now - last_used > SESSION_MAX_AGE:
+            shutil.rmtree(path, ignore_errors=True)
 
 class PromptFile:
     context_source_filename = ""
     default_context_filename = "current_context.txt"
     default_file_path = os.path.join(os.path.dirname(__file__), "..", default_context_filename)
     default_config_path = os.path.join(os.path.dirname(__file__), "..", "current_context.config")
+    default_log_path = os.path.join(os.path.dirname(__file__), "..", "current_context.log")
+    default_index_path = os.path.join(os.path.dirname(__file__), "..", "current_context.idx")
 
-    def __init__(self, file_name, config):
+    def __init__(self, file_name, config, session=None):
         self.context_source_filename = "{}-context.txt".format(config['shell']) #  feel free to set your own default context path here
         
         self.file_path = self.default_file_path
         self.config_path = self.default_config_path
+        log_path = self.default_log_path
+        index_path = self.default_index_path
+        if session:
+            session_path = get_session_path(session)
+            self.file_path = os.path.join(session_path, self.default_context_filename)
+            self.config_path = os.path.join(session_path, os.path.basename(self.default_config_path))
+            log_path = os.path.join(session_path, os.path.basename(self.default_log_path))
+            index_path = os.path.join(session_path, os.path.basename(self.default_index_path))
+
+        # defaults for keys missing from a loaded context, the engine always comes from openaiapirc
+        self.default_config = dict(config)
+        self.config = dict(config)
+        # config changes made while answering a query are written once, by flush()
+        self.config_dirty = False
+
+        # the interactions live in an append-only log, current_context.txt is only
+        # written as a snapshot for viewing and imported once if it predates the log
+        migrate = not os.path.isfile(index_path) and os.path.isfile(self.file_path)
+        self.store = ContextStore(log_path, index_path)
+        if migrate:
+            with open(self.file_path, 'r') as f:
+                self.store.reset(self.count_interactions(parse_interactions(f.read()), config['engine']))
+
+        # a new session starts with the settings of the shared config, not with its history
+        if session and not self.has_config() and os.path.isfile(self.default_config_path):
+            shared_config, _, _ = read_context_file(self.default_config_path)
+            shared_config['token_count'] = 0
+            self.set_config(dict(self.default_config, **shared_config))
 
         # loading in one of the saved contexts
         if file_name != self.default_context_filename:
@@ -38,19 +112,10 @@ class PromptFile:
             self.set_config(self.config)
             return self.config
         
-        with open(self.config_path, 'r') as f:
-            lines = f.readlines()
-
-        config = {
-            'engine': lines[0].split(':')[1].strip(),
-            'temperature': float(lines[1].split(':')[1].strip()),
-            'max_tokens': int(lines[2].split(':')[1].strip()),
-            'shell': lines[3].split(':')[1].strip(),
-            'multi_turn': lines[4].split(':')[1].strip(),
-            'token_count': int(lines[5].split(':')[1].strip())
-        }
+        config, _, _ = read_context_file(self.config_path)
 
-        self.config = config
+        self.config = dict(self.default_config, **config)
+        self.config_dirty = False
         return self.config 
     
     def set_config(self, config):
@@ -58,14 +123,22 @@ class PromptFile:
         Set the prompt headers with the new config
         """
         self.config = config
-        
-        with open(self.config_path, 'w') as f:
-            f.write('engine: {}\n'.format(self.config['engine']))
-            f.write('temperature: {}\n'.format(self.config['temperature']))
-            f.write('max_tokens: {}\n'.format(self.config['max_tokens']))
-            f.write('shell: {}\n'.format(self.config['shell']))
-            f.write('multi_turn: {}\n'.format(self.config['multi_turn']))
-            f.write('token_count: {}\n'.format(self.config['token_count']))
+        self.config_dirty = False
+        # readers need no lock, the file is replaced atomically
+        with self.store.lock:
+            write_context_file(self.config_path, self.config)
+
+    def flush(self):
+        """
+        Write the config if it changed since it was last written, once per turn
+        Only the token count changes during a turn, settings written meanwhile by another process are kept
+        """
+        if self.config_dirty:
+            with self.store.lock:
+                token_count = self.config['token_count']
+                self.read_config()
+                self.config['token_count'] = token_count
+                self.set_config(self.config)
     
     def show_config(self):
         print('\n')
@@ -75,122 +148,175 @@ class PromptFile:
             lines.append('# {}: {}\n'.format(key, value))
         print(''.join(lines))
     
+    def count_interactions(self, interactions, engine=None):
+        """
+        Returns: the (query, completion) pairs with their token count for the configured engine
+        """
+        engine = engine or self.config['engine']
+        return [(query, completion, count_tokens(query + completion, engine)) for query, completion in interactions]
+
+    def update_token_count(self, token_count):
+        if token_count != self.config['token_count']:
+            self.config['token_count'] = token_count
+            self.config_dirty = True
+
     def add_input_output_pair(self, user_query, prompt_response):
         """
-        Add lines to file_name and update the token_count
+        Append the interaction to the context log and update the token_count
         """
+        with self.store.lock:
+            self.store.append(user_query, prompt_response, count_tokens(user_query + prompt_response, self.config['engine']))
+            # only the most recent of near duplicate interactions is kept
+            self.store.drop_duplicates(last_only=True)
 
-        with open(self.file_path, 'a') as f:
-            f.write(user_query)
-            f.write(prompt_response)
-        
         if self.config['multi_turn'] == 'on':
-            self.config['token_count'] += len(user_query.split()) + len(prompt_response.split())
-            self.set_config(self.config)
+            self.update_token_count(self.store.token_count())
     
-    def read_prompt_file(self, input):
+    def read_prompt_file(self, input, ranked=True):
         """
         Get the updated prompt file
         Checks for token overflow and appends the current input
+        The prompt, the input and the completion (max_tokens) have to fit the context of the engine
+        ranked=False always uses the whole context, e.g. to share it between queries
 
         Returns: the prompt file after appending the input
         """
 
-        input_tokens_count = len(input.split())
-        need_to_refresh = (self.config['token_count'] + input_tokens_count > 2048)
+        input_tokens_count = count_tokens(input, self.config['engine'])
+        budget = get_context_limit(self.config['engine']) - int(self.config['max_tokens']) - input_tokens_count
 
-        if need_to_refresh:
-            # delete first 2 lines of prompt context file
-            with open(self.file_path, 'r') as f:
-                lines = f.readlines()
-                prompt = lines[2:] # drop first 2 lines of prompt
-            with open(self.file_path, 'w') as f:
-                f.writelines(prompt)
+        # drop whole interactions from the start of the context until it fits
+        self.update_token_count(self.store.trim(budget))
 
-        # get input from prompt file
-        with open(self.file_path, 'r') as f:
-            lines = f.readlines()
+        if ranked and int(self.config.get('examples', 0)) > 0:
+            return self.select_examples(input, budget, int(self.config['examples']))
 
-        return ''.join(lines)
+        return self.store.render()
+
+    def select_examples(self, input, budget, k):
+        """
+        Build the prompt from the k examples most relevant to the input,
+        taken from every saved context of the shell and the multi-turn history
+
+        Returns: the selected examples followed by the most recent interactions
+        """
+        # imported here, most queries use the whole context
+        from example_index import ExampleIndex
+
+        history = self.store.tail()
+        recent = history[-RECENT_INTERACTIONS:] if self.config['multi_turn'] == 'on' else []
+        older = history[:len(history) - len(recent)]
+
+        index = ExampleIndex(self.config['shell'], self.config['engine'])
+        index.update()
+        selected = index.select(input, budget - sum(tokens for _, _, tokens in recent), older, k)
+
+        return ''.join(query + completion for query, completion, _ in selected + recent)
     
     def get_token_count(self):
         """
-        Get the actual token count
+        Get the actual token count, recounting every interaction
         """
-        token_count = 0
-        if self.has_config():
-            with open(self.config_path, 'r') as f:
-                lines = f.readlines()
-                token_count = int(lines[5].split(':')[1].strip())
-        
-        true_token_count = 0
-        with open(self.file_path, 'r') as f:
-            lines = f.readlines()
-            # count the number of words in the prompt file
-            for line in lines:
-                true_token_count += len(line.split())
-        
-        if true_token_count != token_count:
-            self.config['token_count'] = true_token_count
-            self.set_config(self.config)
-        
+        with self.store.lock:
+            interactions = self.count_interactions((query, completion) for query, completion, _ in self.store.tail())
+            self.store.reset(interactions)
+            true_token_count = self.store.token_count()
+        self.update_token_count(true_token_count)
         return true_token_count
+
+    def compact_context(self):
+        """
+        Remove every interaction that has a more recent near duplicate and print the tokens saved
+        """
+        before = self.store.token_count()
+        removed = self.store.drop_duplicates()
+        after = self.store.token_count()
+        self.update_token_count(after)
+        print('\n#   Removed {} duplicate interactions, {} tokens saved ({} -> {} tokens)'.format(len(removed), before - after, before, after))
+
+    def show_context(self, n=None):
+        """
+        Print the last n interactions (all of them if n is None) as comments
+        """
+        print('\n')
+        for line in self.store.render(n or None).splitlines():
+            print('# ' + line)
+
+    def write_snapshot(self):
+        """
+        Write the current interactions to current_context.txt, e.g. to open them in an editor
+        """
+        with open(self.file_path, 'w') as f:
+            f.write(self.store.render())
     
+    def get_archive(self):
+        """
+        Returns: the archive of saved and cleared contexts
+        """
+        from context_archive import ContextArchive
+
+        archive = ContextArchive()
+        archive.import_deleted(self.count_interactions)
+        return archive
+
     def clear(self):
         """
         Clear the prompt file, while keeping the config
-        Note: saves a copy to the deleted folder
+        Note: saves a compressed copy to the archive
         """
+        from context_archive import CLEARED
+
         config = self.read_config()
-        filename = time.strftime("%Y-%m-%d_%H-%M-%S") + ".txt"
-        with open(self.file_path, 'r') as f:
-            lines = f.readlines()
-            filename = os.path.join(os.path.dirname(__file__), "..", "deleted", filename)
-            with Path(filename).open('w') as f:
-                f.writelines(lines)
+        name = time.strftime("%Y-%m-%d_%H-%M-%S")
+        self.get_archive().add(name, CLEARED, config, self.store.tail())
         
-        # delete the prompt file
-        with open(self.file_path, 'w') as f:
-            f.write('')
+        # delete the interactions
+        self.store.reset()
         
-        print("\n#   Context has been cleared, temporarily saved to {}".format(filename))
+        print("\n#   Context has been cleared, archived as {}".format(name))
+        config['token_count'] = 0
         self.set_config(config)
     
     def clear_last_interaction(self):
         """
         Clear the last interaction from the prompt file
         """
-        with open(self.file_path, 'r') as f:
-            lines = f.readlines()
-            if len(lines) > 1:
-                lines.pop()
-                lines.pop()
-                with open(self.file_path, 'w') as f:
-                    f.writelines(lines)
-            print("\n#   Unlearned interaction")
+        if self.store.pop() is not None:
+            self.update_token_count(self.store.token_count())
+        print("\n#   Unlearned interaction")
     
     def save_to(self, save_name):
         """
-        Save the prompt file to a new location with the config
+        Save the prompt file with the config to the archive
         """
-        if not save_name.endswith('.txt'):
-            save_name = save_name + '.txt'
-        save_path = os.path.join(os.path.dirname(__file__), "..", "contexts", save_name)
+        from context_archive import SAVED
 
-        # first write the config
-        with open(self.config_path, 'r') as f:
-            lines = f.readlines()
-            lines = ['## ' + line for line in lines]
-            with Path(save_path).open('w') as f:
-                f.writelines(lines)
-        
-        # then write the prompt file
-        with open(self.file_path, 'r') as f:
-            lines = f.readlines()
-            with Path(save_path).open('a') as f:
-                f.writelines(lines)
+        if save_name.endswith('.txt'):
+            save_name = save_name[:-len('.txt')]
+
+        # the config, the interactions and their token counts go into a single compressed entry
+        self.get_archive().add(save_name, SAVED, self.config, self.store.tail())
         
         print('\n#   Context saved to {}'.format(save_name))
+
+    def list_contexts(self):
+        """
+        Print the contexts that can be loaded: the context files and the archive entries
+        """
+        from context_archive import show_entries
+
+        contexts_path = os.path.join(os.path.dirname(__file__), "..", "contexts")
+        names = sorted(name[:-len('.txt')] for name in os.listdir(contexts_path) if name.endswith('.txt'))
+        print('\n#   Context files: {}'.format(', '.join(names)))
+        show_entries(self.get_archive().entries(), 'Archived contexts')
+
+    def search_contexts(self, text):
+        """
+        Print the archived contexts whose name or queries match text
+        """
+        from context_archive import show_entries
+
+        show_entries(self.get_archive().search(text), 'Contexts matching "{}"'.format(text))
     
     def start_multi_turn(self):
         """
@@ -221,26 +347,29 @@ class PromptFile:
         """
         if not filename.endswith('.txt'):
             filename = filename + '.txt'
-        filepath = Path(os.path.join(os.path.dirname(__file__), "..", "contexts", filename))
-
-        # check if the file exists
-        if filepath.exists():
-            with filepath.open('r') as f:
-                lines = f.readlines()
-            
-            # read in the engine name from openaiapirc
-            config = configparser.ConfigParser()
-            config.read(API_KEYS_LOCATION)
-            ENGINE = config['openai']['engine'].strip('"').strip("'")
-
-            config = {
-                'engine': ENGINE,
-                'temperature': float(lines[1].split(':')[1].strip()),
-                'max_tokens': int(lines[2].split(':')[1].strip()),
-                'shell': lines[3].split(':')[1].strip(),
-                'multi_turn': lines[4].split(':')[1].strip(),
-                'token_count': int(lines[5].split(':')[1].strip())
-            }
+        filepath = os.path.join(os.path.dirname(__file__), "..", "contexts", filename)
+
+        # the saved and cleared contexts of the archive first, a newer save replaces an older context file
+        context = None
+        if not initialize:
+            from context_archive import ContextArchive
+            archive = ContextArchive()
+            entry = archive.find(filename[:-len('.txt')])
+            if entry is not None:
+                context = archive.read(entry)
+        if context is None and os.path.exists(filepath):
+            # version 1 contexts are migrated to the current format on the first load
+            context = read_context_file(filepath)
+
+        # check if the context exists
+        if context is not None:
+            config, body, token_counts = context
+
+            # the engine name comes from openaiapirc
+            config = dict(self.default_config, **config)
+            config['engine'] = self.default_config['engine']
+            # the completion stats are kept per context, see completion_stats.py
+            config['context'] = filename[:-len('.txt')]
 
             # use new config if old config doesn't exist
             if initialize == False or self.has_config() == False:
@@ -248,12 +377,19 @@ class PromptFile:
             else:
                 self.config = self.read_config()
 
-            lines = lines[6:]
-
             # write to the current prompt file if we are in multi-turn mode
             if initialize == False or self.config['multi_turn'] == "off":
-                with open(self.file_path, 'w') as f:
-                    f.writelines(lines)
+                interactions = parse_interactions(body)
+                # every one-shot call in single-turn mode loads the default context, the log is left alone if it already holds it
+                if not initialize or not self.store.holds(interactions):
+                    # token counts saved with the context are reused, otherwise the interactions are counted
+                    if token_counts is not None and len(token_counts) == len(interactions):
+                        interactions = [(query, completion, tokens) for (query, completion), tokens in zip(interactions, token_counts)]
+                    else:
+                        interactions = self.count_interactions(interactions)
+                    self.store.reset(interactions)
+                self.update_token_count(self.store.token_count())
+                self.flush()
                 
                 if initialize == False:
                     print('\n#   Context loaded from {}'.format(filename))
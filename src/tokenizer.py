@@ -0,0 +1,126 @@
+import os
+
+# re and base64 are imported when the tokenizer is first used, this module
+# is loaded on the startup path of every command
+
+# byte pair encoding files, in the tiktoken format ("<base64 token> <rank>" per line)
+# for example tokenizer/p50k_base.tiktoken, they are not shipped with the repo (see the README),
+# until one is installed the counts of its engines are estimates
+TOKENIZER_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "tokenizer")
+
+# encoding used by each engine, unknown engines use DEFAULT_ENCODING
+ENGINE_ENCODINGS = {
+    'code-davinci-002': 'p50k_base',
+    'code-davinci-001': 'p50k_base',
+    'code-cushman-002': 'p50k_base',
+    'code-cushman-001': 'p50k_base',
+    'davinci-codex': 'p50k_base',
+    'cushman-codex': 'p50k_base',
+}
+DEFAULT_ENCODING = 'p50k_base'
+
+# context window of each engine in tokens, shared by the prompt and the completion
+# can be overridden in the [context_limits] section of openaiapirc
+CONTEXT_LIMITS = {
+    'code-davinci-002': 8001,
+    'code-davinci-001': 8001,
+    'code-cushman-002': 2048,
+    'code-cushman-001': 2048,
+    'davinci-codex': 4096,
+    'cushman-codex': 2048,
+}
+DEFAULT_CONTEXT_LIMIT = 2048
+
+# pre-tokenization of the GPT-2/Codex encodings, with the unicode classes approximated for the re module
+PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+|_+"""
+
+# characters per token when no encoding file is available
+CHARS_PER_TOKEN = 5
+
+# the per piece cache is reset once it holds this many pieces
+PIECE_CACHE_SIZE = 100000
+
+_tokenizers = {}
+
+class Tokenizer:
+    """
+    Offline byte pair encoder, only used to count tokens
+    If the encoding file is missing, the count is estimated from the pre-tokenized pieces
+    """
+
+    def __init__(self, encoding_path=None):
+        import re
+
+        self.pattern = re.compile(PATTERN)
+        self.ranks = None
+        self.piece_cache = {}
+
+        if encoding_path is not None and os.path.isfile(encoding_path):
+            import base64
+
+            self.ranks = {}
+            with open(encoding_path, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        token, rank = line.split()
+                        self.ranks[base64.b64decode(token)] = int(rank)
+
+    def _merge(self, piece):
+        """
+        Byte pair merge of a single piece, merging the lowest ranked pair first
+
+        Returns: the number of tokens of the piece
+        """
+        parts = [piece[i:i + 1] for i in range(len(piece))]
+        while len(parts) > 1:
+            best_rank = None
+            best_index = None
+            for i in range(len(parts) - 1):
+                rank = self.ranks.get(parts[i] + parts[i + 1])
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best_rank = rank
+                    best_index = i
+            if best_index is None:
+                break
+            parts[best_index:best_index + 2] = [parts[best_index] + parts[best_index + 1]]
+        return len(parts)
+
+    def count_piece(self, piece):
+        count = self.piece_cache.get(piece)
+        if count is None:
+            if self.ranks is None:
+                count = max(1, -(-len(piece.strip()) // CHARS_PER_TOKEN))
+            else:
+                data = piece.encode('utf-8')
+                count = 1 if data in self.ranks else self._merge(data)
+            if len(self.piece_cache) >= PIECE_CACHE_SIZE:
+                self.piece_cache.clear()
+            self.piece_cache[piece] = count
+        return count
+
+    def count(self, text):
+        """
+        Returns: the number of tokens in text
+        """
+        return sum(self.count_piece(piece) for piece in self.pattern.findall(text))
+
+def get_tokenizer(engine):
+    """
+    Returns: the tokenizer of the encoding used by engine, loaded once per process
+    """
+    encoding = ENGINE_ENCODINGS.get(engine, DEFAULT_ENCODING)
+    if encoding not in _tokenizers:
+        _tokenizers[encoding] = Tokenizer(os.path.join(TOKENIZER_LOCATION, encoding + '.tiktoken'))
+    return _tokenizers[encoding]
+
+def count_tokens(text, engine):
+    """
+    Returns: the number of tokens in text for the given engine
+    """
+    return get_tokenizer(engine).count(text)
+
+def get_context_limit(engine):
+    """
+    Returns: the context window of the engine in tokens
+    """
+    return CONTEXT_LIMITS.get(engine, DEFAULT_CONTEXT_LIMIT)
@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from local_engine import LocalEngine, IndexReader, write_index
+
+class CompletePrefixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.directory.name, 'index.bin')
+        self.engine = LocalEngine('bash', 'local', index_path=os.path.join(self.directory.name, 'index'), contexts_path=self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def complete(self, docs, prefix, extra=()):
+        write_index(self.index_path, docs)
+        with IndexReader(self.index_path) as reader:
+            return self.engine.complete_prefix(reader, prefix, list(extra))
+
+    def test_most_used_command(self):
+        docs = [('', 'git status', 3), ('', 'git log', 5), ('', 'ls -la', 9)]
+        self.assertEqual(self.complete(docs, 'git'), 'git log')
+
+    def test_prefix_identical_to_best_command(self):
+        # the most used command is the prefix itself, the next ranked one is completed
+        docs = [('', 'git', 10), ('', 'git status', 3), ('', 'git log', 5), ('', 'gitk', 1)]
+        self.assertEqual(self.complete(docs, 'git'), 'git log')
+        self.assertEqual(self.complete(docs, 'git s'), 'git status')
+
+    def test_prefix_identical_to_only_command(self):
+        self.assertIsNone(self.complete([('', 'git', 10), ('', 'ls', 2)], 'git'))
+
+    def test_prefix_identical_to_delta_command(self):
+        docs = [('', 'git status', 3)]
+        self.assertEqual(self.complete(docs, 'git', [('', 'git', 20)]), 'git status')
+
+if __name__ == '__main__':
+    unittest.main()
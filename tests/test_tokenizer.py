@@ -0,0 +1,41 @@
+import os
+import sys
+import base64
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from tokenizer import Tokenizer
+
+class TokenizerTest(unittest.TestCase):
+
+    def setUp(self):
+        # every single byte, then the merges he < ll < hell
+        ranks = [bytes([i]) for i in range(256)] + [b'he', b'll', b'hell']
+        self.directory = tempfile.TemporaryDirectory()
+        self.encoding_path = os.path.join(self.directory.name, 'test.tiktoken')
+        with open(self.encoding_path, 'wb') as f:
+            for rank, token in enumerate(ranks):
+                f.write(base64.b64encode(token) + b' ' + str(rank).encode('ascii') + b'\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_byte_pair_merges(self):
+        tokenizer = Tokenizer(self.encoding_path)
+        self.assertIsNotNone(tokenizer.ranks)
+        # hell + o
+        self.assertEqual(tokenizer.count('hello'), 2)
+        # hell + o, then " " + hell + o: no pair with the space was learned
+        self.assertEqual(tokenizer.count('hello hello'), 5)
+        # a piece that is a token of its own
+        self.assertEqual(tokenizer.count('hell'), 1)
+
+    def test_estimate_without_encoding_file(self):
+        tokenizer = Tokenizer(os.path.join(self.directory.name, 'missing.tiktoken'))
+        self.assertIsNone(tokenizer.ranks)
+        self.assertEqual(tokenizer.count('hello hello'), 2)
+
+if __name__ == '__main__':
+    unittest.main()